@@ -0,0 +1,14 @@
+# -*- coding: utf8 -*-
+"""
+Benchmarks for icecake.
+
+sitegen builds a synthetic site on top of the starter site that icecake init
+writes, so every run measures the same amount of work. run times the things
+that make icecake feel slow: cold and incremental builds, the delay between
+saving a file and its output changing in watch mode, and the queries templates
+make. Results are written as JSON and can be compared against a baseline:
+
+    python -m benchmarks run --output baseline.json
+    python -m benchmarks run --output current.json
+    python -m benchmarks compare baseline.json current.json
+"""
@@ -0,0 +1,280 @@
+# -*- coding: utf8 -*-
+"""
+Run the benchmarks against a synthetic site and compare results.
+"""
+from __future__ import absolute_import, division, print_function, unicode_literals
+import json
+import os
+from os.path import exists, isdir, join
+import platform
+import shutil
+import tempfile
+import time
+
+
+import click
+
+
+from icecake.cli import Site
+from benchmarks import sitegen
+
+
+__metaclass__ = type
+
+try:
+    wall_clock = time.perf_counter
+except AttributeError:
+    wall_clock = time.time
+
+version = 1
+
+
+def clean(root):
+    for folder in ["output", ".icecake"]:
+        if isdir(join(root, folder)):
+            shutil.rmtree(join(root, folder))
+
+
+def touch_page(root, index, run):
+    """
+    Change the body of a generated page, so it has to be rendered again.
+    Returns the marker we wrote, so callers can look for it in the output.
+    """
+    marker = "edit-%d-%f" % (run, time.time())
+    with open(join(root, sitegen.page_path(index)), mode="a") as f:
+        f.write("\n%s\n" % marker)
+    return marker
+
+
+def cold_build(root, config, repeat):
+    """
+    Load and build the site with no snapshot or converted markdown to reuse
+    """
+    runs = []
+    for _ in range(repeat):
+        clean(root)
+        start = wall_clock()
+        Site(root, snapshot=True).build()
+        runs.append(wall_clock() - start)
+    return runs
+
+
+def incremental_build(root, config, repeat):
+    """
+    Load the site from its snapshot and rebuild after one page changed
+    """
+    if not exists(join(root, ".icecake")):
+        Site(root, snapshot=True).build()
+    runs = []
+    for run in range(repeat):
+        touch_page(root, run % config["pages"], run)
+        start = wall_clock()
+        Site(root, snapshot=True).build(incremental=True)
+        runs.append(wall_clock() - start)
+    return runs
+
+
+def watch_save(root, config, repeat, timeout=30):
+    """
+    Time from saving a page to its output changing while icecake watch runs
+    """
+    from icecake.watcher import Watcher
+    site = Site(root, snapshot=True)
+    site.build(incremental=True)
+    watcher = Watcher(site)
+    watcher.start()
+    runs = []
+    try:
+        for run in range(repeat):
+            index = run % config["pages"]
+            page = site.pagedata[os.path.relpath(sitegen.page_path(index), "content")]
+            target = join(site.output_dir, page.get_target())
+            marker = touch_page(root, index, run)
+            start = wall_clock()
+            while True:
+                with open(target) as f:
+                    if marker in f.read():
+                        break
+                if wall_clock() - start > timeout:
+                    raise RuntimeError("%s was not rebuilt within %ds" % (target, timeout))
+                time.sleep(0.001)
+            runs.append(wall_clock() - start)
+            # Let the listings that include the page catch up before the next run
+            while len(watcher.queue):
+                time.sleep(0.01)
+    finally:
+        watcher.stop()
+    return runs
+
+
+def list_dependents(root, config, repeat):
+    """
+    List the pages that use the innermost layout, which is every generated
+    page
+    """
+    site = Site(root)
+    name = sitegen.layout_name(config["depth"])
+    runs = []
+    for _ in range(repeat):
+        start = wall_clock()
+        site.list_dependents(name)
+        runs.append(wall_clock() - start)
+    return runs
+
+
+def pages_query(root, config, repeat):
+    """
+    Run the kinds of queries the starter site's listings make
+    """
+    site = Site(root)
+    runs = []
+    for _ in range(repeat):
+        start = wall_clock()
+        site.pages(path="articles/", order="-date")
+        site.pages(tag="tag-0", order="title")
+        site.pages(path="articles/", order="-date", limit=5)
+        runs.append(wall_clock() - start)
+    return runs
+
+
+benchmarks = [
+    ("cold_build", cold_build),
+    ("incremental_build", incremental_build),
+    ("watch_save", watch_save),
+    ("list_dependents", list_dependents),
+    ("pages_query", pages_query),
+]
+
+
+def summarize(runs):
+    ordered = sorted(runs)
+    middle = len(ordered) // 2
+    if len(ordered) % 2:
+        median = ordered[middle]
+    else:
+        median = (ordered[middle - 1] + ordered[middle]) / 2
+    return {"median": median, "min": ordered[0], "max": ordered[-1], "runs": runs}
+
+
+def run(root=None, repeat=5, only=None, **settings):
+    """
+    Generate a site and run the benchmarks against it. If root is None the
+    site is generated in a temporary folder and deleted afterwards. Returns
+    the results as a dict.
+    """
+    config = dict(sitegen.defaults)
+    config.update(settings)
+    temporary = root is None
+    if temporary:
+        root = tempfile.mkdtemp(prefix="icecake-bench-")
+    try:
+        sitegen.generate(root, **config)
+        results = {}
+        for name, benchmark in benchmarks:
+            if only and name not in only:
+                continue
+            results[name] = summarize(benchmark(root, config, repeat))
+    finally:
+        if temporary:
+            shutil.rmtree(root)
+    return {
+        "version": version,
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "config": config,
+        "repeat": repeat,
+        "results": results,
+    }
+
+
+def compare(baseline, current, threshold=0.1):
+    """
+    Compare the median of each benchmark to a baseline. Returns a list of
+    (name, baseline median, current median, change) and a list of the names
+    that got slower by more than threshold, which is a fraction.
+    """
+    rows = []
+    regressions = []
+    for name, _ in benchmarks:
+        if name not in baseline["results"] or name not in current["results"]:
+            continue
+        before = baseline["results"][name]["median"]
+        after = current["results"][name]["median"]
+        change = (after - before) / before if before else 0.0
+        rows.append((name, before, after, change))
+        if change > threshold:
+            regressions.append(name)
+    return rows, regressions
+
+
+def load(path):
+    with open(path) as f:
+        results = json.load(f)
+    if results.get("version") != version:
+        raise click.ClickException("%s was written by a different version of the benchmarks" % path)
+    return results
+
+
+@click.group()
+def main():
+    pass
+
+
+@main.command("generate", help="Write a synthetic site into PATH")
+@click.option("--pages", default=sitegen.defaults["pages"])
+@click.option("--tags", default=sitegen.defaults["tags"])
+@click.option("--code-blocks", default=sitegen.defaults["code_blocks"])
+@click.option("--depth", default=sitegen.defaults["depth"], help="Template nesting depth")
+@click.option("--static-files", default=sitegen.defaults["static_files"])
+@click.option("--static-size", default=sitegen.defaults["static_size"], help="Bytes per static file")
+@click.option("--seed", default=sitegen.defaults["seed"])
+@click.argument("path", type=click.Path())
+def generate_command(path, **settings):
+    sitegen.generate(path, **settings)
+
+
+@main.command("run", help="Generate a site, run the benchmarks and write the results as JSON")
+@click.option("--pages", default=sitegen.defaults["pages"])
+@click.option("--tags", default=sitegen.defaults["tags"])
+@click.option("--code-blocks", default=sitegen.defaults["code_blocks"])
+@click.option("--depth", default=sitegen.defaults["depth"], help="Template nesting depth")
+@click.option("--static-files", default=sitegen.defaults["static_files"])
+@click.option("--static-size", default=sitegen.defaults["static_size"], help="Bytes per static file")
+@click.option("--seed", default=sitegen.defaults["seed"])
+@click.option("--repeat", default=5, help="How many times to run each benchmark")
+@click.option("--only", multiple=True, type=click.Choice([name for name, _ in benchmarks]),
+              help="Only run this benchmark. May be repeated.")
+@click.option("--site", default=None, type=click.Path(),
+              help="Generate the site here and keep it, instead of in a temporary folder")
+@click.option("--output", default="bench.json", type=click.Path(), help="Where to write the results")
+def run_command(repeat, only, site, output, **settings):
+    results = run(site, repeat=repeat, only=only, **settings)
+    for name, _ in benchmarks:
+        if name in results["results"]:
+            summary = results["results"][name]
+            click.echo("%-18s median %9.4fs  min %9.4fs  max %9.4fs" %
+                       (name, summary["median"], summary["min"], summary["max"]))
+    with open(output, "w") as f:
+        json.dump(results, f, indent=2, sort_keys=True)
+    click.echo("Wrote results to %s" % output)
+
+
+@main.command("compare", help="""
+    Compare benchmark results against a baseline. Exits with status 1 if any
+    benchmark got slower by more than the threshold.
+    """)
+@click.option("--threshold", default=0.1, help="Allowed slowdown, as a fraction of the baseline")
+@click.argument("baseline", type=click.Path(exists=True))
+@click.argument("current", type=click.Path(exists=True))
+def compare_command(threshold, baseline, current):
+    baseline = load(baseline)
+    current = load(current)
+    if baseline["config"] != current["config"]:
+        click.echo("Warning: the results were measured on sites generated with different settings")
+    rows, regressions = compare(baseline, current, threshold)
+    click.echo("%-18s %10s %10s %8s" % ("Benchmark", "Baseline", "Current", "Change"))
+    for name, before, after, change in rows:
+        flag = "  SLOWER" if name in regressions else ""
+        click.echo("%-18s %9.4fs %9.4fs %+7.1f%%%s" % (name, before, after, change * 100, flag))
+    if regressions:
+        raise SystemExit(1)
@@ -0,0 +1,112 @@
+# -*- coding: utf8 -*-
+"""
+Generate synthetic sites for benchmarks. The same settings and seed always
+produce the same site.
+"""
+from __future__ import absolute_import, division, print_function, unicode_literals
+import binascii
+from datetime import date, timedelta
+import os
+from os.path import dirname, isdir, join
+import random
+
+
+from icecake.cli import Site
+
+
+__metaclass__ = type
+
+defaults = {
+    "pages": 200,
+    "tags": 20,
+    "code_blocks": 2,
+    "depth": 3,
+    "static_files": 20,
+    "static_size": 64 * 1024,
+    "seed": 0,
+}
+
+words = ("cake pie frosting sprinkles oven flour sugar butter batter layer crumb "
+         "whisk bake glaze icing slice recipe kitchen chocolate vanilla").split()
+
+code = '''```python
+def bake_%(index)d(layers, flavor="vanilla"):
+    """Bake a cake with %(index)d extra layers"""
+    cake = []
+    for layer in range(layers + %(index)d):
+        cake.append({"layer": layer, "flavor": flavor})
+    return cake
+```
+'''
+
+
+def write(root, path, data, mode="w"):
+    target = join(root, path)
+    if not isdir(dirname(target)):
+        os.makedirs(dirname(target))
+    with open(target, mode=mode) as f:
+        f.write(data)
+
+
+def layout_name(level):
+    """
+    Get the layout for a level of template nesting. Level 0 is the starter
+    site's markdown.html; every other level extends the one before it.
+    """
+    if level == 0:
+        return "markdown.html"
+    return "bench/level%d.html" % level
+
+
+def paragraph(rng, count=60):
+    return " ".join(rng.choice(words) for _ in range(count)).capitalize() + "."
+
+
+def page_path(index):
+    return join("content", "articles", "bench", "page-%04d.md" % index)
+
+
+def generate(root, pages=200, tags=20, code_blocks=2, depth=3, static_files=20,
+             static_size=64 * 1024, seed=0):
+    """
+    Write a synthetic site into root, starting from the starter site.
+
+    pages -- Markdown articles to write. They are listed by the starter site's
+             index, articles, tags and atom pages.
+    tags -- How many distinct tags the articles use
+    code_blocks -- Highlighted code blocks per article
+    depth -- How many layouts deep the article template extends
+    static_files -- Files to write under static
+    static_size -- The size of each static file in bytes
+    """
+    rng = random.Random(seed)
+    Site.scaffold(root)
+    for level in range(1, depth + 1):
+        write(root, join("layouts", layout_name(level)),
+              '{%% extends "%s" %%}\n'
+              '{%% block content %%}<div class="level-%d">{{ super() }}</div>{%% endblock %%}\n'
+              % (layout_name(level - 1), level))
+    start = date(2016, 1, 1)
+    for index in range(pages):
+        count = min(tags, rng.randint(1, 3))
+        page_tags = sorted(set("tag-%d" % rng.randrange(tags) for _ in range(count))) if tags else []
+        parts = [
+            "title = Benchmark page %d" % index,
+            "date = %s" % (start + timedelta(days=index)).isoformat(),
+            "tags = %s" % " ".join(page_tags),
+            "template = %s" % layout_name(depth),
+            "++++",
+            "",
+        ]
+        for block in range(max(code_blocks, 1)):
+            parts.append(paragraph(rng))
+            parts.append("")
+            if block < code_blocks:
+                parts.append(code % {"index": index * code_blocks + block})
+        write(root, page_path(index), "\n".join(parts) + "\n")
+    for index in range(static_files):
+        data = b""
+        if static_size:
+            data = binascii.unhexlify("%0*x" % (static_size * 2, rng.getrandbits(static_size * 8)))
+        write(root, join("static", "bench", "asset-%04d.bin" % index), data, mode="wb")
+    return root
@@ -0,0 +1,227 @@
+# -*- coding: utf8 -*-
+"""
+Pack the build cache in .icecake into one archive and restore it somewhere
+else, so CI runners that start from a fresh checkout still get a warm,
+incremental build.
+
+The archive records the icecake, Python, Markdown and Pygments versions and
+the Markdown configuration it was built with, and is only restored into a
+site that matches all of them. It also records the size, mtime and hash of
+every page's source when it was packed. A checkout gives every file a new mtime, so when
+the cache is restored the pages whose content is the same get their new
+mtime in the snapshot and page store, and are not parsed again.
+"""
+from __future__ import absolute_import, division, print_function, unicode_literals
+import io
+import json
+import os
+from os.path import dirname, isabs, isdir, isfile, join, normpath, relpath
+import platform
+import shutil
+import time
+
+
+from . import __version__
+from .snapshot import Snapshot, file_digest
+
+
+__metaclass__ = type
+
+# The layout of the archive
+version = 1
+metadata_name = 'icecake-cache.json'
+prefix = 'cache/'
+
+
+class CacheError(Exception):
+    pass
+
+
+class StaleCache(CacheError):
+    """The archive was made by a different setup than this one"""
+    pass
+
+
+def python_version():
+    return '.'.join(platform.python_version_tuple()[:2])
+
+
+def library_versions():
+    """
+    The versions of the libraries whose output is cached. A new Markdown or
+    Pygments can convert or highlight the same source differently.
+    """
+    import markdown
+    import pygments
+    # Markdown 2 calls it version
+    return getattr(markdown, '__version__', getattr(markdown, 'version', None)), pygments.__version__
+
+
+def describe(site):
+    """
+    What a cache depends on, besides the site's sources
+    """
+    markdown_version, pygments_version = library_versions()
+    return {
+        'icecake': __version__,
+        'python': python_version(),
+        'markdown': site.markdown_key(),
+        'markdown_version': markdown_version,
+        'pygments': pygments_version,
+    }
+
+
+def sources(site):
+    """
+    Get {path: [mtime, size, sha1]} for every page's source
+    """
+    found = {}
+    for path, stat in site.scan('content'):
+        sha1 = file_digest(join(site.root, 'content', path))
+        found[path.replace(os.sep, '/')] = [stat.st_mtime, stat.st_size, sha1]
+    return found
+
+
+def export(site, path):
+    """
+    Write site.cache_dir to a .tar.gz at path. Returns the number of files
+    packed.
+    """
+    import tarfile
+    if not isdir(site.cache_dir):
+        raise CacheError('There is no cache to export; %s does not exist' % site.cache_dir)
+    metadata = dict(describe(site), version=version, created=time.time(), sources=sources(site))
+    data = json.dumps(metadata, indent=2, sort_keys=True).encode('utf-8')
+    if dirname(path) and not isdir(dirname(path)):
+        os.makedirs(dirname(path))
+    count = 0
+    temp = path + '.tmp'
+    with tarfile.open(temp, 'w:gz') as archive:
+        info = tarfile.TarInfo(metadata_name)
+        info.size = len(data)
+        info.mtime = metadata['created']
+        info.mode = 0o644
+        archive.addfile(info, io.BytesIO(data))
+        for folder, _, files in os.walk(site.cache_dir):
+            for name in sorted(files):
+                # Files we were in the middle of writing
+                if name.endswith('.tmp'):
+                    continue
+                source = join(folder, name)
+                archive.add(source, arcname=prefix + relpath(source, site.cache_dir).replace(os.sep, '/'))
+                count += 1
+    if platform.system() == 'Windows' and isfile(path):
+        os.remove(path)  # rename does not replace files on Windows
+    os.rename(temp, path)
+    return count
+
+
+def read_metadata(archive, path):
+    try:
+        member = archive.getmember(metadata_name)
+    except KeyError:
+        raise CacheError('%s is not an icecake cache' % path)
+    metadata = json.loads(archive.extractfile(member).read().decode('utf-8'))
+    if metadata.get('version') != version:
+        raise StaleCache('%s was packed by a different version of icecake' % path)
+    return metadata
+
+
+def check(site, metadata):
+    """
+    Raise StaleCache if the cache was built with a different setup
+    """
+    current = describe(site)
+    reasons = []
+    if metadata['icecake'] != current['icecake']:
+        reasons.append('icecake %s, not %s' % (metadata['icecake'], current['icecake']))
+    if metadata['python'] != current['python']:
+        reasons.append('Python %s, not %s' % (metadata['python'], current['python']))
+    if metadata.get('markdown_version') != current['markdown_version']:
+        reasons.append('Markdown %s, not %s' % (metadata.get('markdown_version'), current['markdown_version']))
+    if metadata.get('pygments') != current['pygments']:
+        reasons.append('Pygments %s, not %s' % (metadata.get('pygments'), current['pygments']))
+    if metadata['markdown'] != current['markdown']:
+        reasons.append('different Markdown extensions or options')
+    if reasons:
+        raise StaleCache('The cache was built with %s' % ', '.join(reasons))
+
+
+def restore(site, path):
+    """
+    Replace site.cache_dir with the cache packed in path. Returns the number
+    of files restored and the number of pages whose mtime was brought up to
+    date. Raises StaleCache without touching anything if the cache doesn't
+    match the site.
+    """
+    import tarfile
+    try:
+        archive = tarfile.open(path, 'r:*')
+    except (IOError, tarfile.TarError) as e:
+        raise CacheError('Could not read %s: %s' % (path, e))
+    with archive:
+        metadata = read_metadata(archive, path)
+        check(site, metadata)
+        temp = site.cache_dir + '.import'
+        if isdir(temp):
+            shutil.rmtree(temp)
+        count = 0
+        try:
+            for member in archive.getmembers():
+                if member.name == metadata_name or member.isdir():
+                    continue
+                name = normpath(member.name[len(prefix):])
+                if (not member.isfile() or not member.name.startswith(prefix) or
+                        isabs(name) or name.split(os.sep)[0] == '..'):
+                    raise CacheError('%s has an unexpected file %s' % (path, member.name))
+                target = join(temp, name)
+                if not isdir(dirname(target)):
+                    os.makedirs(dirname(target))
+                with open(target, 'wb') as f:
+                    shutil.copyfileobj(archive.extractfile(member), f)
+                count += 1
+        except Exception:
+            # Don't leave half a cache next to the real one
+            if isdir(temp):
+                shutil.rmtree(temp)
+            raise
+    if isdir(site.cache_dir):
+        shutil.rmtree(site.cache_dir)
+    os.rename(temp, site.cache_dir)
+    return count, rebase(site, metadata['sources'])
+
+
+def rebase(site, packed):
+    """
+    Give pages whose source is the same as when the cache was packed their
+    current (mtime, size) in the snapshot and page store. Returns how many
+    pages were updated.
+    """
+    moved = {}
+    for path, stat in site.scan('content'):
+        entry = packed.get(path.replace(os.sep, '/'))
+        if entry is None or entry[1] != stat.st_size:
+            continue
+        if file_digest(join(site.root, 'content', path)) == entry[2]:
+            moved[path] = ((entry[0], entry[1]), (stat.st_mtime, stat.st_size))
+    rebased = set()
+    snapshot_path = join(site.cache_dir, 'snapshot.pickle')
+    if isfile(snapshot_path):
+        snapshot = Snapshot.load(snapshot_path)
+        for filepath, record in snapshot.pages.items():
+            if filepath in moved and tuple(record['stat']) == moved[filepath][0]:
+                record['stat'] = moved[filepath][1]
+                rebased.add(filepath)
+        if rebased:
+            snapshot.save()
+    store_path = join(site.cache_dir, 'pages.sqlite')
+    if isfile(store_path):
+        from .store import PageStore
+        store = PageStore(store_path)
+        for filepath, stat in store.stats().items():
+            if filepath in moved and tuple(stat) == moved[filepath][0]:
+                store.restat(filepath, *moved[filepath][1])
+                rebased.add(filepath)
+        store.commit()
+        store.close()
+    return len(rebased)
@@ -16,32 +16,37 @@ import platform
 import logging
 import os
 from os.path import abspath, basename, dirname, exists, isdir, isfile, join, normpath, relpath, splitext
-from multiprocessing import Process
+from datetime import datetime
+import fnmatch
+import hashlib
+import json
+import re
+import sys
+import threading
 import time
-import shutil
+import types
+from stat import S_ISDIR
 
 
 import click
-import jinja2
-import jinja2.meta
-import markdown
-from dateutil.parser import parse as dateparse
-from werkzeug.contrib.atom import AtomFeed
-import watchdog.observers
-import watchdog.events
 
 
-from .templates import templates
-from .livejs import livejs
+from .manifest import Manifest
+from .metrics import Metrics
+from .outputs import MemoryOutput, Output, OutputError, from_spec
+from .snapshot import Fragments, Snapshot, digest
 if platform.python_version_tuple()[0] == '2':
     import ConfigParser as configparser
     import io
-    from SimpleHTTPServer import SimpleHTTPRequestHandler
-    from SocketServer import TCPServer
 else:
     import configparser
-    from http.server import SimpleHTTPRequestHandler
-    from socketserver import TCPServer
+try:
+    from os import scandir
+except ImportError:
+    try:
+        from scandir import scandir
+    except ImportError:
+        scandir = None
 
 
 __metaclass__ = type
@@ -54,29 +59,126 @@ def ui(*args, **kwargs):
     pass
 
 
-def ls_relative(list_path):
+# Date formats we can parse without dateutil. These cover ISO-8601 dates as
+# they are normally written in page metadata; anything else falls back to
+# dateutil, which is much slower.
+date_formats = [
+    "%Y-%m-%d",
+    "%Y-%m-%dT%H:%M:%S",
+    "%Y-%m-%d %H:%M:%S",
+    "%Y-%m-%dT%H:%M",
+    "%Y-%m-%d %H:%M",
+]
+
+
+def parse_date(text):
     """
-    List files relative to the specified path
+    Parse a date string into a datetime. ISO-8601 strings are handled directly
+    and everything else is passed to dateutil. Returns None if the string
+    cannot be parsed.
+    """
+    if not text:
+        return None
+    text = text.strip()
+    for fmt in date_formats:
+        try:
+            return datetime.strptime(text, fmt)
+        except ValueError:
+            pass
+    from dateutil.parser import parse as dateparse
+    try:
+        value = dateparse(text)
+    except (ValueError, OverflowError):
+        logging.warning("Unable to parse date '%s'", text)
+        return None
+    # Convert timezone-aware dates to naive UTC so all of the dates on the site
+    # can be compared with each other.
+    if value.tzinfo is not None:
+        value = (value - value.utcoffset()).replace(tzinfo=None)
+    return value
+
+
+# Files and folders that are never part of a site. These are glob patterns
+# matched against each name, so ".git" skips the whole repository folder.
+ignore = [".git", ".hg", ".svn", ".DS_Store", "*.swp", "*~"]
+_ignore_patterns = {}
+
+
+def ignore_pattern(patterns):
+    """Compile a list of glob patterns into one regular expression"""
+    patterns = tuple(patterns)
+    if patterns not in _ignore_patterns:
+        if patterns:
+            regex = "|".join("(?:%s)" % fnmatch.translate(pattern) for pattern in patterns)
+        else:
+            regex = "(?!)"  # Never matches
+        _ignore_patterns[patterns] = re.compile(regex)
+    return _ignore_patterns[patterns]
+
+
+def scan(list_path, ignore=ignore):
+    """
+    List the files under a path as (relative path, stat) pairs, sorted by path.
+    Names matching one of the ignore patterns are skipped, and so is
+    everything in an ignored folder. We use scandir so each file costs one
+    stat call, and the stat is returned so callers don't have to stat the
+    file again. Like os.walk, symlinked folders are not followed.
     """
     found = []
     # Guard against dir doesn't exist
     if not isdir(list_path):
         return found
-    for path, dirs, files in os.walk(list_path):
-        for file in files:
-            filepath = join(path, file)
-            found.append(relpath(filepath, list_path))
+    ignored = ignore_pattern(ignore).match
+    if scandir is None:
+        for path, dirs, files in os.walk(list_path):
+            dirs[:] = [name for name in dirs if not ignored(name)]
+            for file in files:
+                if ignored(file):
+                    continue
+                filepath = join(path, file)
+                try:
+                    stat = os.stat(filepath)
+                except OSError:
+                    continue  # Broken symlink
+                found.append((relpath(filepath, list_path), stat))
+    else:
+        pending = [""]
+        while pending:
+            prefix = pending.pop()
+            for entry in scandir(join(list_path, prefix)):
+                if ignored(entry.name):
+                    continue
+                path = join(prefix, entry.name)
+                if entry.is_dir(follow_symlinks=False):
+                    pending.append(path)
+                    continue
+                try:
+                    stat = entry.stat()
+                except OSError:
+                    continue  # Broken symlink
+                if not S_ISDIR(stat.st_mode):
+                    found.append((path, stat))
     found.sort()  # Make sure the sort order is deterministic
     return found
 
 
+def ls_relative(list_path, ignore=ignore):
+    """
+    List files relative to the specified path
+    """
+    return [path for path, _ in scan(list_path, ignore)]
+
+
 class ContentCache:
-    def __init__(self, root):
+    def __init__(self, root, ignore=ignore):
         self.root = root
+        self.ignore = ignore
         self.files = {}
+        self.chars = 0  # The total length of files, kept up to date for stats
         self.pages = {}
         self.templates = {}
         self.rebuild_index = {}
+        self.stats = {}  # (mtime, size) of each file when we read it
 
     def peek(self, filename):
         """
@@ -88,13 +190,16 @@ class ContentCache:
             return content
         return None
 
-    def read(self, filename):
+    def read(self, filename, stat=None):
         """
         read when you want to get fresh data from disk and store it in the cache
         """
         content = self.peek(filename)
         if content is not None:
             self.set(filename, content)
+            if stat is None:
+                stat = os.stat(join(self.root, filename))
+            self.stats[filename] = (stat.st_mtime, stat.st_size)
         return content
 
     def set(self, filename, content):
@@ -104,7 +209,10 @@ class ContentCache:
                 self.templates[relpath(filename, 'content')] = content
         if filename.startswith('layouts'):
             self.templates[relpath(filename, 'layouts')] = content
+        if filename in self.files:
+            self.chars -= len(self.files[filename])
         self.files[filename] = content
+        self.chars += len(content)
 
     def get(self, filename):
         if filename in self.files:
@@ -112,7 +220,12 @@ class ContentCache:
         return None
 
     def delete(self, filename):
-        del(self.files[filename])
+        if filename in self.files:
+            self.chars -= len(self.files.pop(filename))
+        self.stats.pop(filename, None)
+        for folder in ['content', 'layouts']:
+            if filename.startswith(folder):
+                self.templates.pop(relpath(filename, folder), None)
 
     def move(self, old, new):
         if old not in self.files:
@@ -121,9 +234,15 @@ class ContentCache:
         self.delete(old)
 
     def warm(self):
+        """
+        Load the templates. Markdown files are not templates and are read when
+        they are rendered, so we leave them out to save memory.
+        """
         for path in ['content', 'layouts']:
-            for file in ls_relative(join(self.root, path)):
-                self.read(join(path, file))
+            for file, stat in scan(join(self.root, path), self.ignore):
+                if splitext(file)[1] in ['.md', '.markdown']:
+                    continue
+                self.read(join(path, file), stat)
 
 
 class Page:
@@ -131,10 +250,17 @@ class Page:
     A page is any discrete piece of content that will appear in your output
     folder. At minimum a page should have a body, title, and slug so it can be
     rendered. However, a page may have additional metadata like date or tags.
+
+    Large sites keep thousands of pages in memory, so pages use __slots__ and
+    only hold on to their body and HTML while they are being rendered. The body
+    is read from disk again when it is needed and dropped by release().
     """
     metadata = ["tags", "date", "title", "slug", "template"]
     required = ["date", "title"]
     metadelimiter = "++++"
+    __slots__ = ["parsed", "site", "abspath", "filepath", "folder", "slug", "ext",
+                 "url", "date", "published", "tags", "template", "title",
+                 "_body", "content", "rendered"]
 
     def __init__(self, filepath, site):
         # These are set when the page is initialized (step 1)
@@ -155,16 +281,60 @@ class Page:
         self.url = self._get_url()           # This is the URL path
 
         # These maybe set when the page is parsed for metadata (step 2)
-        self.date = None      # This is the date the page was published
-        self.tags = None      # This is a list of tags, used to build links
-        self.template = None  # This is the template we'll use to render the page
-        self.title = None     # This is the title of the page
+        self.date = None       # This is the date the page was published
+        self.published = None  # This is the date parsed into a datetime
+        self.tags = None       # This is a list of tags, used to build links
+        self.template = None   # This is the template we'll use to render the page
+        self.title = None      # This is the title of the page
 
         # These are set when the page is rendered (step 3)
-        self.body = None      # This is the raw body of the page
+        self._body = None     # This is the raw body of the page
         self.content = None   # This is the content string for markdown pages
         self.rendered = None  # This is the HTML content of the page
 
+    @property
+    def body(self):
+        if self._body is None:
+            self.load()
+        return self._body
+
+    @body.setter
+    def body(self, value):
+        self._body = value
+        self.content = None
+
+    def load(self):
+        """
+        Read the body of the page from disk without parsing the metadata again
+        """
+        if self.site.store is not None:
+            body = self.site.store.get_body(self.filepath)
+            if body is not None:
+                self.body = body
+                return
+        if isfile(self.abspath):
+            with open(self.abspath) as f:
+                self.body = self.split(f.read())[1]
+
+    def release(self):
+        """
+        Forget the body and rendered HTML so they can be garbage collected. We
+        only do this for pages we can load from disk again.
+        """
+        if isfile(self.abspath):
+            self._body = None
+            self.content = None
+            self.rendered = None
+
+    def context(self):
+        """
+        Get the variables that are available when rendering this page
+        """
+        names = [name for name in self.__slots__ if not name.startswith('_')]
+        context = dict((name, getattr(self, name)) for name in names)
+        context['body'] = self.body
+        return context
+
     def _get_folder(self):
         return dirname(self.filepath)
 
@@ -249,6 +419,7 @@ class Page:
             if value is None and key in self.required:
                 logging.warning("Metadata '%s' not specified in %s", key,
                                 self.filepath)
+        self.published = self.site.parse_date(self.date)
         self.url = self._get_url()
         self.parsed = True
 
@@ -261,34 +432,90 @@ class Page:
         """
         logging.debug("Rendering %s" % self.filepath)
         if self.ext in [".md", ".markdown"]:
-            self.content = markdown.markdown(self.body,
-                                             extensions=self.site.markdown_plugins,
-                                             extension_configs=self.site.markdown_options)
-            if self.template is not None:
-                template = self.site.renderer.get_template(self.template)
-            else:
-                template = self.site.renderer.get_template("markdown.html")
-        else:
-            template = self.site.renderer.get_template(self.filepath)
+            self.get_content()
+        template = self.site.renderer.get_template(self.get_template_name())
         # Inject livejs code (optional)
         if self.site.preview_mode:
+            from .livejs import livejs
             livejs_code = "<script>"+livejs+"</script>"
         else:
             livejs_code = ""
-        self.rendered = template.render(self.__dict__, site=self.site, livejs=livejs_code)
+        # Record the queries the page makes so we know which pages it lists
+        queries = self.site.queries[self.filepath] = []
+        self.site.recording = queries
+        try:
+            self.rendered = template.render(self.context(), site=self.site, livejs=livejs_code)
+        finally:
+            self.site.recording = None
         return self.rendered
 
+    def get_template_name(self):
+        """
+        Get the name of the template used to render this page. HTML pages are
+        templates themselves.
+        """
+        if self.ext in [".md", ".markdown"]:
+            if self.template is not None:
+                return self.template
+            return "markdown.html"
+        return self.filepath
+
+    def to_record(self):
+        """
+        Get the page metadata as a dict, which can be turned back into a page
+        with from_record()
+        """
+        record = dict((key, getattr(self, key)) for key in self.metadata)
+        record['filepath'] = self.filepath
+        return record
+
+    def get_content(self):
+        """
+        Get the HTML for the body of a markdown page. This is converted once and
+        kept so feeds and listings can use it without rendering the page
+        template. Other kinds of pages have no content.
+        """
+        if self.content is None and self.ext in [".md", ".markdown"]:
+            store = self.site.store
+            fragments = self.site.fragments
+            key = None
+            if store is not None:
+                # The store has one entry per page, so the body is already
+                # covered by the page's mtime and size
+                key = digest(self.site.markdown_key())
+                self.content = store.get_content(self.filepath, key)
+            elif fragments is not None:
+                key = digest(self.site.markdown_key() + self.body)
+                self.content = fragments.get(key)
+            if self.content is not None:
+                self.site.metrics.add('markdown_cache_hits')
+            else:
+                self.site.metrics.add('markdown_converted')
+                import markdown
+                self.content = markdown.markdown(self.body,
+                                                 extensions=self.site.markdown_plugins,
+                                                 extension_configs=self.site.markdown_options)
+                if store is not None:
+                    store.set_content(self.filepath, self.content, key)
+                elif fragments is not None:
+                    fragments.set(key, self.content)
+        return self.content
+
     def render_to_disk(self):
-        output = self.render()
-        target = join(self.site.root, 'output', self.get_target())
-        logging.debug('Writing to %s' % target)
-        ui('Generating %s' % target)
-        target_dir = dirname(target)
-        if not isdir(target_dir):
-            os.makedirs(target_dir)
-        file = open(target, mode='w')
-        file.write(output)
-        file.close()
+        self.site.write_output(self.get_target(), self.render())
+        self.site.metrics.add('pages_rendered')
+        self.release()
+
+    @classmethod
+    def split(cls, text):
+        """
+        Split a raw string into its front matter and body. The front matter is
+        None if the string doesn't have any.
+        """
+        parts = text.split(cls.metadelimiter, 1)
+        if len(parts) == 2:
+            return parts[0].strip(), parts[1].strip()
+        return None, parts[0].strip()
 
     @classmethod
     def parse_string(cls, filepath, site, text):
@@ -297,13 +524,11 @@ class Page:
         a page object with metadata and body.
         """
         page = cls(filepath, site)
-        parts = text.split(cls.metadelimiter, 1)
+        meta, page.body = cls.split(text)
 
-        if len(parts) == 2:
-            page.parse_metadata(parts[0].strip())
-            page.body = parts[1].strip()
+        if meta is not None:
+            page.parse_metadata(meta)
         else:
-            page.body = parts[0].strip()
             if page.ext in ['.md', '.markdown']:
                 logging.warning("No metadata detected; expected %s separator %s",
                                 cls.metadelimiter, page.filepath)
@@ -311,13 +536,29 @@ class Page:
             page.parsed = True
         return page
 
+    @classmethod
+    def from_record(cls, filepath, site, record):
+        """
+        Create a page from metadata we stored earlier, without reading the file
+        """
+        page = cls(filepath, site)
+        for key in cls.metadata:
+            if record.get(key) is not None:
+                setattr(page, key, record[key])
+        page.published = site.parse_date(page.date)
+        page.url = page._get_url()
+        page.parsed = True
+        return page
+
     @classmethod
     def parse_file(cls, filepath, site):
         """
-        Read a file and return the Page created by passing it into parse_string
+        Read a file and return the Page created by passing it into parse_string.
+        The body is not kept; it will be read again when the page is rendered.
         """
-        content = open(filepath).read()
-        page = cls.parse_string(filepath, site, content)
+        with open(filepath) as f:
+            page = cls.parse_string(filepath, site, f.read())
+        page.release()
         return page
 
 
@@ -340,16 +581,59 @@ class Site:
     Methods on this class deal with configuration, discovering content and
     building your site.
     """
+    # Threads that write rendered pages during a build. 0 writes each page
+    # as soon as it is rendered.
+    writer_threads = 4
 
-    def __init__(self, root, preview_mode=False):
+    def __init__(self, root, preview_mode=False, store=False, snapshot=False, output=None):
         """
         Keyword Arguments:
         root -- The path to the static site folder which includes the pages,
                 layouts, and static folders.
+        preview_mode -- Inject livejs into rendered pages.
+        store -- Keep page metadata and cached content in a SQLite file under
+                 .icecake so the site can be loaded without re-reading pages.
+        snapshot -- Load the state of the last build from .icecake so only the
+                    files that changed since then are parsed and rendered.
+        output -- Write the site somewhere other than the output folder: a
+                  folder, a spec like tar:site.tar.gz (see icecake.outputs)
+                  or an Output.
         """
+        started = time.time()
+        self.metrics = Metrics()
         self.preview_mode = preview_mode
         self.root = abspath(root)
-        self.cache = ContentCache(root)
+        if output is None:
+            output = join(self.root, 'output')
+        if not isinstance(output, Output):
+            output = from_spec(output)
+        self.output = output
+        # None unless the site is written to a folder
+        self.output_dir = output.root
+        # When this is a dict we record the digest of every file we write to
+        # output, keyed by its path relative to output
+        self.outputs = None
+        self.outputs_lock = threading.Lock()
+        # While a build renders pages, they are written by a WriterPool
+        self.writer = None
+        self.cache_dir = join(self.root, '.icecake')
+        self.store = None
+        if store:
+            from .store import PageStore
+            self.store = PageStore(join(self.cache_dir, 'pages.sqlite'))
+        self.snapshot = None
+        self.fragments = None
+        # The size and hash of every file in output, which each build saves
+        # to manifest_path
+        self.manifest = Manifest()
+        self.manifest_path = join(self.cache_dir, 'manifest.json')
+        if snapshot:
+            self.snapshot = Snapshot.load(join(self.cache_dir, 'snapshot.pickle'))
+            self.fragments = Fragments(join(self.cache_dir, 'fragments'))
+            self.manifest = Manifest(self.snapshot.outputs)
+        # Glob patterns for files that are not part of the site
+        self.ignore = list(ignore)
+        self.cache = ContentCache(root, self.ignore)
         self.cache.warm()
         self.markdown_plugins = ["markdown.extensions.fenced_code", "markdown.extensions.codehilite"]
         self.markdown_options = {
@@ -358,15 +642,49 @@ class Site:
                 "guess_lang": False,
             }
         }
+        import jinja2
         self.renderer = jinja2.Environment(loader=jinja2.DictLoader(self.cache.templates))
         self.pagedata = {}
+        self.dates = {}
+        # These track the state of the sources so we can tell what changed
+        self.depgraph = {}
+        self.page_stats = {}
+        self.static_stats = {}
+        self.changed_pages = set()
+        self.removed_pages = set()
+        # The (path, tag) of each site.pages() call a page made when it was
+        # last rendered, so we know which pages list which
+        self.queries = {}
+        self.recording = None
+        if self.snapshot is not None:
+            self.depgraph = dict(self.snapshot.templates)
+            for filepath, record in self.snapshot.pages.items():
+                if record.get('queries') is not None:
+                    self.queries[filepath] = record['queries']
         self.get_pages()
+        self.metrics.record('load', time.time() - started)
+
+    def markdown_key(self):
+        """
+        Get a string describing the markdown configuration, so cached markdown
+        is not reused after the configuration changes
+        """
+        return json.dumps([self.markdown_plugins, self.markdown_options], sort_keys=True)
+
+    def parse_date(self, text):
+        """
+        Parse a date string, memoizing the result so each distinct date on the
+        site is only parsed once.
+        """
+        if text not in self.dates:
+            self.dates[text] = parse_date(text)
+        return self.dates[text]
 
     def get_target(self, path):
         """Convert a path from static to output"""
         path = self.relpath(path)
         if path.startswith('static'):
-            return join(self.root, 'output', relpath(path, 'static'))
+            return join(self.output_dir, relpath(path, 'static'))
         raise ValueError('Invalid path %s; expected a path under static')
 
     def relpath(self, path):
@@ -382,65 +700,372 @@ class Site:
     def is_static(self, path):
         return self.relpath(path).startswith('static')
 
-    def copy_static(self, path):
+    def is_ignored(self, path):
+        """Whether a path or any folder it is in matches an ignore pattern"""
+        ignored = ignore_pattern(self.ignore).match
+        return any(ignored(name) for name in self.relpath(path).split(os.sep))
+
+    def scan(self, folder):
+        """
+        List the files in one of the site's folders as (path, stat) pairs,
+        leaving out ignored files
+        """
+        return scan(join(self.root, folder), self.ignore)
+
+    def known_digest(self, path, stat):
+        """
+        Get the SHA-1 of a static file from the last build, if the file hasn't
+        changed since, so it doesn't have to be hashed again
+        """
+        if self.snapshot is None:
+            return None
+        if self.snapshot.static.get(join('static', path)) != (stat.st_mtime, stat.st_size):
+            return None
+        entry = self.snapshot.outputs.get(path.replace(os.sep, '/'))
+        if entry is None or entry[0] != stat.st_size:
+            return None
+        return entry[1]
+
+    def copy_static(self, path, stat=None):
         source = join(self.root, 'static', path)
-        target = self.get_target(source)
-        target_dir = dirname(target)
-        if not isdir(target_dir):
-            logging.debug('Creating directory %s' % target_dir)
-            os.makedirs(target_dir, mode=0o755)
-        logging.debug('Copying static file to %s' % target)
-        shutil.copy(source, target)
+        logging.debug('Copying static file to %s' % self.output.name(path))
+        if stat is None:
+            stat = os.stat(source)
+        fingerprint = self.output.copy(path, source, self.known_digest(path, stat))
+        self.manifest.add(path, stat.st_size, fingerprint)
+        if self.outputs is not None:
+            self.record_output(path, fingerprint)
+        self.static_stats[self.relpath(source)] = (stat.st_mtime, stat.st_size)
+        self.metrics.add('static_copied')
+        self.metrics.add('static_bytes_copied', stat.st_size)
 
     def copy_all_static(self):
         logging.debug('Copying static files')
-        static_dir = join(self.root, 'static')
-        sources = ls_relative(static_dir)
-        for source in sources:
-            if isfile(join(self.root, 'static', source)):
-                self.copy_static(source)
+        for source, stat in self.scan('static'):
+            self.copy_static(source, stat)
+
+    def sync_static(self, previous=None, changed=None):
+        """
+        Copy the static files that changed since the last snapshot and remove
+        the ones that were deleted. Pass previous to compare against other
+        {path: (mtime, size)} fingerprints instead of the snapshot. Pass a list
+        as changed to collect the (path, stat) of changed files instead of
+        copying them.
+        """
+        logging.debug('Syncing static files')
+        if previous is None:
+            previous = self.snapshot.static
+        current = set()
+        for source, stat in self.scan('static'):
+            path = join('static', source)
+            current.add(path)
+            fingerprint = (stat.st_mtime, stat.st_size)
+            if previous.get(path) == fingerprint and isfile(self.get_target(path)):
+                self.static_stats[path] = fingerprint
+                self.metrics.add('static_skipped')
+                continue
+            if changed is not None:
+                changed.append((source, stat))
+            else:
+                self.copy_static(source, stat)
+        for path in previous:
+            if path not in current:
+                self.remove_static(relpath(path, 'static'))
+
+    def remove_static(self, path):
+        """
+        Remove the output of a static file that was deleted
+        """
+        self.static_stats.pop(join('static', path), None)
+        self.remove_output(path)
+
+    def move_static(self, old, new):
+        """
+        Move the output of a static file that was renamed, instead of copying
+        it again
+        """
+        self.static_stats.pop(join('static', old), None)
+        self.manifest.move(old, new)
+        old_target = join(self.output_dir, old)
+        new_target = join(self.output_dir, new)
+        if not isfile(old_target) or isdir(new_target):
+            self.remove_output(old)
+            self.copy_static(new)
+            return
+        if not isdir(dirname(new_target)):
+            os.makedirs(dirname(new_target), mode=0o755)
+        logging.debug('Moving %s to %s', old_target, new_target)
+        os.rename(old_target, new_target)
+        self.prune_output(dirname(old_target))
+        stat = os.stat(join(self.root, 'static', new))
+        self.static_stats[join('static', new)] = (stat.st_mtime, stat.st_size)
+
+    def write_output(self, path, data):
+        """
+        Write a file to output. The path is relative to the output folder.
+        """
+        target = self.output.name(path)
+        logging.debug('Writing to %s' % target)
+        ui('Generating %s' % target)
+        if self.writer is not None:
+            self.writer.write(path, data)
+        else:
+            self.write_file(path, data)
+
+    def write_file(self, path, data):
+        # This runs on the writer threads, so the page is encoded and hashed
+        # for the manifest and the shard manifest there instead of holding up
+        # rendering. We encode it once and use the bytes for everything.
+        data = data.encode('utf-8')
+        size = len(data)
+        if self.output.write(path, data):
+            self.metrics.add('files_written')
+            self.metrics.add('bytes_written', size)
+        else:
+            self.metrics.add('files_unchanged')
+        fingerprint = hashlib.sha1(data).hexdigest()
+        self.manifest.add(path, size, fingerprint)
+        if self.outputs is not None:
+            self.record_output(path, fingerprint)
+
+    def render_pages(self, pages):
+        """
+        Render pages to output. While we render, the pages that are done are
+        written by a pool of writer_threads threads.
+        """
+        if self.writer_threads < 1:
+            for page in pages:
+                page.render_to_disk()
+            return
+        from .writer import WriterPool
+        self.writer = WriterPool(self.write_file, self.writer_threads)
+        try:
+            for page in pages:
+                page.render_to_disk()
+        finally:
+            writer = self.writer
+            self.writer = None
+            writer.close()
+
+    def record_output(self, path, value):
+        with self.outputs_lock:
+            if self.outputs.get(path, value) != value:
+                logging.warning('%s was written more than once with different content', path)
+            self.outputs[path] = value
+
+    def remove_output(self, path):
+        """
+        Remove a file from output, along with any folders it leaves empty
+        """
+        self.manifest.remove(path)
+        target = join(self.output_dir, path)
+        if not isfile(target):
+            return
+        logging.debug('Removing %s', target)
+        os.remove(target)
+        self.prune_output(dirname(target))
+
+    def prune_output(self, folder):
+        """
+        Remove a folder under output if it is empty, and its parents likewise
+        """
+        while folder.startswith(self.output_dir + os.sep) and not os.listdir(folder):
+            os.rmdir(folder)
+            folder = dirname(folder)
 
     def get_pages(self):
         """
-        Enumerate and parse all the page files in the static site.
+        Enumerate and parse all the page files in the static site. If we have a
+        page store or a snapshot, pages that haven't changed since then are
+        created from what we stored instead of being read again.
         """
         logging.debug("Getting pages")
+        content_dir = join(self.root, 'content')
+        tracking = self.store is not None or self.snapshot is not None
+        stats = {}
+        records = {}
+        if self.store is not None:
+            stats = self.store.stats()
+            records = dict((record['filepath'], record) for record in self.store.records())
+        elif self.snapshot is not None:
+            for file, record in self.snapshot.pages.items():
+                stats[file] = record['stat']
+                records[file] = record
         pages = {}
-        for file in self.cache.files:
-            if not file.startswith('content'):
-                continue
-            source_file = join(self.root, file)
-            if isfile(source_file):
+        parsed = 0
+        self.page_stats = {}
+        for file, stat in self.scan('content'):
+            source_file = join(content_dir, file)
+            fingerprint = (stat.st_mtime, stat.st_size)
+            self.page_stats[file] = fingerprint
+            if not tracking:
                 logging.debug("Parsing %s", source_file)
                 page = Page.parse_file(source_file, self)
-                page.render()
                 pages[page.filepath] = page
+                parsed += 1
+                continue
+            if stats.get(file) == fingerprint:
+                page = Page.from_record(source_file, self, records[file])
+            else:
+                logging.debug("Parsing %s", source_file)
+                with open(source_file) as f:
+                    page = Page.parse_string(source_file, self, f.read())
+                parsed += 1
+                if self.store is not None:
+                    self.store.put(page, stat.st_mtime, stat.st_size, page.body)
+                page.release()
+            pages[page.filepath] = page
+        if self.store is not None:
+            for file in stats:
+                if file not in pages:
+                    self.store.delete(file)
+            self.store.commit()
+        if self.snapshot is not None:
+            previous = self.snapshot.pages
+            self.changed_pages = set(file for file, fingerprint in self.page_stats.items()
+                                     if file not in previous or previous[file]['stat'] != fingerprint)
+            self.removed_pages = set(file for file in previous if file not in pages)
+        self.metrics.set('pages_parsed', parsed)
+        self.metrics.set('pages_reused', len(pages) - parsed)
         self.pagedata = pages
         return self.pagedata
 
+    def add_page(self, page, stat=None):
+        """
+        Add a new or changed page to the site so queries will find it
+        """
+        self.pagedata[page.filepath] = page
+        if stat is None:
+            if not isfile(page.abspath):
+                return
+            stat = os.stat(page.abspath)
+        self.page_stats[page.filepath] = (stat.st_mtime, stat.st_size)
+        if self.store is not None:
+            self.store.put(page, stat.st_mtime, stat.st_size, page.body)
+            self.store.commit()
+
+    def remove_page(self, filepath):
+        """
+        Remove a page that was deleted from content, along with its output
+        """
+        page = self.pagedata.pop(filepath, None)
+        self.page_stats.pop(filepath, None)
+        self.cache.delete(join('content', filepath))
+        if self.store is not None:
+            self.store.delete(filepath)
+            self.store.commit()
+        if page is not None:
+            self.remove_output(page.get_target())
+        return page
+
+    def rescan(self, static=None):
+        """
+        Compare the files on disk against what we have loaded and bring the
+        site up to date. Changed pages and templates are read again, deleted
+        pages are removed along with their output, and static files are
+        synced. Returns the filepaths of the pages to render again. Pass a
+        list as static to collect the changed static files instead of copying
+        them; see sync_static().
+
+        This only needs a stat of each file, so the watcher can run it
+        whenever it may have missed events.
+        """
+        changed_templates = set()
+        seen = set()
+        for file, stat in self.scan('layouts'):
+            name = join('layouts', file)
+            seen.add(name)
+            if self.cache.stats.get(name) != (stat.st_mtime, stat.st_size):
+                source = self.cache.get(name)
+                if self.cache.read(name, stat) != source:
+                    changed_templates.add(file)
+        for name in list(self.cache.stats):
+            if name.startswith('layouts') and name not in seen:
+                self.cache.delete(name)
+                changed_templates.add(relpath(name, 'layouts'))
+
+        changed_pages = set()
+        seen = set()
+        content_dir = join(self.root, 'content')
+        for file, stat in self.scan('content'):
+            seen.add(file)
+            if self.page_stats.get(file) == (stat.st_mtime, stat.st_size):
+                continue
+            logging.debug("Parsing %s", join(content_dir, file))
+            if splitext(file)[1] not in ['.md', '.markdown']:
+                # HTML pages are templates too, and other pages may include them
+                self.cache.read(join('content', file), stat)
+                changed_templates.add(file)
+            self.add_page(Page.parse_file(join(content_dir, file), self), stat)
+            changed_pages.add(file)
+        removed = [file for file in self.pagedata if file not in seen]
+        for file in removed:
+            self.remove_page(file)
+            changed_templates.add(file)
+
+        self.sync_static(dict(self.static_stats), static)
+        if self.store is not None:
+            self.store.commit()
+        pages = self.affected_pages(changed_pages, changed_templates,
+                                    bool(changed_pages or removed))
+        return [page.filepath for page in pages]
+
+    def template_info(self, name):
+        """
+        Get the templates referenced by a template, and whether it uses the
+        site helpers. Templates are only parsed again when their source
+        changes.
+        """
+        source = self.cache.templates.get(name)
+        if source is None:
+            return set(), False
+        key = digest(source)
+        info = self.depgraph.get(name)
+        if info is None or info[0] != key:
+            import jinja2.meta
+            ast = self.renderer.parse(source)
+            referenced = set(jinja2.meta.find_referenced_templates(ast))
+            referenced.discard(None)  # Dynamic includes can't be resolved
+            uses_site = 'site' in jinja2.meta.find_undeclared_variables(ast)
+            info = (key, referenced, uses_site)
+            self.depgraph[name] = info
+        return info[1], info[2]
+
+    def template_closure(self, name):
+        """
+        Get the set of templates needed to render a template, including itself
+        """
+        closure = set()
+        pending = [name]
+        while pending:
+            current = pending.pop()
+            if current in closure:
+                continue
+            closure.add(current)
+            pending.extend(self.template_info(current)[0])
+        return closure
+
+    def uses_site(self, closure):
+        """
+        Whether any of the templates in a closure query the site, which means
+        the page has to be rendered again when other pages change
+        """
+        return any(self.template_info(name)[1] for name in closure)
+
     def list_dependents(self, filepath):
+        """
+        List the pages that have to be rendered again when a template changes
+        """
         depset = set()
-        # If the page is markdown.html then we need to add all of the markdown
-        # pages.
-        # TODO add support for markdown pages that specify a custom template
-        if filepath == 'markdown.html':
-            for _, page in self.pagedata.items():
-                if page.ext in ['.md', '.markdown']:
-                    depset.add(page.filepath)
-        else:
-            for path, body in self.cache.templates.items():
-                ast = self.renderer.parse(body)
-                pagedeps = jinja2.meta.find_referenced_templates(ast)
-                if filepath in pagedeps:
-                    for item in self.list_dependents(path):
-                        depset.add(item)
-            for _, page in self.pagedata.items():
-                ast = self.renderer.parse(page.body)
-                pagedeps = jinja2.meta.find_referenced_templates(ast)
-                if filepath in list(pagedeps):
-                    depset.add(page.filepath)
-                    for item in self.list_dependents(page.filepath):
-                        depset.add(item)
+        closures = {}
+        for _, page in self.pagedata.items():
+            if page.filepath == filepath:
+                continue
+            name = page.get_template_name()
+            if name not in closures:
+                closures[name] = self.template_closure(name)
+            if filepath in closures[name]:
+                depset.add(page.filepath)
         deplist = list(depset)
         deplist.sort()
         return deplist
@@ -449,19 +1074,237 @@ class Site:
         for item in self.list_dependents(filepath):
             self.pagedata[item].render_to_disk()
 
-    def build(self):
+    def stale_pages(self):
+        """
+        List the pages that have to be rendered again since the snapshot was
+        taken. A page is stale if its source changed, if any of its templates
+        changed, if it queries the site and any page was added, changed or
+        removed, or if its output is missing.
+        """
+        snapshot = self.snapshot
+        pages = [page for _, page in sorted(self.pagedata.items())]
+        if snapshot.preview_mode != self.preview_mode:
+            return pages
+        changed_templates = set()
+        for name in set(self.cache.templates) | set(snapshot.templates):
+            previous = snapshot.templates.get(name)
+            source = self.cache.templates.get(name)
+            if previous is None or source is None or previous[0] != digest(source):
+                changed_templates.add(name)
+        return self.affected_pages(self.changed_pages, changed_templates,
+                                   bool(self.changed_pages or self.removed_pages),
+                                   check_output=True)
+
+    def affected_pages(self, changed_pages, changed_templates, pages_changed, check_output=False):
+        """
+        List the pages that have to be rendered again: the changed pages, the
+        pages that use a changed template, and the pages that query the site
+        if pages_changed is true. With check_output pages whose output is
+        missing are included as well.
+        """
+        changed_templates = set(changed_templates)
+        closures = {}
+        affected = []
+        for _, page in sorted(self.pagedata.items()):
+            name = page.get_template_name()
+            if name not in closures:
+                closures[name] = self.template_closure(name)
+            closure = closures[name]
+            if (page.filepath in changed_pages or
+                    closure & changed_templates or
+                    (pages_changed and self.uses_site(closure)) or
+                    (check_output and
+                     not isfile(join(self.output_dir, page.get_target())))):
+                affected.append(page)
+        return affected
+
+    def remove_deleted_outputs(self):
+        """
+        Remove the output of pages that were deleted since the snapshot
+        """
+        for filepath in self.removed_pages:
+            self.remove_output(self.snapshot.pages[filepath]['target'])
+
+    def save_snapshot(self, exclude=()):
+        """
+        Record the current state of the site so the next run can skip anything
+        that hasn't changed. Pages in exclude are left out, so they will be
+        rendered by the next run.
+        """
+        exclude = set(exclude)
+        pages = {}
+        for filepath, page in self.pagedata.items():
+            if filepath not in self.page_stats or filepath in exclude:
+                continue
+            record = page.to_record()
+            record['stat'] = self.page_stats[filepath]
+            record['target'] = page.get_target()
+            record['queries'] = self.queries.get(filepath)
+            pages[filepath] = record
+        for name in self.cache.templates:
+            self.template_info(name)
+        self.snapshot.pages = pages
+        self.snapshot.templates = dict((name, self.depgraph[name])
+                                       for name in self.cache.templates)
+        self.snapshot.static = dict(self.static_stats)
+        self.snapshot.outputs = dict(self.manifest.files)
+        self.snapshot.preview_mode = self.preview_mode
+        self.snapshot.save()
+        self.changed_pages = set()
+        self.removed_pages = set()
+
+    def select(self, paths):
+        """
+        Find the sources under a list of paths, which can be files or folders
+        under content, layouts or static. Returns the filepaths of the pages,
+        the names of the templates, and the paths of the static files.
+        """
+        pages = set()
+        templates = set()
+        static = set()
+        for path in paths:
+            path = normpath(self.relpath(path))
+            folder = path.split(os.sep)[0]
+            if folder not in ['content', 'layouts', 'static']:
+                raise ValueError('Invalid path %s; expected a path under content, layouts or static' % path)
+            prefix = relpath(path, folder)
+            if prefix == '.':
+                prefix = ''
+
+            def selected(name):
+                return not prefix or name == prefix or name.startswith(prefix + os.sep)
+            if folder == 'content':
+                for filepath, page in self.pagedata.items():
+                    if selected(filepath):
+                        pages.add(filepath)
+                        if filepath in self.cache.templates:
+                            templates.add(filepath)
+            elif folder == 'layouts':
+                for name in self.cache.files:
+                    if self.is_layout(name) and selected(relpath(name, 'layouts')):
+                        templates.add(relpath(name, 'layouts'))
+            else:
+                for source, _ in self.scan('static'):
+                    if selected(source):
+                        static.add(source)
+        return pages, templates, static
+
+    def collection_pages(self, pages):
+        """
+        List the pages whose site.pages() queries match any of the given
+        pages. Pages that use the site but haven't recorded their queries are
+        always included.
+        """
+        collections = []
+        for filepath, page in sorted(self.pagedata.items()):
+            queries = self.queries.get(filepath)
+            if not queries:
+                if self.uses_site(self.template_closure(page.get_template_name())):
+                    collections.append(page)
+                continue
+            for path, tag in queries:
+                if any((path is None or other.filepath.startswith(path)) and
+                       (tag is None or (other.tags and tag in other.tags))
+                       for other in pages):
+                    collections.append(page)
+                    break
+        return collections
+
+    def build_only(self, paths):
+        """
+        Build the sources under the given paths, plus the pages that depend
+        on them: pages that use a selected template, and pages that list a
+        selected page. Nothing else in output is touched.
+        """
+        filepaths, templates, static = self.select(paths)
+        render = set(page.filepath for page in self.affected_pages(filepaths, templates, False))
+        selected = [self.pagedata[filepath] for filepath in filepaths]
+        render.update(page.filepath for page in self.collection_pages(selected))
+        self.render_pages(self.pagedata[filepath] for filepath in sorted(render))
+        for source in sorted(static):
+            self.copy_static(source)
+        if self.store is not None:
+            self.store.commit()
+        return sorted(render)
+
+    def build(self, incremental=False, only=None, shard=None):
         """
         Build the site. This method originates all of the calls to discover,
         render, and place pages in the output directory. If you want to
         customize how your site is built, this is a good place to start.
+
+        An incremental build uses the snapshot from the last build to render
+        only the pages that are out of date. Everything else in the output
+        directory is left alone.
+
+        Pass a list of paths as only to build just those sources and the pages
+        that depend on them; see build_only(). The snapshot is not updated,
+        since the rest of the site may still be out of date.
+
+        Pass shard=(index, count) to build one part of the site for a sharded
+        build; see icecake.shards.
+
+        Everything is written through self.output, which is opened before the
+        build and closed after it, so archives are only finished when the
+        whole site is in them. Afterwards the manifest of the output is saved
+        to manifest_path, except for shards; see icecake.manifest.
         """
-        self.clean_output()
-        self.pagedata = self.get_pages()
-        for _, page in self.pagedata.items():
-            page.render_to_disk()
-        self.copy_all_static()
+        if (only or incremental and self.snapshot is not None) and not self.output.incremental:
+            raise ValueError('Incremental builds and --only need to write to a folder, not %s' %
+                             self.output.name(''))
+        started = time.time()
+        rendered = self.metrics.values['pages_rendered']
+        self.output.open()
+        try:
+            result = self._build(incremental, only, shard)
+        except BaseException:
+            self.output.abort()
+            raise
+        self.output.close()
+        # A shard only wrote part of the site; icecake merge writes the
+        # manifest for all of it
+        if shard is None:
+            self.manifest.save(self.manifest_path)
+        rendered = self.metrics.values['pages_rendered'] - rendered
+        self.metrics.set('pages', len(self.pagedata))
+        self.metrics.set('pages_skipped', len(self.pagedata) - rendered)
+        self.metrics.record('build', time.time() - started)
+        return result
+
+    def _build(self, incremental, only, shard):
+        if only:
+            return self.build_only(only)
+        if shard is not None:
+            from . import shards
+            return shards.build(self, *shard)
+        if incremental and self.snapshot is not None:
+            self.remove_deleted_outputs()
+            with self.metrics.phase('render'):
+                self.render_pages(self.stale_pages())
+            with self.metrics.phase('static'):
+                self.sync_static()
+        else:
+            self.clean_output()
+            with self.metrics.phase('load'):
+                self.pagedata = self.get_pages()
+            with self.metrics.phase('render'):
+                self.render_pages(self.pagedata.values())
+            with self.metrics.phase('static'):
+                self.copy_all_static()
+        if self.store is not None:
+            self.store.commit()
+        # The snapshot describes what is in the output folder, which the
+        # other backends can't be read back from
+        if self.snapshot is not None and self.output.incremental:
+            with self.metrics.phase('snapshot'):
+                self.save_snapshot()
+        return None
 
     def tags(self):
+        if self.recording is not None:
+            self.recording.append((None, None))
+        if self.store is not None:
+            return self.store.tags()
         tagnames = set()
         for path, page in self.pagedata.items():
             if page.tags:
@@ -479,52 +1322,72 @@ class Site:
         finder.pages(path="articles", limit=5, order="-date")
         finder.pages(tag="family", order="title")
         """
-        items = self.pagedata.values()
+        if self.recording is not None:
+            self.recording.append((path, tag))
+        if self.store is not None and (order is None or order.lstrip("-") in self.store.columns):
+            return [self.pagedata[filepath] for filepath in
+                    self.store.query(path=path, tag=tag, limit=limit, order=order)
+                    if filepath in self.pagedata]
+        items = list(self.pagedata.values())
         for page in items:
             logging.debug(page.filepath)
         if path is not None:
             items = [page for page in items if page.filepath.startswith(path)]
         if tag is not None:
-            items = [page for page in items if tag in page.tags]
+            items = [page for page in items if page.tags and tag in page.tags]
         if order is not None:
             rev = False
             if order[0] == "-":
                 rev = True
                 order = order[1:]
-            items.sort(key=lambda x: getattr(x, order), reverse=rev)
+            # Dates are sorted by their parsed value rather than the string
+            # the user wrote, so "2016-4-2" and "2016-04-10" sort correctly.
+            if order == "date":
+                order = "published"
+            # Pages without a value sort before the rest, like NULL does in
+            # the page store, so "-date" puts undated pages last.
+            items.sort(key=lambda x: (getattr(x, order) is not None, getattr(x, order)), reverse=rev)
         if limit is not None and limit > 0:
             items = items[:limit]
         return items
 
-    def atom(self, feed_title, feed_url, feed_subtitle, site_url, author, *args, **kwargs):
+    def feed(self, kind, feed_title, feed_url, feed_subtitle, site_url, author, *args, **kwargs):
+        """
+        Build a feed for the pages matching a query. Any arguments after author
+        are passed to pages(), so you can limit the number of entries or build
+        a feed for a single path or tag.
+        """
+        from .feeds import Feed
         items = self.pages(*args, **kwargs)
-
-        atom = AtomFeed(title=feed_title,
-                        subtitle=feed_subtitle,
-                        feed_url=feed_url,
-                        url=site_url)
+        feed = Feed(kind, title=feed_title, feed_url=feed_url, site_url=site_url,
+                    subtitle=feed_subtitle, author=author)
+        output = feed.to_string(items)
+        # Don't hold on to the content of every page in the feed
         for item in items:
-            item.render()
-            atom.add(title=item.title,
-                     content=item.content,
-                     content_type='html',
-                     author=author,
-                     url=site_url+item.url,
-                     published=dateparse(item.date),
-                     updated=dateparse(item.date),
-                     xml_base=None)
-        return atom.to_string()
+            item.release()
+        return output
+
+    def atom(self, feed_title, feed_url, feed_subtitle, site_url, author, *args, **kwargs):
+        return self.feed("atom", feed_title, feed_url, feed_subtitle, site_url, author,
+                         *args, **kwargs)
+
+    def rss(self, feed_title, feed_url, feed_subtitle, site_url, author, *args, **kwargs):
+        return self.feed("rss", feed_title, feed_url, feed_subtitle, site_url, author,
+                         *args, **kwargs)
 
     def clean_output(self):
         """
         Delete everything in the output folder so we can perform a clean build
         """
-        output_dir = join(self.root, 'output')
-        if isdir(output_dir):
-            shutil.rmtree(output_dir)
+        self.output.clean(self.root)
+        self.manifest.clear()
 
     @classmethod
-    def initialize(cls, root):
+    def scaffold(cls, root):
+        """
+        Write the starter site into root without loading it
+        """
+        from .templates import templates
         if not isdir(root):
             os.makedirs(root)
         for path, contents in templates.items():
@@ -537,130 +1400,63 @@ class Site:
                 logging.debug("Writing %s" % target)
                 f.write(contents)
                 f.close()
-        return Site(root)
 
+    @classmethod
+    def initialize(cls, root):
+        cls.scaffold(root)
+        return Site(root)
 
-class Handler(watchdog.events.FileSystemEventHandler):
-    site = None
 
-    def is_watched(self, event):
-        """
-        Whether we are watching this path at all. This guards against
-        triggering logic on the output folder or other folders the user may
-        have created here.
-        """
-        return self.site.is_content(event) or self.site.is_layout(event) or self.site.is_static(event)
+# The watcher and the preview server used to live in this module. They are
+# still available from here, but are only imported when they are used, so
+# commands that don't need them don't load watchdog or http.server. New code
+# should import them from icecake.watcher and icecake.server.
+moved = {
+    'Handler': 'watcher',
+    'Watcher': 'watcher',
+    'HTTPHandler': 'server',
+    'HTTPServer': 'server',
+    'Server': 'server',
+}
 
-    def on_created(self, event):
-        if isfile(event.src_path):
-            if self.site.is_content(event):
-                data = self.site.cache.read(event.src_path)
-                page = Page.parse_string(event.src_path, self.site, data)
-                page.render_to_disk()
-            elif self.site.is_static(event):
-                self.site.copy_static(event.src_path)
-
-    def on_deleted(self, event):
-        if self.is_watched(event.src_path):
-            logging.debug('Deletion detected for %s', event.src_path)
-            shutil.rmtree(event.src_path)
-
-    def on_modified(self, event):
-        if isfile(event.src_path) and self.is_watched(event):
-            path = self.site.relpath(event.src_path)
-            logging.debug('Change detected for %s', event.src_path)
-            if self.site.is_content(event):
-                if self.site.cache.get(path) != self.site.cache.read(path):
-                    data = self.site.cache.get(path)
-                    page = Page.parse_string(path, self.site, data)
-                    page.render_to_disk()
-                    self.site.render_dependents(relpath(self.site.relpath(event.src_path), 'content'))
-            elif self.site.is_static(event):
-                self.site.copy_static(event.src_path)
-            elif self.site.is_layout(event):
-                if self.site.cache.get(path) != self.site.cache.read(path):
-                    self.site.render_dependents(relpath(self.site.relpath(event.src_path), 'layouts'))
-
-    def on_moved(self, event):
-        if isfile(event.dest_path) and self.is_watched(event):
-            self.on_deleted(event)
-            # This is a hack and probably has some bad consequence I'm not
-            # thinking about right now.
-            event.src_path = event.dest_path
-            self.on_created(event)
-
-
-class Watcher:
-    def __init__(self, site):
-        self.site = site
-        Handler.site = site
-
-    def watch(self):
-        obs = watchdog.observers.Observer()
-        obs.schedule(Handler(), join(self.site.root), recursive=True)
-        logging.debug('Watching for changes in %s' % self.site.root)
-        ui('Watching for changes in %s' % self.site.root)
-        obs.start()
-        try:
-            while True:
-                time.sleep(1)
-        except KeyboardInterrupt:
-            obs.stop()
-        obs.join()
 
+class CompatModule(types.ModuleType):
+    """
+    This module, with the names in moved imported when they are first used
+    """
 
-class HTTPHandler(SimpleHTTPRequestHandler):
-    site = None
+    def __getattr__(self, name):
+        if name not in moved:
+            raise AttributeError("module %r has no attribute %r" % (__name__, name))
+        import importlib
+        return getattr(importlib.import_module('.' + moved[name], __package__), name)
 
-    def translate_path(self, path):
-        if platform.python_version_tuple()[0] == '2':
-            path = SimpleHTTPRequestHandler.translate_path(self, path)
-        else:
-            path = super().translate_path(path)
-        # Since we are serving from the project root instead of content root
-        # we want to insert 'content' into the filepath.
-        path = abspath(join('output', relpath(path)))
-        return path
-
-    def log_request(self, code='-', size='-'):
-        # Don't log HEAD requests because these are very spammy with livejs turned on
-        if self.command == 'HEAD':
-            return
-        if platform.python_version_tuple()[0] == '2':
-            SimpleHTTPRequestHandler.log_request(self, code, size)
-        else:
-            super().log_request(code, size)
 
+if platform.python_version_tuple()[0] == '2':
+    class Python2Module(CompatModule):
+        """
+        Python 2 can't change the class of a module, so this stands in for it
+        in sys.modules and passes everything through to it
+        """
 
-class HTTPServer(TCPServer):
-    def server_activate(self):
-        ui('Server started successfully')
-        logging.debug('Listening on http://%s:%s/' % self.server_address)
-        if platform.python_version_tuple()[0] == '2':
-            TCPServer.server_activate(self)
-        else:
-            super().server_activate()
+        def __init__(self, module):
+            CompatModule.__init__(self, module.__name__, module.__doc__)
+            object.__setattr__(self, 'wrapped', module)
 
+        def __getattr__(self, name):
+            if name in self.wrapped.__dict__:
+                return self.wrapped.__dict__[name]
+            return CompatModule.__getattr__(self, name)
 
-class Server:
-    def __init__(self, site):
-        self.site = site
+        def __setattr__(self, name, value):
+            setattr(self.wrapped, name, value)
 
-    def serve(self, address, port):
-        HTTPHandler.site = self.site
-        ui('Starting server on http://%s:%s/' % (address, port))
-        ui('HEAD requests are omitted from the logs')
-        while True:
-            try:
+        def __delattr__(self, name):
+            delattr(self.wrapped, name)
 
-                httpd = HTTPServer((address, port), HTTPHandler)
-                httpd.serve_forever()
-            except OSError:
-                ui('ERROR: Listen socket is busy; will retry in 5 seconds')
-                time.sleep(5)
-            except KeyboardInterrupt:
-                httpd.shutdown()
-                break
+    sys.modules[__name__] = Python2Module(sys.modules[__name__])
+else:
+    sys.modules[__name__].__class__ = CompatModule
 
 
 @click.group()
@@ -682,58 +1478,280 @@ def init(debug, f, path):
     if len(ls_relative(path)) > 0 and not f:
         click.echo("Path \"%s\" already contains files; use -f to force initialization" % path)
         exit(1)
-    Site.initialize(path)
+    Site.scaffold(path)
 
 
 @cli.command()
 @click.option("--debug/--no-debug", default=False)
-def build(debug):
+@click.option("--store/--no-store", default=False, help="Keep page metadata in .icecake/pages.sqlite")
+@click.option("--incremental/--no-incremental", default=False,
+              help="Only render what changed since the last build")
+@click.option("--only", multiple=True, type=click.Path(),
+              help="Only build this file or folder and the pages that depend on it. May be repeated.")
+@click.option("--shard", default=None, metavar="INDEX/COUNT",
+              help="Build one part of the site, like 1/4. Combine the parts with icecake merge.")
+@click.option("--output", default=None, metavar="[dir:|tar:|zip:|cas:]PATH",
+              help="Write the site to this folder, or to a tarball, zip file or content-addressed store")
+@click.option("--manifest", default=join(".icecake", "manifest.json"), type=click.Path(),
+              help="Where to write the manifest of the output (path, size, SHA-1 and content type)")
+@click.option("--writers", default=Site.writer_threads, metavar="N",
+              help="Threads that write pages while the next ones render. 0 writes them in turn.")
+@click.option("--profile/--no-profile", default=False,
+              help="Time each phase of the build per page and print the slowest pages and templates")
+@click.option("--profile-top", default=10, metavar="N",
+              help="How many pages, templates or allocation sites to list in the profile")
+@click.option("--profile-json", default=join(".icecake", "profile.json"), type=click.Path(),
+              help="Where to write the profile as JSON")
+@click.option("--cprofile", default=None, type=click.Path(), help="Save cProfile stats for the build to this file")
+@click.option("--memprofile/--no-memprofile", default=False,
+              help="Trace memory use through each phase of the build")
+@click.option("--memprofile-json", default=join(".icecake", "memprofile.json"), type=click.Path(),
+              help="Where to write the memory profile as JSON")
+@click.option("--metrics-json", default=None, type=click.Path(), help="Write build metrics to this file as JSON")
+@click.option("--metrics-prom", default=None, type=click.Path(),
+              help="Write build metrics to this file for the Prometheus textfile collector")
+def build(debug, store, incremental, only, shard, output, manifest, writers, profile, profile_top, profile_json,
+          cprofile, memprofile, memprofile_json, metrics_json, metrics_prom):
+    if debug:
+        logging.getLogger().setLevel(logging.DEBUG)
+    if shard is not None:
+        from .shards import parse_shard
+        try:
+            shard = parse_shard(shard)
+        except ValueError as e:
+            raise click.BadParameter(str(e), param_hint="--shard")
+    profiler = None
+    if profile:
+        from .profiling import Profiler
+        profiler = Profiler()
+        profiler.install(Site, Page)
+    memprofiler = None
+    if memprofile:
+        if platform.python_version_tuple()[0] == '2':
+            raise click.UsageError("--memprofile needs Python 3")
+        from .profiling import MemoryProfiler
+        memprofiler = MemoryProfiler(profile_top)
+        memprofiler.install(Metrics, Page)
+    stats = None
+    if cprofile is not None:
+        import cProfile
+        stats = cProfile.Profile()
+        stats.enable()
+    site = None
+    try:
+        # Shards don't save a snapshot, since they only render part of the site
+        if output is not None:
+            try:
+                output = from_spec(output)
+            except ValueError as e:
+                raise click.BadParameter(str(e), param_hint="--output")
+            if isinstance(output, MemoryOutput):
+                raise click.BadParameter("memory: can only be used from Python", param_hint="--output")
+        site = Site(curdir, store=store, snapshot=shard is None, output=output)
+        site.writer_threads = writers
+        site.manifest_path = manifest
+        only = [abspath(path) for path in only]
+        try:
+            site.select(only)
+        except ValueError as e:
+            raise click.BadParameter(str(e), param_hint="--only")
+        if (only or incremental) and not site.output.incremental:
+            raise click.UsageError("--incremental and --only need --output to be a folder")
+        try:
+            site.build(incremental=incremental, only=only, shard=shard)
+        except OutputError as e:
+            raise click.ClickException(str(e))
+    finally:
+        if stats is not None:
+            stats.disable()
+            stats.dump_stats(cprofile)
+        if profiler is not None:
+            profiler.uninstall()
+        if memprofiler is not None:
+            memprofiler.uninstall(site)
+    if profiler is not None:
+        click.echo(profiler.format(profile_top))
+        profiler.write_json(profile_json, profile_top)
+        click.echo("Wrote profile to %s" % profile_json)
+    if stats is not None:
+        click.echo("Wrote cProfile stats to %s" % cprofile)
+    if memprofiler is not None:
+        click.echo(memprofiler.format())
+        memprofiler.write_json(memprofile_json)
+        click.echo("Wrote memory profile to %s" % memprofile_json)
+    if metrics_json is not None:
+        site.metrics.write_json(metrics_json)
+    if metrics_prom is not None:
+        site.metrics.write_prometheus(metrics_prom)
+
+
+@cli.command(help="""
+    Combine the output folders of a sharded build (icecake build --shard) into
+    one output folder. Fails without writing anything if a shard is missing or
+    if two shards wrote different files to the same path.
+    """)
+@click.option("--debug/--no-debug", default=False)
+@click.option("--output", default="output", type=click.Path(), help="The folder to write the site to")
+@click.option("--manifest", default=join(".icecake", "manifest.json"), type=click.Path(),
+              help="Where to write the manifest of the merged output")
+@click.argument("shards", nargs=-1, required=True, type=click.Path(exists=True, file_okay=False))
+def merge(debug, output, manifest, shards):
     if debug:
         logging.getLogger().setLevel(logging.DEBUG)
-    Site(curdir).build()
+    from . import shards as sharding
+    try:
+        files = sharding.merge(shards, output, curdir, manifest)
+    except sharding.MergeError as e:
+        raise click.ClickException(str(e))
+    click.echo('Merged %d files from %d shards into %s' % (len(files), len(shards), output))
+
+
+@cli.command(help="""
+    Explain how a page is built: the templates and site.pages() queries it
+    uses, how long each part takes to render, and which changes make it render
+    again. PAGE can be a source file, an output file or a URL.
+    """)
+@click.option("--debug/--no-debug", default=False)
+@click.option("--json", "as_json", is_flag=True, default=False, help="Print the explanation as JSON")
+@click.argument("page")
+def explain(debug, as_json, page):
+    if debug:
+        logging.getLogger().setLevel(logging.DEBUG)
+    from . import explain as explaining
+    site = Site(curdir)
+    found = explaining.find_page(site, page)
+    if found is None:
+        raise click.BadParameter("No page builds %s" % page, param_hint="PAGE")
+    report = explaining.explain(site, found)
+    if as_json:
+        click.echo(json.dumps(report, indent=2, sort_keys=True))
+    else:
+        click.echo(explaining.format(report))
+
+
+@cli.command("diff-manifest", help="""
+    Compare the output manifests of two builds (.icecake/manifest.json, or
+    build --manifest) and list the files that were added (A), changed (M) and
+    deleted (D), so only those have to be uploaded.
+    """)
+@click.option("--json", "as_json", is_flag=True, default=False,
+              help="Print the added and changed files with their entries, and the deleted paths, as JSON")
+@click.argument("old", type=click.Path(exists=True, dir_okay=False))
+@click.argument("new", type=click.Path(exists=True, dir_okay=False))
+def diff_manifest(as_json, old, new):
+    from . import manifest
+    try:
+        old_files = manifest.load(old)
+        new_files = manifest.load(new)
+    except ValueError as e:
+        raise click.ClickException(str(e))
+    added, changed, deleted = manifest.diff(old_files, new_files)
+    if as_json:
+        click.echo(json.dumps({
+            'added': dict((path, new_files[path]) for path in added),
+            'changed': dict((path, new_files[path]) for path in changed),
+            'deleted': deleted,
+        }, indent=2, sort_keys=True))
+        return
+    for status, paths in [('A', added), ('M', changed), ('D', deleted)]:
+        for path in paths:
+            click.echo('%s %s' % (status, path))
+
+
+@cli.group(help="""
+    Pack and restore the build cache in .icecake, so a CI runner that starts
+    from a fresh checkout can restore a recent cache and build incrementally.
+    """)
+def cache():
+    pass
+
+
+@cache.command("export", help="Pack .icecake into a .tar.gz at PATH")
+@click.argument("path", type=click.Path(dir_okay=False))
+def cache_export(path):
+    from . import buildcache
+    site = Site(curdir, snapshot=True)
+    try:
+        count = buildcache.export(site, path)
+    except buildcache.CacheError as e:
+        raise click.ClickException(str(e))
+    click.echo("Packed %d files into %s" % (count, path))
+
+
+@cache.command("import", help="""
+    Restore .icecake from an archive made by icecake cache export. A cache
+    made by another version of icecake or Python, or with other Markdown
+    settings, is not restored; the next build is a full build instead. Only
+    import caches you trust: their HTML goes into your pages as it is.
+    """)
+@click.argument("path", type=click.Path(exists=True, dir_okay=False))
+def cache_import(path):
+    from . import buildcache
+    site = Site(curdir)
+    try:
+        count, rebased = buildcache.restore(site, path)
+    except buildcache.StaleCache as e:
+        click.echo("Not restoring %s: %s" % (path, e))
+        return
+    except buildcache.CacheError as e:
+        raise click.ClickException(str(e))
+    click.echo("Restored %d files from %s; %d unchanged pages will not be parsed again" % (count, path, rebased))
 
 
 @cli.command()
 @click.option("--debug/--no-debug", default=False)
 @click.option("--address", '-a', default="127.0.0.1", type=str)
 @click.option("--port", '-p', default=8000, type=int)
-def preview(debug, address, port):
+@click.option("--store/--no-store", default=False, help="Keep page metadata in .icecake/pages.sqlite")
+def preview(debug, address, port, store):
     if debug:
         logging.getLogger().setLevel(logging.DEBUG)
+    from .preview import Preview
+    from .server import Server
+    from .watcher import Watcher
 
-    site = Site(curdir, preview_mode=True)
-    site.build()
-
-    watcher = Watcher(site)
-    watcher_pid = Process(target=watcher.watch)
-    watcher_pid.daemon = False
-    watcher_pid.start()
+    # Pages are rendered when they are requested, and the rest of the site is
+    # filled in by a background thread. The watcher queues changed pages on
+    # the same thread, ahead of the pages nobody is looking at.
+    site = Site(curdir, preview_mode=True, store=store, snapshot=True)
+    preview = Preview(site)
+    preview.start()
 
-    server = Server(site)
-    server_pid = Process(target=server.serve, args=(address, port))
-    server_pid.daemon = False
-    server_pid.start()
+    watcher = Watcher(site, preview=preview)
+    watcher.start()
 
     click.echo('Use Ctrl-C to quit')
+    Server(site.output_dir, preview=preview).serve(address, port)
 
-    watcher_pid.join()
-    server_pid.join()
+    watcher.stop()
+    preview.stop()
+    preview.save_snapshot()
 
 
 @cli.command()
 @click.option("--debug/--no-debug", default=False)
-def watch(debug):
+@click.option("--store/--no-store", default=False, help="Keep page metadata in .icecake/pages.sqlite")
+def watch(debug, store):
     if debug:
         logging.getLogger().setLevel(logging.DEBUG)
-    Watcher(Site(curdir, preview_mode=True)).watch()
+    from .watcher import Watcher
+    Watcher(Site(curdir, preview_mode=True, store=store, snapshot=True)).watch()
 
 
-@cli.command()
+@cli.command(help="""
+    Serve the output folder. The site is not built unless you pass --build.
+    """)
 @click.option("--debug/--no-debug", default=False)
-def serve(debug):
+@click.option("--address", '-a', default="127.0.0.1", type=str)
+@click.option("--port", '-p', default=8000, type=int)
+@click.option("--build/--no-build", default=False, help="Build the site before serving it")
+def serve(debug, address, port, build):
     if debug:
         logging.getLogger().setLevel(logging.DEBUG)
-    Server(Site(curdir, preview_mode=True)).serve("127.0.0.1", 8000)
+    from .server import Server
+    if build:
+        Site(curdir, snapshot=True).build(incremental=True)
+    Server(join(curdir, 'output')).serve(address, port)
 
 
 if __name__ == "__main__":
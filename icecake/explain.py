@@ -0,0 +1,181 @@
+# -*- coding: utf8 -*-
+"""
+Explain why a page costs what it does: what it is built from, what it asks
+the site for, how long each part takes to render, and which changes make it
+render again.
+"""
+from __future__ import absolute_import, division, print_function, unicode_literals
+import os
+from os.path import abspath, join, normpath, relpath
+import re
+
+
+from .profiling import Profiler, wall_clock
+
+
+__metaclass__ = type
+
+# Fenced code blocks, which are highlighted with Pygments
+code_block = re.compile(r'^(```|~~~).*?^\1', re.MULTILINE | re.DOTALL)
+
+
+def find_page(site, path):
+    """
+    Find the page for a source path, an output path or a URL. Returns None
+    if no page matches.
+    """
+    source = normpath(site.relpath(abspath(path)))
+    if source.split(os.sep)[0] == 'content' and relpath(source, 'content') in site.pagedata:
+        return site.pagedata[relpath(source, 'content')]
+    if normpath(path) in site.pagedata:
+        return site.pagedata[normpath(path)]
+    output = normpath(relpath(abspath(path), site.output_dir))
+    for page in site.pagedata.values():
+        target = normpath(page.get_target())
+        if target in [output, join(output, 'index.html')] or path in [page.url, page.url.rstrip('/')]:
+            return page
+    return None
+
+
+def template_source(site, name):
+    """
+    Get the source path of a template, relative to the site root
+    """
+    if name in site.pagedata:
+        return join('content', name)
+    return join('layouts', name)
+
+
+def time_blocks(site, page):
+    """
+    Render each block of the page's template on its own. Returns a list of
+    (block, template, seconds, characters). Blocks include the blocks nested
+    inside them.
+    """
+    import jinja2.utils
+    template = site.renderer.get_template(page.get_template_name())
+    context = template.new_context(dict(page.context(), site=site, livejs=''))
+    # Rendering the root fills in the blocks of the templates we extend
+    jinja2.utils.concat(template.root_render_func(context))
+    blocks = []
+    for name, functions in sorted(context.blocks.items()):
+        start = wall_clock()
+        text = jinja2.utils.concat(functions[0](context))
+        blocks.append((name, functions[0].__globals__.get('name'), wall_clock() - start, len(text)))
+    return blocks
+
+
+def explain(site, page):
+    """
+    Work out what a page depends on and time rendering it. Returns a dict.
+    """
+    name = page.get_template_name()
+    closure = site.template_closure(name)
+    body = page.body if page.ext in ['.md', '.markdown'] else ''
+    blocks = [match.group(0) for match in code_block.finditer(body)]
+
+    # The site only records the path and tag of each query, so we note the
+    # limits the page asks for ourselves
+    limits = {}
+    pages = site.pages
+
+    def recorded(path=None, tag=None, limit=None, order=None):
+        limits.setdefault((path, tag), []).append(limit if limit is not None and limit > 0 else None)
+        return pages(path=path, tag=tag, limit=limit, order=order)
+
+    profiler = Profiler()
+    profiler.install(type(site), type(page))
+    site.pages = recorded
+    try:
+        start = wall_clock()
+        page.content = None
+        page.render()
+        total = wall_clock() - start
+    finally:
+        del site.pages
+        profiler.uninstall()
+    phases = dict((phase, wall) for phase, (wall, _) in profiler.pages.get(page.filepath, {}).items())
+
+    queries = []
+    for path, tag in site.queries.get(page.filepath) or []:
+        if (path, tag) not in [(query['path'], query['tag']) for query in queries]:
+            matches = len(site.pages(path=path, tag=tag))
+            # The most pages any of the calls gets
+            limit = None
+            if None not in limits.get((path, tag), [None]):
+                limit = max(limits[(path, tag)])
+            queries.append({'path': path, 'tag': tag, 'limit': limit,
+                            'results': matches if limit is None else min(limit, matches),
+                            'matches': matches})
+
+    invalidated_by = [join('content', page.filepath)]
+    invalidated_by += sorted(template_source(site, item) for item in closure if item != page.filepath)
+    if queries:
+        for query in queries:
+            where = []
+            if query['path'] is not None:
+                where.append('under %s' % join('content', query['path']))
+            if query['tag'] is not None:
+                where.append('tagged %s' % query['tag'])
+            invalidated_by.append('adding, changing or removing pages %s' % ' and '.join(where or ['anywhere']))
+    elif site.uses_site(closure):
+        invalidated_by.append('adding, changing or removing any page')
+
+    return {
+        'source': join('content', page.filepath),
+        'output': page.get_target(),
+        'url': page.url,
+        'template': name,
+        'templates': sorted((item, template_source(site, item)) for item in closure),
+        'queries': queries,
+        'markdown_size': len(body),
+        'code_blocks': len(blocks),
+        'code_size': sum(len(block) for block in blocks),
+        'render_seconds': total,
+        'phases': phases,
+        'blocks': time_blocks(site, page),
+        'output_size': len(page.rendered or ''),
+        'invalidated_by': invalidated_by,
+    }
+
+
+def format(report):
+    """
+    Format an explanation as text for the terminal
+    """
+    lines = [
+        "%s -> %s (%s)" % (report['source'], report['output'], report['url']),
+        "",
+        "Templates (%s and everything it extends or includes)" % report['template'],
+    ]
+    for name, source in report['templates']:
+        lines.append("  %s" % source)
+    lines.append("")
+    if report['queries']:
+        lines.append("Queries")
+        for query in report['queries']:
+            if query['limit'] is None:
+                lines.append("  site.pages(path=%r, tag=%r): %d pages" %
+                             (query['path'], query['tag'], query['results']))
+            else:
+                lines.append("  site.pages(path=%r, tag=%r, limit=%d): %d of %d pages" %
+                             (query['path'], query['tag'], query['limit'], query['results'], query['matches']))
+    else:
+        lines.append("Queries: none")
+    lines.append("")
+    lines.append("Markdown: %d characters, %d code blocks (%d characters)" %
+                 (report['markdown_size'], report['code_blocks'], report['code_size']))
+    lines.append("Output: %d characters" % report['output_size'])
+    lines.append("")
+    lines.append("Render: %.4fs" % report['render_seconds'])
+    for phase, seconds in sorted(report['phases'].items(), key=lambda item: -item[1]):
+        lines.append("  %-10s %.4fs" % (phase, seconds))
+    lines.append("")
+    lines.append("Blocks (each includes the blocks inside it)")
+    for name, template, seconds, size in sorted(report['blocks'], key=lambda item: -item[2]):
+        lines.append("  %-20s %.4fs  %7d characters  from %s" % (name, seconds, size, template))
+    lines.append("")
+    lines.append("Rendered again when these change")
+    for item in report['invalidated_by']:
+        lines.append("  %s" % item)
+    return "\n".join(lines)
@@ -0,0 +1,145 @@
+# -*- coding: utf8 -*-
+"""
+Atom and RSS feed generation.
+
+Feeds are written as a stream of strings so large feeds never have to be held
+in memory as a document tree. The output only depends on the pages in the feed
+(there is no "generated at" timestamp) so building an unchanged site produces
+byte-identical feeds.
+"""
+from __future__ import absolute_import, division, print_function, unicode_literals
+from datetime import datetime
+from xml.sax.saxutils import escape, quoteattr
+
+
+__metaclass__ = type
+
+days = ["Mon", "Tue", "Wed", "Thu", "Fri", "Sat", "Sun"]
+months = ["Jan", "Feb", "Mar", "Apr", "May", "Jun",
+          "Jul", "Aug", "Sep", "Oct", "Nov", "Dec"]
+
+
+def format_iso8601(date):
+    """Format a naive UTC datetime for Atom"""
+    return date.strftime("%Y-%m-%dT%H:%M:%SZ")
+
+
+def format_rfc822(date):
+    """
+    Format a naive UTC datetime for RSS. This is spelled out by hand because
+    strftime uses the current locale for day and month names.
+    """
+    return "%s, %02d %s %04d %02d:%02d:%02d GMT" % (
+        days[date.weekday()], date.day, months[date.month - 1], date.year,
+        date.hour, date.minute, date.second)
+
+
+def text(value):
+    """Escape a value for use as XML character data"""
+    if value is None:
+        return ""
+    return escape(value)
+
+
+class Feed:
+    """
+    A feed for a list of pages. Use kind="atom" or kind="rss" to pick the
+    format. Entry content comes from page.get_content() so markdown pages are
+    included without rendering their templates.
+    """
+    kinds = ["atom", "rss"]
+    epoch = datetime(1970, 1, 1)
+
+    def __init__(self, kind, title, feed_url, site_url, subtitle=None, author=None):
+        if kind not in self.kinds:
+            raise ValueError("Unknown feed type %s; expected one of %s" %
+                             (kind, ", ".join(self.kinds)))
+        self.kind = kind
+        self.title = title
+        self.feed_url = feed_url
+        self.site_url = site_url or ""
+        self.subtitle = subtitle
+        self.author = author
+
+    def updated(self, pages):
+        """
+        The feed is as new as its newest entry. We don't use the current time
+        because that would change the feed on every build.
+        """
+        dates = [page.published for page in pages if page.published is not None]
+        if dates:
+            return max(dates)
+        return self.epoch
+
+    def generate(self, pages):
+        """
+        Yield the feed as a series of strings
+        """
+        if self.kind == "atom":
+            return self.generate_atom(pages)
+        return self.generate_rss(pages)
+
+    def generate_atom(self, pages):
+        yield '<?xml version="1.0" encoding="utf-8"?>\n'
+        yield '<feed xmlns="http://www.w3.org/2005/Atom">\n'
+        yield '  <title type="text">%s</title>\n' % text(self.title)
+        if self.subtitle:
+            yield '  <subtitle type="text">%s</subtitle>\n' % text(self.subtitle)
+        yield '  <id>%s</id>\n' % text(self.feed_url or self.site_url)
+        yield '  <updated>%s</updated>\n' % format_iso8601(self.updated(pages))
+        if self.site_url:
+            yield '  <link href=%s />\n' % quoteattr(self.site_url)
+        if self.feed_url:
+            yield '  <link href=%s rel="self" />\n' % quoteattr(self.feed_url)
+        if self.author:
+            yield '  <author><name>%s</name></author>\n' % text(self.author)
+        for page in pages:
+            url = self.site_url + page.url
+            date = page.published or self.epoch
+            yield '  <entry>\n'
+            yield '    <title type="text">%s</title>\n' % text(page.title)
+            yield '    <id>%s</id>\n' % text(url)
+            yield '    <updated>%s</updated>\n' % format_iso8601(date)
+            yield '    <published>%s</published>\n' % format_iso8601(date)
+            yield '    <link href=%s />\n' % quoteattr(url)
+            content = page.get_content()
+            if content is not None:
+                yield '    <content type="html">%s</content>\n' % text(content)
+            yield '  </entry>\n'
+        yield '</feed>\n'
+
+    def generate_rss(self, pages):
+        yield '<?xml version="1.0" encoding="utf-8"?>\n'
+        yield '<rss version="2.0" xmlns:atom="http://www.w3.org/2005/Atom">\n'
+        yield '<channel>\n'
+        yield '  <title>%s</title>\n' % text(self.title)
+        yield '  <link>%s</link>\n' % text(self.site_url)
+        yield '  <description>%s</description>\n' % text(self.subtitle or self.title)
+        if self.feed_url:
+            yield ('  <atom:link href=%s rel="self" type="application/rss+xml" />\n' %
+                   quoteattr(self.feed_url))
+        yield '  <lastBuildDate>%s</lastBuildDate>\n' % format_rfc822(self.updated(pages))
+        for page in pages:
+            url = self.site_url + page.url
+            yield '  <item>\n'
+            yield '    <title>%s</title>\n' % text(page.title)
+            yield '    <link>%s</link>\n' % text(url)
+            yield '    <guid isPermaLink="true">%s</guid>\n' % text(url)
+            if page.published is not None:
+                yield '    <pubDate>%s</pubDate>\n' % format_rfc822(page.published)
+            content = page.get_content()
+            if content is not None:
+                yield '    <description>%s</description>\n' % text(content)
+            yield '  </item>\n'
+        yield '</channel>\n'
+        yield '</rss>\n'
+
+    def write(self, file, pages):
+        """
+        Stream the feed into a file-like object
+        """
+        for chunk in self.generate(pages):
+            file.write(chunk)
+
+    def to_string(self, pages):
+        return "".join(self.generate(pages))
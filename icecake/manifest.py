@@ -0,0 +1,114 @@
+# -*- coding: utf8 -*-
+"""
+A manifest of everything a build put in the output: the size, SHA-1 and
+content type of each file. Upload tooling can compare the manifests of two
+builds with diff() (or icecake diff-manifest) and push only what changed,
+instead of hashing the whole output again.
+
+The hashes are taken while the build writes each file. Incremental builds
+start from the manifest saved in the snapshot, so files that were skipped
+keep the entry from the build that wrote them.
+"""
+from __future__ import absolute_import, division, print_function, unicode_literals
+import json
+import mimetypes
+import os
+from os.path import dirname, isdir, isfile
+import platform
+import threading
+
+
+__metaclass__ = type
+
+version = 1
+
+
+def content_type(path):
+    """Guess the Content-Type to serve a file with"""
+    kind, _ = mimetypes.guess_type(path)
+    if kind is None:
+        return 'application/octet-stream'
+    if kind.startswith('text/') or kind in ['application/javascript', 'application/json', 'application/xml']:
+        # Rendered pages are always written as UTF-8
+        kind += '; charset=utf-8'
+    return kind
+
+
+class Manifest:
+    """
+    files -- {path: (size, sha1)} for each file in output. Paths use / between
+             folders.
+    """
+
+    def __init__(self, files=None):
+        self.files = dict(files or {})
+        # Writer threads add files while the build renders
+        self.lock = threading.Lock()
+
+    def add(self, path, size, sha1):
+        with self.lock:
+            self.files[path.replace(os.sep, '/')] = (size, sha1)
+
+    def remove(self, path):
+        with self.lock:
+            self.files.pop(path.replace(os.sep, '/'), None)
+
+    def move(self, old, new):
+        with self.lock:
+            entry = self.files.pop(old.replace(os.sep, '/'), None)
+            if entry is not None:
+                self.files[new.replace(os.sep, '/')] = entry
+
+    def clear(self):
+        with self.lock:
+            self.files = {}
+
+    def to_dict(self):
+        with self.lock:
+            files = dict(self.files)
+        return {
+            'version': version,
+            'files': dict((path, {'size': size, 'sha1': sha1, 'type': content_type(path)})
+                          for path, (size, sha1) in files.items()),
+        }
+
+    def save(self, path):
+        # Upload tooling may read the manifest at any time, so we write a
+        # temporary file and rename it into place. Shards of a build can run
+        # side by side in one site, so each process has its own.
+        if dirname(path) and not isdir(dirname(path)):
+            try:
+                os.makedirs(dirname(path))
+            except OSError:
+                if not isdir(dirname(path)):
+                    raise
+        temp = '%s.%d.tmp' % (path, os.getpid())
+        with open(temp, 'w') as f:
+            json.dump(self.to_dict(), f, indent=2, sort_keys=True)
+        if platform.system() == 'Windows' and isfile(path):
+            os.remove(path)  # rename does not replace files on Windows
+        os.rename(temp, path)
+
+
+def load(path):
+    """
+    Read the files from a saved manifest, as {path: {size, sha1, type}}
+    """
+    with open(path) as f:
+        data = json.load(f)
+    if not isinstance(data, dict) or data.get('version') != version:
+        raise ValueError('%s is not a manifest from this version of icecake' % path)
+    return data['files']
+
+
+def diff(old, new):
+    """
+    Compare the files of two manifests. Returns sorted lists of the paths that
+    were added, changed and deleted.
+    """
+    added = sorted(path for path in new if path not in old)
+    deleted = sorted(path for path in old if path not in new)
+    changed = sorted(path for path in new if path in old and
+                     (new[path]['sha1'], new[path]['size'], new[path]['type']) !=
+                     (old[path]['sha1'], old[path]['size'], old[path]['type']))
+    return added, changed, deleted
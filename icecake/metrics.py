@@ -0,0 +1,182 @@
+# -*- coding: utf8 -*-
+"""
+Counters and timings for a build, which can be written as JSON or in the
+Prometheus textfile collector format so builds run from CI or cron can be
+graphed and alerted on. Histograms keep track of latencies in long-running
+previews.
+"""
+from __future__ import absolute_import, division, print_function, unicode_literals
+import json
+import os
+from os.path import dirname, isdir, isfile
+import platform
+import threading
+import time
+
+
+__metaclass__ = type
+
+# The counters we keep, with the help text we give Prometheus
+counters = [
+    ("pages", "Pages in the site"),
+    ("pages_parsed", "Pages read and parsed from their source"),
+    ("pages_reused", "Pages loaded from the snapshot or page store without being parsed"),
+    ("pages_rendered", "Pages rendered"),
+    ("pages_skipped", "Pages that were up to date and not rendered"),
+    ("files_written", "Rendered files written to output"),
+    ("files_unchanged", "Rendered files that output already had, which were not rewritten"),
+    ("bytes_written", "Bytes of rendered files written to output"),
+    ("static_copied", "Static files copied to output"),
+    ("static_skipped", "Static files that were up to date and not copied"),
+    ("static_bytes_copied", "Bytes of static files copied to output"),
+    ("markdown_cache_hits", "Markdown bodies found in the fragment cache or page store"),
+    ("markdown_converted", "Markdown bodies converted to HTML"),
+]
+
+# Cache hit ratios as (name, hits, misses)
+ratios = [
+    ("markdown_cache_hit_ratio", "markdown_cache_hits", "markdown_converted"),
+    ("page_reuse_ratio", "pages_reused", "pages_parsed"),
+]
+
+
+class Histogram:
+    """
+    Counts observations into buckets, like a Prometheus histogram. Bucket
+    counts are cumulative: each is the number of observations less than or
+    equal to its bound.
+    """
+    # Seconds, from a millisecond up
+    buckets = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0, 10.0)
+
+    def __init__(self, buckets=None):
+        if buckets is not None:
+            self.buckets = tuple(buckets)
+        self.lock = threading.Lock()
+        self.counts = [0] * len(self.buckets)
+        self.count = 0
+        self.sum = 0
+        self.max = None
+
+    def observe(self, value):
+        with self.lock:
+            for index, bound in enumerate(self.buckets):
+                if value <= bound:
+                    self.counts[index] += 1
+            self.count += 1
+            self.sum += value
+            if self.max is None or value > self.max:
+                self.max = value
+
+    def to_dict(self):
+        with self.lock:
+            return {
+                "count": self.count,
+                "sum": self.sum,
+                "max": self.max,
+                "mean": self.sum / self.count if self.count else None,
+                "buckets": [[bound, count] for bound, count in zip(self.buckets, self.counts)] +
+                           [["+Inf", self.count]],
+            }
+
+
+class Phase:
+    def __init__(self, metrics, name):
+        self.metrics = metrics
+        self.name = name
+        self.start = None
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.metrics.record(self.name, time.time() - self.start)
+        return False
+
+
+class Metrics:
+    """
+    The counters for one site. Counters are plain integers so keeping them
+    costs next to nothing; phases are seconds spent in each part of the build.
+    """
+
+    def __init__(self):
+        self.values = dict((name, 0) for name, _ in counters)
+        self.phases = {}
+        self.started = time.time()
+        # Writer threads count the files they write
+        self.lock = threading.Lock()
+
+    def add(self, name, amount=1):
+        with self.lock:
+            self.values[name] += amount
+
+    def set(self, name, value):
+        self.values[name] = value
+
+    def phase(self, name):
+        """
+        Time a block of code, like: with site.metrics.phase("render"):
+        """
+        return Phase(self, name)
+
+    def record(self, name, seconds):
+        self.phases[name] = self.phases.get(name, 0.0) + seconds
+
+    def ratio(self, hits, misses):
+        total = self.values[hits] + self.values[misses]
+        if not total:
+            return None
+        return self.values[hits] / total
+
+    def to_dict(self):
+        return {
+            "timestamp": self.started,
+            "counters": dict(self.values),
+            "ratios": dict((name, self.ratio(hits, misses)) for name, hits, misses in ratios),
+            "phases": dict(self.phases),
+        }
+
+    def to_prometheus(self, prefix="icecake_build"):
+        """
+        Format the metrics for the Prometheus textfile collector. Each value
+        describes the last build, so they are all gauges.
+        """
+        lines = []
+
+        def gauge(name, help, samples):
+            lines.append("# HELP %s_%s %s" % (prefix, name, help))
+            lines.append("# TYPE %s_%s gauge" % (prefix, name))
+            for labels, value in samples:
+                value = repr(value) if isinstance(value, float) else str(value)
+                lines.append("%s_%s%s %s" % (prefix, name, labels, value))
+
+        gauge("timestamp_seconds", "When the last build started", [("", self.started)])
+        for name, help in counters:
+            gauge(name, help, [("", self.values[name])])
+        for name, hits, misses in ratios:
+            value = self.ratio(hits, misses)
+            if value is not None:
+                gauge(name, "%s / (%s + %s)" % (hits, hits, misses), [("", value)])
+        gauge("phase_seconds", "Seconds spent in each phase of the build",
+              [('{phase="%s"}' % name, seconds) for name, seconds in sorted(self.phases.items())])
+        return "\n".join(lines) + "\n"
+
+    def write(self, path, data):
+        # The textfile collector may read the file at any time, so we write a
+        # temporary file and rename it into place
+        if dirname(path) and not isdir(dirname(path)):
+            os.makedirs(dirname(path))
+        temp = path + '.tmp'
+        with open(temp, 'w') as f:
+            f.write(data)
+        if platform.system() == 'Windows' and isfile(path):
+            os.remove(path)  # rename does not replace files on Windows
+        os.rename(temp, path)
+
+    def write_json(self, path):
+        self.write(path, json.dumps(self.to_dict(), indent=2, sort_keys=True))
+
+    def write_prometheus(self, path):
+        self.write(path, self.to_prometheus())
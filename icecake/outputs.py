@@ -0,0 +1,550 @@
+# -*- coding: utf8 -*-
+"""
+Places a site can be written to.
+
+A build writes every page and static file through an output backend. The
+default writes into a folder. The others write a tarball or zip file in one
+pass, without a temporary tree, store files by their content so unchanged
+files are never written twice, or keep everything in memory.
+
+Backends are picked with a spec like the ones icecake build --output takes:
+
+    output            A folder
+    dir:output        A folder
+    tar:site.tar.gz   A tarball, compressed according to its extension
+    zip:site.zip      A zip file
+    cas:store         A content-addressed store in a folder
+    memory:           A dict in memory, for tests and embedding (not from the
+                      command line, where it would throw the site away)
+
+Backends can be written to from several threads at once.
+"""
+from __future__ import absolute_import, division, print_function, unicode_literals
+import hashlib
+import io
+import json
+import logging
+import os
+from os.path import abspath, basename, dirname, expanduser, isdir, isfile, join, realpath
+import platform
+import shutil
+import threading
+import time
+
+
+from .shards import manifest_name as shard_manifest_name
+from .snapshot import file_digest
+
+
+__metaclass__ = type
+
+# An empty file we leave in the folders we build into, other than a site's own
+# output folder, so later builds know they may empty them
+marker_name = '.icecake-output'
+
+
+class OutputError(ValueError):
+    pass
+
+
+def archive_path(path):
+    """Archives always use / between folders"""
+    return path.replace(os.sep, '/')
+
+
+def replace(temp, target):
+    if platform.system() == 'Windows' and isfile(target):
+        os.remove(target)  # rename does not replace files on Windows
+    os.rename(temp, target)
+
+
+def clean_folder(folder, site_root=None):
+    """
+    Delete a folder so a build can start from scratch. Since the folder can
+    come from the command line, we refuse to delete the home folder, the site
+    or a folder containing either of them, and a folder with files in it
+    unless it is the site's output folder or an earlier build marked it.
+    """
+    folder = realpath(folder)
+    protected = [realpath(expanduser('~'))]
+    if site_root is not None:
+        protected.append(realpath(site_root))
+    for path in protected:
+        if path == folder or path.startswith(folder.rstrip(os.sep) + os.sep):
+            raise OutputError('Refusing to delete %s, since it holds %s' % (folder, path))
+    default = site_root is not None and folder == realpath(join(site_root, 'output'))
+    if isdir(folder) and not default and os.listdir(folder):
+        if not any(isfile(join(folder, name)) for name in [marker_name, shard_manifest_name]):
+            raise OutputError('Refusing to delete %s, which has files icecake did not write; '
+                              'empty it or build somewhere else' % folder)
+    if isdir(folder):
+        shutil.rmtree(folder)
+    if not default:
+        os.makedirs(folder)
+        open(join(folder, marker_name), 'w').close()
+
+
+def write_if_changed(target, data, folders=None):
+    """
+    Write data to the target file unless the file already has exactly this
+    content. Leaving unchanged files alone keeps their mtime stable so sync and
+    upload tools can skip them. Returns True if the file was written.
+
+    Pass a set as folders to remember which folders exist, so we don't check
+    for the same folder for every file in it.
+    """
+    if isfile(target):
+        with open(target, mode='rb') as f:
+            if f.read() == data:
+                return False
+    else:
+        target_dir = dirname(target)
+        if folders is None or target_dir not in folders:
+            if not isdir(target_dir):
+                try:
+                    os.makedirs(target_dir)
+                except OSError:
+                    # Another writer thread may have just created it
+                    if not isdir(target_dir):
+                        raise
+            if folders is not None:
+                folders.add(target_dir)
+    with open(target, mode='wb') as f:
+        f.write(data)
+    return True
+
+
+def copy_in_kernel(source, target, size):
+    """
+    Copy size bytes between two open files without reading them into Python,
+    using copy_file_range or sendfile where the OS has them. Returns False if
+    neither works for these files, in which case nothing was copied.
+    """
+    for name in ['copy_file_range', 'sendfile']:
+        if not hasattr(os, name):
+            continue
+        copied = 0
+        try:
+            while copied < size:
+                if name == 'copy_file_range':
+                    sent = os.copy_file_range(source.fileno(), target.fileno(), size - copied)
+                else:
+                    sent = os.sendfile(target.fileno(), source.fileno(), copied, size - copied)
+                if sent == 0:
+                    break  # The file got shorter
+                copied += sent
+            return True
+        except OSError:
+            # Not supported for these files (like sendfile to a regular file
+            # on macOS, or copy_file_range across filesystems)
+            if copied:
+                raise
+    return False
+
+
+class HashingReader:
+    """
+    Wraps a file so everything read from it also goes into hashes
+    """
+
+    def __init__(self, f, *hashes):
+        self.f = f
+        self.hashes = hashes
+
+    def read(self, size=-1):
+        data = self.f.read(size)
+        for hash in self.hashes:
+            hash.update(data)
+        return data
+
+
+def copy_file(source, target, sha1=None):
+    """
+    Copy a file, with its permissions. The data goes to a temporary file next
+    to the target which is then renamed over it, so nobody ever sees a
+    partial copy.
+
+    Pass a hashlib object as sha1 to hash the file as it is copied. The data
+    has to pass through Python for that, so the copy isn't done in the kernel.
+    """
+    temp = join(dirname(target), '.%s.icecake-tmp' % basename(target))
+    try:
+        with open(source, mode='rb') as src:
+            with open(temp, mode='wb') as dst:
+                size = os.fstat(src.fileno()).st_size
+                if sha1 is not None:
+                    shutil.copyfileobj(HashingReader(src, sha1), dst, 1024 * 1024)
+                elif not copy_in_kernel(src, dst, size):
+                    shutil.copyfileobj(src, dst, 1024 * 1024)
+        shutil.copymode(source, temp)
+    except Exception:
+        # Don't leave a partial copy behind to be published
+        if isfile(temp):
+            os.remove(temp)
+        raise
+    replace(temp, target)
+
+
+class Output:
+    """
+    Somewhere to write a site. Paths are relative to the root of the site's
+    output, like articles/hello-world/index.html.
+    """
+    # The folder the files are written to, if they are written to a folder
+    root = None
+    # Whether the files from the last build are still there to compare
+    # against, which incremental builds and previews need
+    incremental = False
+
+    def open(self):
+        """
+        Called before a build writes anything
+        """
+        pass
+
+    def close(self):
+        """
+        Called after a build has written everything
+        """
+        pass
+
+    def abort(self):
+        """
+        Called instead of close() when a build fails
+        """
+        pass
+
+    def clean(self, site_root=None):
+        """
+        Remove the files written by earlier builds. site_root is the site being
+        built, if there is one.
+        """
+        pass
+
+    def name(self, path):
+        """
+        Describe where a file is written, for messages
+        """
+        return path
+
+    def write(self, path, data):
+        """
+        Write a rendered page, encoded as UTF-8. Returns True if anything was
+        written, or False if the output already had this file.
+        """
+        raise NotImplementedError()
+
+    def copy(self, path, source, sha1=None):
+        """
+        Copy a static file into the output. Returns the SHA-1 of the file,
+        taken while it was copied unless it was passed in as sha1.
+        """
+        raise NotImplementedError()
+
+
+class DirectoryOutput(Output):
+    incremental = True
+
+    def __init__(self, root):
+        self.root = abspath(root)
+        # Folders we know exist while a build is writing. Outside of a build
+        # anything could happen to them.
+        self.folders = None
+
+    def open(self):
+        self.folders = set()
+
+    def close(self):
+        self.folders = None
+
+    def abort(self):
+        self.folders = None
+
+    def clean(self, site_root=None):
+        clean_folder(self.root, site_root)
+
+    def name(self, path):
+        return join(self.root, path)
+
+    def write(self, path, data):
+        return write_if_changed(join(self.root, path), data, self.folders)
+
+    def copy(self, path, source, sha1=None):
+        target = join(self.root, path)
+        target_dir = dirname(target)
+        if not isdir(target_dir):
+            logging.debug('Creating directory %s' % target_dir)
+            try:
+                os.makedirs(target_dir, mode=0o755)
+            except OSError:
+                if not isdir(target_dir):
+                    raise
+        if sha1 is not None:
+            # We already know the hash, so the kernel can do the copy
+            copy_file(source, target)
+            return sha1
+        sha1 = hashlib.sha1()
+        copy_file(source, target, sha1)
+        return sha1.hexdigest()
+
+
+class ArchiveOutput(Output):
+    """
+    Writes a single archive file. The archive is written next to its final
+    name and renamed into place when the build is done, so a failed build
+    leaves the last archive alone.
+    """
+
+    def __init__(self, path):
+        self.path = abspath(path)
+        self.temp = self.path + '.tmp'
+        self.lock = threading.Lock()
+        self.archive = None
+        self.names = set()
+        self.started = None
+
+    def open(self):
+        if not isdir(dirname(self.path)):
+            os.makedirs(dirname(self.path))
+        self.names = set()
+        self.started = time.time()
+        self.archive = self.create(self.temp)
+
+    def close(self):
+        self.archive.close()
+        self.archive = None
+        replace(self.temp, self.path)
+
+    def abort(self):
+        if self.archive is not None:
+            self.archive.close()
+            self.archive = None
+        if isfile(self.temp):
+            os.remove(self.temp)
+
+    def name(self, path):
+        return '%s:%s' % (self.path, archive_path(path))
+
+    def claim(self, path):
+        """
+        Make sure a path is only added once, since archives can hold two
+        files with the same name
+        """
+        if self.archive is None:
+            raise RuntimeError('%s is not open for writing' % self.path)
+        if path in self.names:
+            logging.warning('%s was already written to %s', path, self.path)
+            return False
+        self.names.add(path)
+        return True
+
+    def write(self, path, data):
+        path = archive_path(path)
+        with self.lock:
+            if not self.claim(path):
+                return False
+            self.add(path, data)
+        return True
+
+    def copy(self, path, source, sha1=None):
+        path = archive_path(path)
+        sha1 = hashlib.sha1()
+        with self.lock:
+            if not self.claim(path):
+                return file_digest(source)
+            with open(source, 'rb') as f:
+                self.add_file(path, source, HashingReader(f, sha1))
+        return sha1.hexdigest()
+
+
+class TarOutput(ArchiveOutput):
+    compression = [
+        ('.tar.gz', 'gz'),
+        ('.tgz', 'gz'),
+        ('.tar.bz2', 'bz2'),
+        ('.tar.xz', 'xz'),
+    ]
+
+    def __init__(self, path):
+        super(TarOutput, self).__init__(path)
+        self.mode = 'w'
+        for extension, compression in self.compression:
+            if self.path.endswith(extension):
+                self.mode = 'w:' + compression
+        # Python 2's tarfile can't write xz
+        if self.mode == 'w:xz' and platform.python_version_tuple()[0] == '2':
+            raise ValueError('Invalid output %s; .tar.xz needs Python 3' % path)
+
+    def create(self, path):
+        import tarfile
+        return tarfile.open(path, self.mode)
+
+    def add(self, path, data):
+        import tarfile
+        info = tarfile.TarInfo(path)
+        info.size = len(data)
+        info.mtime = self.started
+        info.mode = 0o644
+        self.archive.addfile(info, io.BytesIO(data))
+
+    def add_file(self, path, source, f):
+        self.archive.addfile(self.archive.gettarinfo(source, arcname=path), f)
+
+
+class ZipOutput(ArchiveOutput):
+    def create(self, path):
+        import zipfile
+        return zipfile.ZipFile(path, 'w', zipfile.ZIP_DEFLATED)
+
+    def add(self, path, data):
+        import zipfile
+        info = zipfile.ZipInfo(path, time.localtime(self.started)[:6])
+        info.compress_type = zipfile.ZIP_DEFLATED
+        info.external_attr = 0o644 << 16
+        self.archive.writestr(info, data)
+
+    def add_file(self, path, source, f):
+        import zipfile
+        if not hasattr(zipfile.ZipInfo, 'from_file'):
+            # Python 2 can't stream into a zip file
+            self.archive.writestr(self.archive_info(path, source), f.read())
+            return
+        with self.archive.open(self.archive_info(path, source), 'w') as dst:
+            shutil.copyfileobj(f, dst, 1024 * 1024)
+
+    def archive_info(self, path, source):
+        import zipfile
+        stat = os.stat(source)
+        info = zipfile.ZipInfo(path, time.localtime(stat.st_mtime)[:6])
+        info.compress_type = zipfile.ZIP_DEFLATED
+        info.external_attr = (stat.st_mode & 0o7777) << 16
+        info.file_size = stat.st_size
+        return info
+
+
+class ContentOutput(Output):
+    """
+    A content-addressed store. Each file is stored once under the sha256 of
+    its content in objects/, and index.json maps the site's paths to them.
+    Files that didn't change since an earlier build are already there, so
+    only new content is written.
+    """
+    index_name = 'index.json'
+
+    def __init__(self, root):
+        self.store = abspath(root)
+        self.lock = threading.Lock()
+        self.index = {}
+
+    def object_path(self, key):
+        return join(self.store, 'objects', key[:2], key[2:])
+
+    def open(self):
+        self.index = {}
+
+    def close(self):
+        if not isdir(self.store):
+            os.makedirs(self.store)
+        temp = join(self.store, self.index_name + '.tmp')
+        with open(temp, 'w') as f:
+            json.dump(self.index, f, indent=2, sort_keys=True)
+        replace(temp, join(self.store, self.index_name))
+
+    def name(self, path):
+        return 'cas:%s' % archive_path(path)
+
+    def put(self, key, write):
+        """
+        Store an object unless we already have it. write(path) writes the
+        object's content to path.
+        """
+        target = self.object_path(key)
+        if isfile(target):
+            return False
+        if not isdir(dirname(target)):
+            try:
+                os.makedirs(dirname(target))
+            except OSError:
+                if not isdir(dirname(target)):
+                    raise
+        # Two threads may store the same content at once, so each writes
+        # its own temporary file
+        temp = '%s.%d.tmp' % (target, threading.current_thread().ident)
+        write(temp)
+        replace(temp, target)
+        return True
+
+    def write(self, path, data):
+        key = hashlib.sha256(data).hexdigest()
+
+        def write(temp):
+            with open(temp, 'wb') as f:
+                f.write(data)
+        written = self.put(key, write)
+        with self.lock:
+            self.index[archive_path(path)] = key
+        return written
+
+    def copy(self, path, source, sha1=None):
+        sha256 = hashlib.sha256()
+        sha1 = hashlib.sha1()
+        with open(source, 'rb') as f:
+            reader = HashingReader(f, sha256, sha1)
+            while reader.read(1024 * 1024):
+                pass
+        key = sha256.hexdigest()
+        self.put(key, lambda temp: copy_file(source, temp))
+        with self.lock:
+            self.index[archive_path(path)] = key
+        return sha1.hexdigest()
+
+
+class MemoryOutput(Output):
+    """
+    Keeps the site in files, a dict of {path: bytes}
+    """
+
+    def __init__(self):
+        self.files = {}
+
+    def clean(self, site_root=None):
+        self.files = {}
+
+    def name(self, path):
+        return 'memory:%s' % archive_path(path)
+
+    def write(self, path, data):
+        path = archive_path(path)
+        if self.files.get(path) == data:
+            return False
+        self.files[path] = data
+        return True
+
+    def copy(self, path, source, sha1=None):
+        with open(source, 'rb') as f:
+            data = f.read()
+        self.files[archive_path(path)] = data
+        return hashlib.sha1(data).hexdigest()
+
+
+backends = {
+    'dir': DirectoryOutput,
+    'tar': TarOutput,
+    'zip': ZipOutput,
+    'cas': ContentOutput,
+}
+
+
+def from_spec(spec):
+    """
+    Get the backend for a spec like tar:site.tar.gz. Anything without a
+    known prefix is a folder.
+    """
+    kind, separator, path = spec.partition(':')
+    if separator and kind == 'memory':
+        return MemoryOutput()
+    if separator and kind in backends:
+        if not path:
+            raise ValueError('Invalid output %s; expected a path after %s:' % (spec, kind))
+        return backends[kind](path)
+    return DirectoryOutput(spec)
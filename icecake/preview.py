@@ -0,0 +1,364 @@
+# -*- coding: utf8 -*-
+"""
+Background rendering for icecake preview and watch.
+
+Pages that have to be rendered again are put in a priority queue and rendered
+one at a time by a worker thread, so the watcher never waits for rendering.
+
+In preview mode pages are also rendered the first time they are requested,
+instead of building the whole site before the server starts. Pages that are
+open in a browser go to the front of the queue.
+"""
+from __future__ import absolute_import, division, print_function, unicode_literals
+import heapq
+import itertools
+import logging
+from os.path import isfile, join
+import threading
+import time
+
+
+from .metrics import Histogram
+
+
+__metaclass__ = type
+
+try:
+    from urllib.parse import unquote, urlsplit
+except ImportError:
+    from urllib import unquote
+    from urlparse import urlsplit
+
+# Priorities for the rebuild queue. Lower numbers are rendered first.
+VIEWING = 0     # Pages that are open in a browser
+CHANGED = 1     # Pages affected by a change to the site
+BACKGROUND = 2  # Pages that were out of date when we started
+
+
+class RebuildQueue:
+    """
+    A queue of pages to render, ordered by priority. Pages are rendered by a
+    worker thread, which holds the lock while it renders each page. Anything
+    else that touches the site while the worker is running should hold the
+    lock too.
+    """
+
+    def __init__(self, site):
+        self.site = site
+        self.lock = threading.RLock()
+        self.condition = threading.Condition(threading.Lock())
+        self.heap = []
+        self.queued = {}
+        self.counter = itertools.count()
+        self.thread = None
+        self.stopped = False
+        # When each page was first queued because of a change, so we can tell
+        # how long it took for the change to show up
+        self.changed = {}
+        self.rendered = 0
+        self.latency = Histogram()
+        self.render_time = Histogram()
+        self.batch_size = Histogram(buckets=(1, 2, 5, 10, 20, 50, 100, 200, 500, 1000))
+
+    def __len__(self):
+        with self.condition:
+            return len(self.queued)
+
+    def __contains__(self, filepath):
+        with self.condition:
+            return filepath in self.queued
+
+    def priority(self, filepath, default):
+        """
+        Get the sort key for a page that is being queued with the default
+        priority
+        """
+        return (default, 0)
+
+    def push(self, filepaths, priority=CHANGED):
+        """
+        Queue pages to be rendered. A page that is already queued keeps
+        whichever place is sooner.
+        """
+        with self.condition:
+            for filepath in filepaths:
+                key = self.priority(filepath, priority)
+                if filepath in self.queued and self.queued[filepath] <= key:
+                    continue
+                self.queued[filepath] = key
+                heapq.heappush(self.heap, (key, next(self.counter), filepath))
+            self.condition.notify()
+
+    def rebuild(self, filepaths):
+        """
+        Called by the watcher with the pages affected by a change
+        """
+        self.track(filepaths)
+        self.push(filepaths, CHANGED)
+
+    def track(self, filepaths):
+        """
+        Start timing how long it takes to render the pages affected by a change
+        """
+        now = time.time()
+        self.batch_size.observe(len(filepaths))
+        with self.condition:
+            for filepath in filepaths:
+                self.changed.setdefault(filepath, now)
+
+    def pop(self, block=True):
+        """
+        Take the next page off the queue. Returns None when the queue is empty
+        and we aren't blocking, or when the queue has been stopped.
+        """
+        with self.condition:
+            while not self.stopped:
+                while self.heap:
+                    key, _, filepath = heapq.heappop(self.heap)
+                    # Entries that were queued again with a better place are
+                    # left in the heap; skip them.
+                    if self.queued.get(filepath) == key:
+                        del self.queued[filepath]
+                        return filepath
+                if not block:
+                    break
+                self.condition.wait()
+        return None
+
+    def render(self, filepath):
+        with self.lock:
+            page = self.site.pagedata.get(filepath)
+            if page is None:
+                return
+            start = time.time()
+            try:
+                page.render_to_disk()
+            except Exception:
+                logging.exception("Failed to render %s", filepath)
+            now = time.time()
+            self.render_time.observe(now - start)
+            with self.condition:
+                self.rendered += 1
+                changed = self.changed.pop(filepath, None)
+            if changed is not None:
+                self.latency.observe(now - changed)
+
+    def idle(self):
+        """
+        Called when the queue has been emptied
+        """
+        pass
+
+    def run_pending(self):
+        """
+        Render everything in the queue and return
+        """
+        while True:
+            filepath = self.pop(block=False)
+            if filepath is None:
+                break
+            self.render(filepath)
+        self.idle()
+
+    def work(self):
+        while True:
+            filepath = self.pop()
+            if filepath is None:
+                return
+            self.render(filepath)
+            if not len(self):
+                self.idle()
+            # Give request threads a chance to take the lock
+            time.sleep(0)
+
+    def start(self):
+        """
+        Start rendering queued pages in the background
+        """
+        self.thread = threading.Thread(target=self.work)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stats(self):
+        """
+        Get the state of the queue and how long rebuilds take
+        """
+        site = self.site
+        # We don't take the lock, so stats answer while a page is rendering.
+        # The counts may be a page behind.
+        cache = {
+            "pages": len(site.pagedata),
+            "files": len(site.cache.files),
+            "file_chars": site.cache.chars,
+            "templates": len(site.cache.templates),
+            "compiled_templates": len(site.renderer.cache) if site.renderer.cache is not None else 0,
+        }
+        metrics = site.metrics.to_dict()
+        return {
+            "queue": len(self),
+            "rendered": self.rendered,
+            "rebuild_latency_seconds": self.latency.to_dict(),
+            "render_seconds": self.render_time.to_dict(),
+            "pages_per_change": self.batch_size.to_dict(),
+            "cache": cache,
+            "counters": metrics["counters"],
+            "ratios": metrics["ratios"],
+        }
+
+    def stop(self):
+        with self.condition:
+            self.stopped = True
+            self.condition.notify_all()
+        if self.thread is not None:
+            self.thread.join()
+
+
+class Preview(RebuildQueue):
+    """
+    Tracks which pages in the output folder are up to date, and renders the
+    others when they are requested or when the worker gets to them. Pages
+    that were requested recently are rendered before anything else.
+    """
+    # How many seconds a page counts as open after it was last requested.
+    # livejs polls the page it is showing every second, so a page with a live
+    # reload connection stays open.
+    recent = 10
+
+    def __init__(self, site):
+        super(Preview, self).__init__(site)
+        self.fresh = set()
+        self.viewed = {}
+        self.urls = {}
+        self.indexed = None
+        self.filled = False
+        self.prepare()
+
+    def prepare(self):
+        """
+        Work out which pages are out of date. With a snapshot we can keep the
+        output of the pages that haven't changed; otherwise everything is
+        rendered again.
+        """
+        site = self.site
+        if site.snapshot is not None:
+            site.remove_deleted_outputs()
+            stale = site.stale_pages()
+        else:
+            stale = [page for _, page in sorted(site.pagedata.items())]
+        stale_paths = set(page.filepath for page in stale)
+        self.fresh = set(filepath for filepath in site.pagedata if filepath not in stale_paths)
+        self.push([page.filepath for page in stale], BACKGROUND)
+        self.index()
+
+    def index(self):
+        """
+        Map URL paths to the pages that produce them. Pages are reachable via
+        their clean URL and via the file we write.
+        """
+        urls = {}
+        for filepath, page in self.site.pagedata.items():
+            urls[page.url] = filepath
+            urls['/' + page.get_target()] = filepath
+        self.urls = urls
+        self.indexed = len(self.site.pagedata)
+
+    def lookup(self, url):
+        """
+        Find the page for a requested URL, or None if it isn't a page
+        """
+        path = unquote(urlsplit(url).path)
+        if self.indexed != len(self.site.pagedata):
+            self.index()
+        filepath = self.urls.get(path)
+        if filepath is None and not path.endswith('/'):
+            filepath = self.urls.get(path + '/')
+        return filepath
+
+    def priority(self, filepath, default):
+        viewed = self.viewed.get(filepath)
+        if viewed is not None and time.time() - viewed < self.recent:
+            # The page that was requested last goes first
+            return (VIEWING, -viewed)
+        return (default, 0)
+
+    def render(self, filepath):
+        """
+        Render a page unless it is already up to date
+        """
+        with self.lock:
+            if filepath in self.fresh:
+                return
+            super(Preview, self).render(filepath)
+            self.fresh.add(filepath)
+
+    def ensure(self, url):
+        """
+        Make sure the output for a requested URL is up to date before we serve
+        it. Static files are copied if they haven't been copied yet.
+        """
+        with self.lock:
+            filepath = self.lookup(url)
+            if filepath is not None:
+                self.viewed[filepath] = time.time()
+                self.render(filepath)
+                return
+            path = unquote(urlsplit(url).path).lstrip('/')
+            source = join(self.site.root, 'static', path)
+            if path and isfile(source) and not isfile(join(self.site.output_dir, path)):
+                self.site.copy_static(path)
+
+    def invalidate(self, filepaths, priority=CHANGED):
+        """
+        Mark pages as out of date and queue them to be rendered again
+        """
+        with self.lock:
+            for filepath in filepaths:
+                self.fresh.discard(filepath)
+            self.index()
+        self.push(filepaths, priority)
+
+    def rebuild(self, filepaths):
+        self.track(filepaths)
+        self.invalidate(filepaths)
+
+    def stale(self):
+        """
+        List the pages that haven't been rendered since they last changed
+        """
+        with self.lock:
+            return [filepath for filepath in self.site.pagedata if filepath not in self.fresh]
+
+    def save_snapshot(self):
+        """
+        Save a snapshot, leaving out the pages we haven't rendered yet so the
+        next run knows it still has to render them
+        """
+        with self.lock:
+            if self.site.snapshot is not None:
+                self.site.save_snapshot(exclude=self.stale())
+
+    def idle(self):
+        # The first time the queue runs dry the whole site is up to date, so
+        # we save a snapshot the next preview can start from.
+        if not self.filled:
+            self.filled = True
+            self.save_snapshot()
+            logging.debug("Finished rendering the site in the background")
+
+    def copy_static(self):
+        with self.lock:
+            if self.site.snapshot is not None:
+                self.site.sync_static()
+            else:
+                self.site.copy_all_static()
+
+    def fill(self):
+        """
+        Render everything that is out of date and return
+        """
+        self.copy_static()
+        self.run_pending()
+
+    def work(self):
+        self.copy_static()
+        super(Preview, self).work()
@@ -0,0 +1,430 @@
+# -*- coding: utf8 -*-
+"""
+Timing and memory reports for icecake build --profile and --memprofile.
+
+The profiler wraps the methods that do the work of a build (parsing front
+matter, converting markdown, highlighting code, rendering templates, writing
+output and copying static files) and records the wall and CPU time each one
+takes, per page. Phases can be nested, like Pygments inside Markdown inside
+a template, so each phase is charged only for the time not spent in the
+phases it called. Output is written on the writer threads while the next
+pages render, so the write phase overlaps the others and is charged to the
+output file rather than the page.
+
+The memory profiler takes a tracemalloc snapshot each time a phase of the
+build ends, to show which lines allocated the memory that phase kept, and
+estimates how much memory the site's own structures are holding on to.
+
+Nothing is wrapped until install() is called, so normal builds pay nothing.
+"""
+from __future__ import absolute_import, division, print_function, unicode_literals
+import functools
+import json
+import os
+from os.path import dirname, isdir, relpath
+import sys
+import threading
+import time
+
+
+__metaclass__ = type
+
+try:
+    wall_clock = time.perf_counter
+    cpu_clock = time.process_time
+except AttributeError:
+    wall_clock = time.time
+    cpu_clock = time.clock
+
+phases = ["load", "parse", "markdown", "pygments", "jinja", "write", "static"]
+
+
+def write_json(path, data):
+    if dirname(path) and not isdir(dirname(path)):
+        os.makedirs(dirname(path))
+    with open(path, 'w') as f:
+        json.dump(data, f, indent=2, sort_keys=True)
+
+
+class Frame:
+    __slots__ = ["phase", "key", "wall", "cpu", "child_wall", "child_cpu"]
+
+    def __init__(self, phase, key):
+        self.phase = phase
+        self.key = key
+        self.child_wall = 0.0
+        self.child_cpu = 0.0
+        self.wall = wall_clock()
+        self.cpu = cpu_clock()
+
+
+class Profiler:
+    """
+    Collects timings for a build. Use install() before loading the site and
+    uninstall() when the build is done.
+
+    phases -- {phase: [wall, cpu, count]}
+    pages -- {key: {phase: [wall, cpu]}}, where the key is a page filepath, a
+             static file path or, for writes, the path in output
+    templates -- {name: [wall, cpu, count]} for the Jinja phase
+    """
+
+    def __init__(self):
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.phases = {}
+        self.pages = {}
+        self.templates = {}
+        self.wrapped = []
+        self.started = None
+        self.finished = None
+
+    def stack(self):
+        if not hasattr(self.local, 'stack'):
+            self.local.stack = []
+        return self.local.stack
+
+    def enter(self, phase, key=None):
+        stack = self.stack()
+        if key is None and stack:
+            key = stack[-1].key  # Nested phases are charged to the same page
+        frame = Frame(phase, key)
+        stack.append(frame)
+        return frame
+
+    def exit(self, template=None):
+        wall = wall_clock()
+        cpu = cpu_clock()
+        stack = self.stack()
+        frame = stack.pop()
+        total_wall = wall - frame.wall
+        total_cpu = cpu - frame.cpu
+        if stack:
+            stack[-1].child_wall += total_wall
+            stack[-1].child_cpu += total_cpu
+        own_wall = total_wall - frame.child_wall
+        own_cpu = total_cpu - frame.child_cpu
+        with self.lock:
+            totals = self.phases.setdefault(frame.phase, [0.0, 0.0, 0])
+            totals[0] += own_wall
+            totals[1] += own_cpu
+            totals[2] += 1
+            if frame.key is not None:
+                page = self.pages.setdefault(frame.key, {})
+                times = page.setdefault(frame.phase, [0.0, 0.0])
+                times[0] += own_wall
+                times[1] += own_cpu
+            if template is not None:
+                times = self.templates.setdefault(template, [0.0, 0.0, 0])
+                times[0] += own_wall
+                times[1] += own_cpu
+                times[2] += 1
+
+    def wrap(self, owner, name, phase, key=None, template=None, kind=None):
+        """
+        Replace owner.name with a version that records its time as a phase.
+        key and template are functions that get the arguments of the call.
+        """
+        original = owner.__dict__[name] if isinstance(owner, type) else getattr(owner, name)
+        function = original
+        if kind is not None:
+            function = original.__func__
+
+        @functools.wraps(function)
+        def timed(*args, **kwargs):
+            self.enter(phase, key(*args, **kwargs) if key is not None else None)
+            try:
+                return function(*args, **kwargs)
+            finally:
+                self.exit(template(*args, **kwargs) if template is not None else None)
+        setattr(owner, name, kind(timed) if kind is not None else timed)
+        self.wrapped.append((owner, name, original))
+
+    def install(self, site_class, page_class):
+        """
+        Start timing the parts of a build done by these Site and Page classes
+        """
+        self.wrap(site_class, '__init__', 'load')
+        content = lambda filepath, site: relpath(filepath, os.path.join(site.root, 'content'))
+        self.wrap(page_class, 'parse_string', 'parse', kind=classmethod,
+                  key=lambda cls, filepath, site, text: content(filepath, site))
+        self.wrap(page_class, 'get_content', 'markdown', key=lambda page: page.filepath)
+        self.wrap(page_class, 'render', 'jinja', key=lambda page: page.filepath,
+                  template=lambda page: page.get_template_name())
+        self.wrap(site_class, 'write_file', 'write', key=lambda site, path, data: path)
+        self.wrap(site_class, 'copy_static', 'static',
+                  key=lambda site, path, stat=None: os.path.join('static', path))
+        try:
+            import markdown.extensions.codehilite as codehilite
+        except ImportError:
+            pass
+        else:
+            self.wrap(codehilite, 'highlight', 'pygments')
+        self.started = (wall_clock(), cpu_clock())
+
+    def uninstall(self):
+        """
+        Stop timing and put back everything we wrapped
+        """
+        self.finished = (wall_clock(), cpu_clock())
+        for owner, name, original in reversed(self.wrapped):
+            setattr(owner, name, original)
+        self.wrapped = []
+
+    def page_total(self, key):
+        times = self.pages[key].values()
+        return sum(wall for wall, _ in times), sum(cpu for _, cpu in times)
+
+    def report(self, top=10):
+        """
+        Get the timings as a dict, with the top slowest pages and templates
+        """
+        total = None
+        if self.started is not None and self.finished is not None:
+            total = {
+                "wall": self.finished[0] - self.started[0],
+                "cpu": self.finished[1] - self.started[1],
+            }
+        pages = sorted(self.pages, key=lambda key: (-self.page_total(key)[0], key))
+        templates = sorted(self.templates, key=lambda name: (-self.templates[name][0], name))
+        return {
+            "total": total,
+            "phases": dict((phase, {"wall": wall, "cpu": cpu, "count": count})
+                           for phase, (wall, cpu, count) in self.phases.items()),
+            "pages": dict((key, dict((phase, {"wall": wall, "cpu": cpu})
+                                     for phase, (wall, cpu) in times.items()))
+                          for key, times in self.pages.items()),
+            "templates": dict((name, {"wall": wall, "cpu": cpu, "count": count})
+                              for name, (wall, cpu, count) in self.templates.items()),
+            "slowest_pages": pages[:top],
+            "slowest_templates": templates[:top],
+        }
+
+    def write_json(self, path, top=10):
+        write_json(path, self.report(top))
+
+    def format(self, top=10):
+        """
+        Format the report as text for the terminal
+        """
+        report = self.report(top)
+        lines = []
+        if report["total"] is not None:
+            lines.append("Total: %.3fs wall, %.3fs CPU" % (report["total"]["wall"], report["total"]["cpu"]))
+            lines.append("")
+        lines.append("%-10s %10s %10s %8s" % ("Phase", "Wall (s)", "CPU (s)", "Calls"))
+        ordered = [phase for phase in phases if phase in report["phases"]]
+        ordered += sorted(phase for phase in report["phases"] if phase not in phases)
+        for phase in ordered:
+            times = report["phases"][phase]
+            lines.append("%-10s %10.3f %10.3f %8d" % (phase, times["wall"], times["cpu"], times["count"]))
+        if report["slowest_pages"]:
+            lines.append("")
+            lines.append("Slowest pages")
+            for key in report["slowest_pages"]:
+                wall, cpu = self.page_total(key)
+                detail = ", ".join("%s %.3f" % (phase, times["wall"])
+                                   for phase, times in sorted(report["pages"][key].items(),
+                                                              key=lambda item: -item[1]["wall"]))
+                lines.append("  %8.3fs  %s (%s)" % (wall, key, detail))
+        if report["slowest_templates"]:
+            lines.append("")
+            lines.append("Slowest templates (Jinja time only)")
+            for name in report["slowest_templates"]:
+                times = report["templates"][name]
+                lines.append("  %8.3fs  %s (%d renders)" % (times["wall"], name, times["count"]))
+        return "\n".join(lines)
+
+
+def peak_rss():
+    """
+    Get the most memory this process has used, in bytes, or None where we
+    can't tell
+    """
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        return peak  # Bytes on macOS, kilobytes everywhere else
+    return peak * 1024
+
+
+def human_size(size):
+    if abs(size) < 1024 * 1024:
+        return "%.1f KB" % (size / 1024)
+    return "%.1f MB" % (size / (1024 * 1024))
+
+
+class MemoryProfiler:
+    """
+    Records memory use at the end of each phase of a build, as reported to
+    site.metrics. Use install() before loading the site and uninstall() with
+    the site once the build is done.
+
+    phases -- A list with a dict for each phase boundary, in order: the memory
+              traced and the peak since the last boundary, the peak RSS, and
+              the lines that allocated the most memory during the phase
+    structures -- Bytes held by the site's caches and pages once the build
+                  is done. Pages drop their body and rendered HTML once they
+                  are written, so for those it is the most one page held
+                  before it was released, if that is more.
+    peaks -- The most one page held in its body and rendered HTML so far
+    """
+
+    def __init__(self, top=10):
+        self.top = top
+        self.phases = []
+        self.structures = {}
+        self.peaks = {"page_bodies": 0, "rendered_output": 0}
+        self.last = None
+        self.original = None
+        self.metrics_class = None
+        self.release = None
+        self.page_class = None
+
+    def install(self, metrics_class, page_class=None):
+        """
+        Start tracing allocations and take a snapshot whenever metrics_class
+        records the end of a phase. Pass page_class to measure what each page
+        holds before it is released.
+        """
+        import tracemalloc
+        tracemalloc.start()
+        self.last = self.snapshot()
+        self.original = metrics_class.__dict__['record']
+        original = self.original
+        profiler = self
+
+        @functools.wraps(original)
+        def record(metrics, name, seconds):
+            original(metrics, name, seconds)
+            profiler.boundary(name)
+        metrics_class.record = record
+        self.metrics_class = metrics_class
+        if page_class is not None:
+            self.release = page_class.__dict__['release']
+            release = self.release
+
+            @functools.wraps(release)
+            def measured(page):
+                profiler.held(page)
+                release(page)
+            page_class.release = measured
+            self.page_class = page_class
+
+    def held(self, page):
+        """
+        Note how much a page is holding on to, just before it is released
+        """
+        body = sys.getsizeof(page._body) if page._body is not None else 0
+        rendered = sum(sys.getsizeof(data) for data in [page.rendered, page.content] if data is not None)
+        self.peaks["page_bodies"] = max(self.peaks["page_bodies"], body)
+        self.peaks["rendered_output"] = max(self.peaks["rendered_output"], rendered)
+
+    def snapshot(self):
+        import tracemalloc
+        # Leave out the memory used by tracemalloc itself
+        return tracemalloc.take_snapshot().filter_traces([
+            tracemalloc.Filter(False, tracemalloc.__file__),
+            tracemalloc.Filter(False, "<frozen importlib._bootstrap>"),
+        ])
+
+    def boundary(self, phase):
+        """
+        Record what changed since the last phase ended
+        """
+        import tracemalloc
+        current, peak = tracemalloc.get_traced_memory()
+        snapshot = self.snapshot()
+        if hasattr(tracemalloc, 'reset_peak'):
+            # Don't count the snapshot in the next phase's peak
+            tracemalloc.reset_peak()
+        top = []
+        for stat in snapshot.compare_to(self.last, 'lineno')[:self.top]:
+            frame = stat.traceback[0]
+            top.append({
+                "file": frame.filename,
+                "line": frame.lineno,
+                "size": stat.size,
+                "size_diff": stat.size_diff,
+                "count_diff": stat.count_diff,
+            })
+        self.phases.append({
+            "phase": phase,
+            "traced": current,
+            "traced_peak": peak,
+            "rss_peak": peak_rss(),
+            "top": top,
+        })
+        self.last = snapshot
+
+    def measure(self, site):
+        """
+        Estimate how many bytes the site's structures are holding on to
+        """
+        cache = site.cache
+        pages = list(site.pagedata.values())
+        compiled = 0
+        for stat in self.last.statistics('filename'):
+            if 'jinja2' in stat.traceback[0].filename:
+                compiled += stat.size
+        self.structures = {
+            "cache_files": sum(sys.getsizeof(data) for data in cache.files.values()) +
+                           sum(sys.getsizeof(data) for data in cache.templates.values()),
+            "page_bodies": max(self.peaks["page_bodies"],
+                               sum(sys.getsizeof(page._body) for page in pages if page._body is not None)),
+            "rendered_output": max(self.peaks["rendered_output"],
+                                   sum(sys.getsizeof(page.rendered) for page in pages
+                                       if page.rendered is not None) +
+                                   sum(sys.getsizeof(page.content) for page in pages
+                                       if page.content is not None)),
+            # Allocations made by Jinja, which are mostly compiled templates
+            "compiled_templates": compiled,
+            "compiled_template_count": len(site.renderer.cache) if site.renderer.cache is not None else 0,
+        }
+        return self.structures
+
+    def uninstall(self, site=None):
+        """
+        Stop tracing. Pass the site to measure its structures first.
+        """
+        import tracemalloc
+        if site is not None:
+            self.measure(site)
+        self.metrics_class.record = self.original
+        if self.page_class is not None:
+            self.page_class.release = self.release
+        tracemalloc.stop()
+
+    def report(self):
+        return {
+            "rss_peak": peak_rss(),
+            "phases": self.phases,
+            "structures": self.structures,
+        }
+
+    def write_json(self, path):
+        write_json(path, self.report())
+
+    def format(self):
+        """
+        Format the report as text for the terminal
+        """
+        lines = []
+        rss = peak_rss()
+        if rss is not None:
+            lines.append("Peak RSS: %s" % human_size(rss))
+        for phase in self.phases:
+            lines.append("")
+            lines.append("%s: %s traced, %s peak" % (phase["phase"], human_size(phase["traced"]),
+                                                    human_size(phase["traced_peak"])))
+            for item in phase["top"]:
+                lines.append("  %+10.1f KB  %s:%d" % (item["size_diff"] / 1024, item["file"], item["line"]))
+        if self.structures:
+            lines.append("")
+            lines.append("Held by the site (pages: the most one page held)")
+            for name in ["cache_files", "page_bodies", "rendered_output", "compiled_templates"]:
+                lines.append("  %-20s %s" % (name, human_size(self.structures[name])))
+        return "\n".join(lines)
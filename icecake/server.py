@@ -0,0 +1,166 @@
+# -*- coding: utf8 -*-
+"""
+A small HTTP server for previewing the output of a site.
+
+The server answers /__icecake/stats itself, with JSON describing the requests
+it has served and, in preview mode, how long rebuilds take.
+"""
+from __future__ import absolute_import, division, print_function, unicode_literals
+import platform
+import io
+import json
+import logging
+import os
+from os.path import abspath, join, relpath
+import threading
+import time
+
+
+from . import cli
+from .metrics import Histogram
+if platform.python_version_tuple()[0] == '2':
+    from SimpleHTTPServer import SimpleHTTPRequestHandler
+    from SocketServer import TCPServer
+else:
+    from http.server import SimpleHTTPRequestHandler
+    from socketserver import TCPServer
+
+
+__metaclass__ = type
+
+# URLs under this path are answered by icecake instead of served from output
+reserved = '/__icecake/'
+
+
+class RequestStats:
+    """
+    Counts the requests the server handled and how long they took
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.started = time.time()
+        self.statuses = {}
+        self.latency = Histogram()
+
+    def record(self, status, seconds):
+        with self.lock:
+            self.statuses[status] = self.statuses.get(status, 0) + 1
+        self.latency.observe(seconds)
+
+    def to_dict(self):
+        with self.lock:
+            statuses = dict(self.statuses)
+        return {
+            "uptime_seconds": time.time() - self.started,
+            "count": sum(statuses.values()),
+            "statuses": statuses,
+            "latency_seconds": self.latency.to_dict(),
+        }
+
+
+class HTTPHandler(SimpleHTTPRequestHandler):
+    root = None
+    preview = None
+    stats = None
+    status = None
+
+    def handle_one_request(self):
+        start = time.time()
+        if platform.python_version_tuple()[0] == '2':
+            SimpleHTTPRequestHandler.handle_one_request(self)
+        else:
+            super().handle_one_request()
+        # The status is only set if a request was read and answered
+        if self.status is not None and self.stats is not None:
+            self.stats.record(str(int(self.status)), time.time() - start)
+        self.status = None
+
+    def send_stats(self):
+        """
+        Answer /__icecake/stats with the server's stats as JSON
+        """
+        data = {}
+        if self.stats is not None:
+            data["requests"] = self.stats.to_dict()
+        if self.preview is not None:
+            data["preview"] = self.preview.stats()
+        body = json.dumps(data, indent=2, sort_keys=True).encode('utf-8')
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.send_header("Cache-Control", "no-store")
+        self.end_headers()
+        return io.BytesIO(body)
+
+    def send_head(self):
+        if self.path.startswith(reserved):
+            if self.path.split('?')[0] == reserved + 'stats':
+                return self.send_stats()
+            self.send_error(404, "Not Found")
+            return None
+        # In preview mode the page may not have been rendered yet
+        if self.preview is not None:
+            self.preview.ensure(self.path)
+        if platform.python_version_tuple()[0] == '2':
+            return SimpleHTTPRequestHandler.send_head(self)
+        return super().send_head()
+
+    def translate_path(self, path):
+        if platform.python_version_tuple()[0] == '2':
+            path = SimpleHTTPRequestHandler.translate_path(self, path)
+        else:
+            path = super().translate_path(path)
+        # The base class maps URLs onto the current directory, so we move the
+        # path under the directory we are serving instead.
+        path = abspath(join(self.root, relpath(path, os.getcwd())))
+        return path
+
+    def log_request(self, code='-', size='-'):
+        self.status = code
+        # Don't log HEAD requests because these are very spammy with livejs turned on
+        if self.command == 'HEAD':
+            return
+        if platform.python_version_tuple()[0] == '2':
+            SimpleHTTPRequestHandler.log_request(self, code, size)
+        else:
+            super().log_request(code, size)
+
+
+class HTTPServer(TCPServer):
+    def server_activate(self):
+        cli.ui('Server started successfully')
+        logging.debug('Listening on http://%s:%s/' % self.server_address)
+        if platform.python_version_tuple()[0] == '2':
+            TCPServer.server_activate(self)
+        else:
+            super().server_activate()
+
+
+class Server:
+    """
+    Serve the files in a directory. This doesn't load or build the site, so it
+    starts right away. With a preview, pages are rendered when they are
+    requested.
+    """
+    def __init__(self, root, preview=None):
+        self.root = abspath(root)
+        self.preview = preview
+
+    def serve(self, address, port):
+        HTTPHandler.root = self.root
+        HTTPHandler.preview = self.preview
+        HTTPHandler.stats = RequestStats()
+        cli.ui('Starting server on http://%s:%s/' % (address, port))
+        cli.ui('HEAD requests are omitted from the logs')
+        while True:
+            try:
+
+                httpd = HTTPServer((address, port), HTTPHandler)
+                httpd.serve_forever()
+            except OSError:
+                cli.ui('ERROR: Listen socket is busy; will retry in 5 seconds')
+                time.sleep(5)
+            except KeyboardInterrupt:
+                httpd.shutdown()
+                break
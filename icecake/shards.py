@@ -0,0 +1,146 @@
+# -*- coding: utf8 -*-
+"""
+Sharded builds.
+
+A large site can be built by N independent processes or machines. Every shard
+loads the whole site, so queries like site.pages() see every page, but each
+shard only renders the pages and copies the static files that belong to it.
+Pages are assigned by a checksum of their path, so every machine agrees on the
+split without talking to the others.
+
+Each shard writes its output folder plus a manifest of the files it wrote.
+merge() combines the shard folders into one output folder, and refuses to do
+so if two shards wrote different files to the same path.
+"""
+from __future__ import absolute_import, division, print_function, unicode_literals
+import json
+import logging
+import os
+from os.path import dirname, isdir, isfile, join
+import zlib
+
+
+__metaclass__ = type
+
+manifest_name = '.icecake-shard.json'
+version = 1
+
+
+class MergeError(Exception):
+    pass
+
+
+def parse_shard(text):
+    """
+    Parse a shard spec like "2/4" into (2, 4). Shards are numbered from 1.
+    """
+    try:
+        index, count = [int(part) for part in text.split('/')]
+    except ValueError:
+        raise ValueError('Invalid shard %s; expected INDEX/COUNT, like 1/4' % text)
+    if count < 1 or not 1 <= index <= count:
+        raise ValueError('Invalid shard %s; expected 1 <= INDEX <= COUNT' % text)
+    return index, count
+
+
+def shard_of(path, count):
+    """
+    Get the 1-based shard for a path. We use crc32 rather than hash() since
+    hash() is randomized per process.
+    """
+    key = path.replace(os.sep, '/').encode('utf-8')
+    return (zlib.crc32(key) & 0xffffffff) % count + 1
+
+
+def build(site, index, count):
+    """
+    Render this shard's pages and copy its static files into the site's
+    output folder, then write the shard manifest. Returns the manifest.
+    """
+    site.clean_output()
+    site.outputs = {}
+    site.render_pages(page for filepath, page in sorted(site.pagedata.items())
+                      if shard_of(filepath, count) == index)
+    for source, stat in site.scan('static'):
+        if shard_of(join('static', source), count) == index:
+            site.copy_static(source, stat)
+    manifest = {
+        'version': version,
+        'shard': index,
+        'shards': count,
+        'files': dict((path.replace(os.sep, '/'), value) for path, value in site.outputs.items()),
+    }
+    site.outputs = None
+    site.output.write(manifest_name, json.dumps(manifest, indent=2, sort_keys=True).encode('utf-8'))
+    return manifest
+
+
+def load_manifest(folder):
+    path = join(folder, manifest_name)
+    if not isfile(path):
+        raise MergeError('%s is not a shard; %s is missing' % (folder, manifest_name))
+    with open(path) as f:
+        manifest = json.load(f)
+    if manifest.get('version') != version:
+        raise MergeError('%s was built by a different version of icecake' % folder)
+    return manifest
+
+
+def merge(folders, output, site_root=None, manifest_path=None):
+    """
+    Combine the output of every shard into the output folder, replacing
+    whatever was there. Raises MergeError if a shard is missing or repeated,
+    or if two shards wrote different content to the same file. Nothing is
+    written unless the shards can be merged. Pass site_root when merging into
+    a site's folder; see outputs.clean_folder. Pass manifest_path to save the
+    manifest of the merged output there, using the hashes the shards took.
+    """
+    output = os.path.abspath(output)
+    if output in [os.path.abspath(folder) for folder in folders]:
+        raise MergeError('Merge into a new folder; %s is one of the shards' % output)
+    manifests = [(folder, load_manifest(folder)) for folder in folders]
+    counts = set(manifest['shards'] for _, manifest in manifests)
+    if len(counts) != 1:
+        raise MergeError('The shards were built with different shard counts: %s' %
+                         ', '.join(str(count) for count in sorted(counts)))
+    count = counts.pop()
+    seen = {}
+    for folder, manifest in manifests:
+        if manifest['shard'] in seen:
+            raise MergeError('Shard %d/%d appears twice: %s and %s' %
+                             (manifest['shard'], count, seen[manifest['shard']], folder))
+        seen[manifest['shard']] = folder
+    missing = [str(index) for index in range(1, count + 1) if index not in seen]
+    if missing:
+        raise MergeError('Missing shards %s of %d' % (', '.join(missing), count))
+
+    owners = {}
+    conflicts = []
+    for folder, manifest in sorted(manifests, key=lambda item: item[1]['shard']):
+        for path, value in sorted(manifest['files'].items()):
+            if path not in owners:
+                owners[path] = (folder, value)
+            elif owners[path][1] != value:
+                conflicts.append('%s (%s and %s)' % (path, owners[path][0], folder))
+    if conflicts:
+        raise MergeError('Shards wrote different files to the same path:\n  %s' %
+                         '\n  '.join(conflicts))
+
+    from .outputs import OutputError, clean_folder, copy_file
+    try:
+        clean_folder(output, site_root)
+    except OutputError as e:
+        raise MergeError(str(e))
+    for path, (folder, _) in sorted(owners.items()):
+        target = join(output, *path.split('/'))
+        if not isdir(dirname(target)):
+            os.makedirs(dirname(target))
+        copy_file(join(folder, *path.split('/')), target)
+    if manifest_path is not None:
+        from .manifest import Manifest
+        merged = Manifest()
+        for path, (_, sha1) in owners.items():
+            merged.add(path, os.stat(join(output, *path.split('/'))).st_size, sha1)
+        merged.save(manifest_path)
+    logging.debug('Merged %d files from %d shards into %s', len(owners), count, output)
+    return sorted(owners)
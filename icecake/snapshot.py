@@ -0,0 +1,146 @@
+# -*- coding: utf8 -*-
+"""
+Warm-start snapshots of a parsed site.
+
+After a build we save what we learned about the site: the metadata and output
+target of every page, the templates each template references, and the size and
+mtime of every source file. The next time the site is loaded we compare the
+files on disk against the snapshot and only parse and render what changed.
+
+Converted markdown is kept separately in a fragment cache, one file per
+fragment, so it can be reused without holding every page's HTML in memory.
+"""
+from __future__ import absolute_import, division, print_function, unicode_literals
+import hashlib
+import logging
+import os
+from os.path import dirname, isdir, isfile, join
+import pickle
+
+
+__metaclass__ = type
+
+
+def digest(text):
+    """Get a fingerprint for a string"""
+    return hashlib.sha1(text.encode('utf-8')).hexdigest()
+
+
+def file_digest(path):
+    """Get the same fingerprint as digest() for the contents of a file"""
+    sha1 = hashlib.sha1()
+    with open(path, mode='rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            sha1.update(chunk)
+    return sha1.hexdigest()
+
+
+class SnapshotUnpickler(pickle.Unpickler):
+    """
+    Snapshots only hold dicts, lists, tuples, sets and strings, so refuse to
+    load anything else. The snapshot may come from an imported cache, and a
+    pickle could otherwise run any code it likes.
+    """
+    allowed = set([('builtins', 'set'), ('builtins', 'frozenset'),
+                   ('__builtin__', 'set'), ('__builtin__', 'frozenset')])
+
+    def find_class(self, module, name):
+        if (module, name) not in self.allowed:
+            raise pickle.UnpicklingError("%s.%s is not allowed in a snapshot" % (module, name))
+        return pickle.Unpickler.find_class(self, module, name)
+
+
+class Snapshot:
+    """
+    The parsed state of a site at the end of a build.
+
+    pages -- {filepath: record} where record has the page metadata plus the
+             "stat" (mtime, size) of the source and the output "target"
+    templates -- {name: (digest, referenced templates, uses site)}
+    static -- {path: (mtime, size)} for files under static
+    outputs -- {path: (size, sha1)} for files in output, for the manifest
+    preview_mode -- Whether the pages were rendered with livejs
+    """
+    version = 2
+
+    def __init__(self, path):
+        self.path = path
+        self.pages = {}
+        self.templates = {}
+        self.static = {}
+        self.outputs = {}
+        self.preview_mode = None
+
+    @classmethod
+    def load(cls, path):
+        """
+        Load a snapshot from disk. If there is no snapshot, or it can't be
+        read, we return an empty snapshot and the site is built from scratch.
+        """
+        snapshot = cls(path)
+        if not isfile(path):
+            return snapshot
+        try:
+            with open(path, mode='rb') as f:
+                data = SnapshotUnpickler(f).load()
+        except Exception as e:
+            logging.warning("Ignoring unreadable snapshot %s: %s", path, e)
+            return snapshot
+        if not isinstance(data, dict) or data.get('version') != cls.version:
+            logging.debug("Ignoring snapshot %s from another version", path)
+            return snapshot
+        snapshot.pages = data['pages']
+        snapshot.templates = data['templates']
+        snapshot.static = data['static']
+        snapshot.outputs = data['outputs']
+        snapshot.preview_mode = data['preview_mode']
+        return snapshot
+
+    def save(self):
+        """
+        Write the snapshot. We write to a temporary file and rename it so an
+        interrupted write never leaves a truncated snapshot behind.
+        """
+        if not isdir(dirname(self.path)):
+            os.makedirs(dirname(self.path))
+        data = {
+            'version': self.version,
+            'pages': self.pages,
+            'templates': self.templates,
+            'static': self.static,
+            'outputs': self.outputs,
+            'preview_mode': self.preview_mode,
+        }
+        temp = self.path + '.tmp'
+        with open(temp, mode='wb') as f:
+            pickle.dump(data, f, protocol=2)
+        os.rename(temp, self.path)
+
+
+class Fragments:
+    """
+    A cache of converted markdown, keyed by a digest of the source text and
+    the markdown configuration that was used to convert it.
+    """
+
+    def __init__(self, root):
+        self.root = root
+
+    def filename(self, key):
+        return join(self.root, key[:2], key[2:] + '.html')
+
+    def get(self, key):
+        filename = self.filename(key)
+        if not isfile(filename):
+            return None
+        with open(filename, mode='rb') as f:
+            return f.read().decode('utf-8')
+
+    def set(self, key, content):
+        filename = self.filename(key)
+        if not isdir(dirname(filename)):
+            os.makedirs(dirname(filename))
+        temp = filename + '.tmp'
+        with open(temp, mode='wb') as f:
+            f.write(content.encode('utf-8'))
+        os.rename(temp, filename)
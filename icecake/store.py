@@ -0,0 +1,211 @@
+# -*- coding: utf8 -*-
+"""
+A page store backed by a local SQLite file.
+
+The store keeps page metadata in indexed columns so very large sites can answer
+site.pages() and site.tags() with queries instead of scanning every page. It
+also remembers the size and mtime of each source file, along with its body and
+converted markdown, so unchanged pages don't have to be read or parsed again
+the next time the site is loaded.
+"""
+from __future__ import absolute_import, division, print_function, unicode_literals
+import os
+from os.path import dirname, isdir
+import sqlite3
+import threading
+
+
+__metaclass__ = type
+
+schema = """
+CREATE TABLE IF NOT EXISTS pages (
+    filepath TEXT PRIMARY KEY,
+    mtime REAL,
+    size INTEGER,
+    url TEXT,
+    slug TEXT,
+    title TEXT,
+    date TEXT,
+    published TEXT,
+    template TEXT,
+    body TEXT,
+    content TEXT,
+    content_key TEXT
+);
+CREATE TABLE IF NOT EXISTS tags (
+    tag TEXT,
+    filepath TEXT,
+    PRIMARY KEY (tag, filepath)
+);
+CREATE INDEX IF NOT EXISTS pages_published ON pages (published);
+CREATE INDEX IF NOT EXISTS pages_title ON pages (title);
+CREATE INDEX IF NOT EXISTS tags_filepath ON tags (filepath);
+"""
+
+
+class PageStore:
+    """
+    Stores page metadata and cached fragments for a site. Pages are keyed by
+    their filepath relative to content, the same as Site.pagedata.
+    """
+    version = 2
+    # Fields that can be used to order queries, and the column that holds them
+    columns = {
+        "date": "published",
+        "published": "published",
+        "title": "title",
+        "slug": "slug",
+        "url": "url",
+        "filepath": "filepath",
+        "template": "template",
+    }
+
+    def __init__(self, path):
+        self.path = path
+        if not isdir(dirname(path)):
+            os.makedirs(dirname(path))
+        # The preview server renders pages from other threads, so we share one
+        # connection and serialize access to it ourselves.
+        self.lock = threading.RLock()
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        with self.lock:
+            version = self.db.execute("PRAGMA user_version").fetchone()[0]
+            if version != self.version:
+                self.db.executescript("DROP TABLE IF EXISTS pages; DROP TABLE IF EXISTS tags;")
+                self.db.execute("PRAGMA user_version = %d" % self.version)
+            self.db.executescript(schema)
+
+    def stats(self):
+        """
+        Get the (mtime, size) of every stored page, keyed by filepath
+        """
+        with self.lock:
+            rows = self.db.execute("SELECT filepath, mtime, size FROM pages")
+            return dict((row[0], (row[1], row[2])) for row in rows)
+
+    def records(self):
+        """
+        Yield the stored metadata for every page as a dict
+        """
+        with self.lock:
+            tags = {}
+            for tag, filepath in self.db.execute("SELECT tag, filepath FROM tags ORDER BY rowid"):
+                tags.setdefault(filepath, []).append(tag)
+            rows = self.db.execute("SELECT filepath, slug, title, date, template FROM pages")
+            rows = rows.fetchall()
+        for filepath, slug, title, date, template in rows:
+            yield {
+                "filepath": filepath,
+                "slug": slug,
+                "title": title,
+                "date": date,
+                "template": template,
+                "tags": tags.get(filepath, []),
+            }
+
+    def put(self, page, mtime, size, body=None):
+        """
+        Store the metadata for a page, replacing anything we had for it before.
+        Cached content is dropped since the page has changed.
+        """
+        published = None
+        if page.published is not None:
+            published = page.published.isoformat()
+        with self.lock:
+            self.db.execute("DELETE FROM tags WHERE filepath = ?", (page.filepath,))
+            self.db.execute(
+                "INSERT OR REPLACE INTO pages "
+                "(filepath, mtime, size, url, slug, title, date, published, template, body, content, content_key) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, NULL, NULL)",
+                (page.filepath, mtime, size, page.url, page.slug, page.title, page.date,
+                 published, page.template, body))
+            seen = set()
+            for tag in page.tags or []:
+                if tag in seen:
+                    continue
+                seen.add(tag)
+                self.db.execute("INSERT INTO tags (tag, filepath) VALUES (?, ?)",
+                                (tag, page.filepath))
+
+    def restat(self, filepath, mtime, size):
+        """
+        Record a new mtime and size for a page whose source didn't change,
+        like after a checkout touched it
+        """
+        with self.lock:
+            self.db.execute("UPDATE pages SET mtime = ?, size = ? WHERE filepath = ?",
+                            (mtime, size, filepath))
+
+    def delete(self, filepath):
+        with self.lock:
+            self.db.execute("DELETE FROM pages WHERE filepath = ?", (filepath,))
+            self.db.execute("DELETE FROM tags WHERE filepath = ?", (filepath,))
+
+    def get_body(self, filepath):
+        with self.lock:
+            row = self.db.execute("SELECT body FROM pages WHERE filepath = ?",
+                                  (filepath,)).fetchone()
+        if row is None:
+            return None
+        return row[0]
+
+    def get_content(self, filepath, key):
+        """
+        Get the converted markdown for a page, if it was converted with the
+        configuration described by key
+        """
+        with self.lock:
+            row = self.db.execute("SELECT content FROM pages WHERE filepath = ? AND content_key = ?",
+                                  (filepath, key)).fetchone()
+        if row is None:
+            return None
+        return row[0]
+
+    def set_content(self, filepath, content, key):
+        with self.lock:
+            self.db.execute("UPDATE pages SET content = ?, content_key = ? WHERE filepath = ?",
+                            (content, key, filepath))
+
+    def query(self, path=None, tag=None, limit=None, order=None):
+        """
+        Get the filepaths of the pages matching a query. This has the same
+        semantics as Site.pages() and raises KeyError if the order is not an
+        indexed field.
+        """
+        sql = "SELECT pages.filepath FROM pages"
+        where = []
+        args = []
+        if tag is not None:
+            sql += " JOIN tags ON tags.filepath = pages.filepath AND tags.tag = ?"
+            args.append(tag)
+        if path is not None:
+            # A range is equivalent to startswith() but can use the index
+            where.append("pages.filepath >= ? AND pages.filepath < ?")
+            args.extend([path, path + "\uffff"])
+        if where:
+            sql += " WHERE " + " AND ".join(where)
+        if order is not None:
+            direction = "ASC"
+            if order[0] == "-":
+                direction = "DESC"
+                order = order[1:]
+            sql += " ORDER BY pages.%s %s, pages.filepath" % (self.columns[order], direction)
+        else:
+            sql += " ORDER BY pages.filepath"
+        if limit is not None and limit > 0:
+            sql += " LIMIT %d" % limit
+        with self.lock:
+            return [row[0] for row in self.db.execute(sql, args)]
+
+    def tags(self):
+        with self.lock:
+            return [row[0] for row in self.db.execute("SELECT DISTINCT tag FROM tags ORDER BY tag")]
+
+    def commit(self):
+        with self.lock:
+            self.db.commit()
+
+    def close(self):
+        with self.lock:
+            self.db.commit()
+            self.db.close()
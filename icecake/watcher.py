@@ -0,0 +1,328 @@
+# -*- coding: utf8 -*-
+"""
+Watch a site for changes and rebuild the affected pages.
+
+File system events can be lost: the kernel drops them when its queue
+overflows, and some changes (like moving a folder into the site) arrive as a
+single event for many files. When we may have missed something we rescan the
+site, comparing the size and mtime of every file against what we loaded, and
+rebuild whatever differs. We also rescan every so often just in case.
+
+Static files are only copied once they stop changing, so a large file that is
+still being written is not copied over and over, or published half-written.
+"""
+from __future__ import absolute_import, division, print_function, unicode_literals
+import logging
+import os
+from os.path import isfile, join, relpath, splitext
+import threading
+import time
+
+
+import watchdog.observers
+import watchdog.events
+
+
+from . import cli
+from .preview import RebuildQueue
+
+
+__metaclass__ = type
+
+
+class Handler(watchdog.events.FileSystemEventHandler):
+    site = None
+    # Pages are rendered by the queue's worker thread, not by the observer
+    queue = None
+    # The watcher is told when we may have missed events
+    watcher = None
+    # We read files while rendering, so we ignore the events that causes
+    reads = ['opened', 'closed_no_write']
+
+    def dispatch(self, event):
+        # Editors often save by renaming a temporary file over the original,
+        # so a move into the site counts even if the source is ignored.
+        paths = [event.src_path, getattr(event, 'dest_path', None) or event.src_path]
+        if all(self.site.is_ignored(path) for path in paths):
+            return
+        if event.event_type in self.reads:
+            return
+        if event.event_type != 'closed':
+            self.watcher.events += 1
+        if event.is_directory and event.event_type != watchdog.events.EVENT_TYPE_MODIFIED:
+            # Files in a folder that is created or moved here may not get
+            # events of their own
+            self.watcher.request_rescan('%s folder %s' % (event.event_type, event.src_path))
+        # The queue and the preview server render pages from their own
+        # threads, so we take turns with them.
+        with self.queue.lock:
+            try:
+                return super(Handler, self).dispatch(event)
+            except Exception:
+                logging.exception('Failed to handle %s', event)
+                self.watcher.request_rescan('an error')
+
+    def is_watched(self, path):
+        """
+        Whether we are watching this path at all. This guards against
+        triggering logic on the output folder or other folders the user may
+        have created here.
+        """
+        return self.site.is_content(path) or self.site.is_layout(path) or self.site.is_static(path)
+
+    def update(self, removed=(), added=()):
+        """
+        Bring the site up to date after files were removed, added or changed,
+        and queue the pages that have to be rendered again. Paths are relative
+        to the site root.
+        """
+        site = self.site
+        changed_pages = set()
+        changed_templates = set()
+        pages_changed = False
+        for path in removed:
+            if site.is_content(path):
+                filepath = relpath(path, 'content')
+                if site.remove_page(filepath) is not None:
+                    pages_changed = True
+                changed_templates.add(filepath)
+            elif site.is_layout(path):
+                site.cache.delete(path)
+                changed_templates.add(relpath(path, 'layouts'))
+            elif site.is_static(path):
+                self.watcher.settling.pop(relpath(path, 'static'), None)
+                site.remove_static(relpath(path, 'static'))
+        for path in added:
+            if not isfile(join(site.root, path)):
+                continue
+            if site.is_content(path):
+                filepath = relpath(path, 'content')
+                previous = site.cache.get(path)
+                data = site.cache.read(path)
+                if data == previous and filepath in site.pagedata:
+                    # Only the mtime changed. Remember it so a rescan doesn't
+                    # think the page changed.
+                    stat = os.stat(join(site.root, path))
+                    site.page_stats[filepath] = (stat.st_mtime, stat.st_size)
+                    continue
+                if splitext(path)[1] not in ['.md', '.markdown']:
+                    # HTML pages are templates too, and other pages may include them
+                    changed_templates.add(filepath)
+                page = cli.Page.parse_string(join(site.root, path), site, data)
+                site.add_page(page)
+                changed_pages.add(filepath)
+                pages_changed = True
+            elif site.is_layout(path):
+                if site.cache.get(path) != site.cache.read(path):
+                    changed_templates.add(relpath(path, 'layouts'))
+            elif site.is_static(path):
+                self.watcher.settle(relpath(path, 'static'))
+        if changed_pages or changed_templates:
+            pages = site.affected_pages(changed_pages, changed_templates, pages_changed)
+            self.queue.rebuild([page.filepath for page in pages])
+
+    def on_created(self, event):
+        path = self.site.relpath(event.src_path)
+        if not event.is_directory and self.is_watched(path):
+            logging.debug('Creation detected for %s', event.src_path)
+            self.update(added=[path])
+
+    def on_deleted(self, event):
+        # Deleted folders are handled by a rescan
+        path = self.site.relpath(event.src_path)
+        if not event.is_directory and self.is_watched(path):
+            logging.debug('Deletion detected for %s', event.src_path)
+            self.update(removed=[path])
+
+    def on_modified(self, event):
+        path = self.site.relpath(event.src_path)
+        if not event.is_directory and self.is_watched(path):
+            logging.debug('Change detected for %s', event.src_path)
+            self.update(added=[path])
+
+    def on_closed(self, event):
+        # Whoever was writing a static file is done with it, so we don't have
+        # to wait to see whether it is still changing
+        path = self.site.relpath(event.src_path)
+        if self.site.is_static(path):
+            self.watcher.copy_stable(relpath(path, 'static'))
+
+    def on_moved(self, event):
+        # The files in a moved folder get events of their own
+        if event.is_directory:
+            return
+        src = self.site.relpath(event.src_path)
+        dest = self.site.relpath(event.dest_path)
+        logging.debug('Move detected from %s to %s', event.src_path, event.dest_path)
+        # Moving a file to an ignored name, like an editor's backup, removes
+        # it, and moving an ignored file into place adds it
+        src_watched = self.is_watched(src) and not self.site.is_ignored(src)
+        dest_watched = self.is_watched(dest) and not self.site.is_ignored(dest)
+        if src_watched and dest_watched and self.site.is_static(src) and self.site.is_static(dest):
+            self.site.move_static(relpath(src, 'static'), relpath(dest, 'static'))
+            return
+        removed = [src] if src_watched else []
+        added = [dest] if dest_watched else []
+        self.update(removed=removed, added=added)
+
+
+class Watcher:
+    """
+    Watches a site and queues the pages affected by each change. In preview
+    mode the preview is the queue; otherwise we start a queue of our own.
+
+    A background thread rescans the site when we may have missed events, and
+    every interval seconds otherwise.
+    """
+    # Seconds between rescans when nothing went wrong
+    interval = 30
+    # How often we check whether a rescan is needed. We wait for a quiet
+    # period before rescanning, so we don't scan in the middle of a change.
+    tick = 1
+    # More events than this in one tick probably overflowed the event queue
+    burst = 1000
+    # Seconds a static file's size and mtime must stay the same before we
+    # copy it
+    stable = 1
+
+    def __init__(self, site, preview=None):
+        self.site = site
+        self.preview = preview
+        if preview is not None:
+            self.queue = preview
+        else:
+            self.queue = RebuildQueue(site)
+        Handler.site = site
+        Handler.queue = self.queue
+        Handler.watcher = self
+        self.events = 0
+        # Static files waiting to be copied: {path: ((mtime, size), checked)}
+        self.settling = {}
+        self.wakeup = threading.Event()
+        self.stopped = False
+        self.observer = None
+        self.thread = None
+
+    def request_rescan(self, reason):
+        logging.debug('Rescanning after %s', reason)
+        self.wakeup.set()
+
+    def settle(self, path, stat=None):
+        """
+        Copy a changed static file once it stops changing
+        """
+        if stat is None:
+            stat = os.stat(join(self.site.root, 'static', path))
+        self.settling[path] = ((stat.st_mtime, stat.st_size), time.time())
+
+    def copy_stable(self, path=None):
+        """
+        Copy the static files that haven't changed for a while. If a path is
+        given that file is copied right away, as long as it is waiting to be
+        copied.
+        """
+        now = time.time()
+        with self.queue.lock:
+            if path is not None:
+                paths = [path] if path in self.settling else []
+            else:
+                paths = [item for item, (_, checked) in self.settling.items()
+                         if now - checked >= self.stable]
+            for item in paths:
+                fingerprint = self.settling[item][0]
+                try:
+                    stat = os.stat(join(self.site.root, 'static', item))
+                except OSError:
+                    del self.settling[item]  # Deleted before we got to it
+                    continue
+                if path is None and (stat.st_mtime, stat.st_size) != fingerprint:
+                    self.settling[item] = ((stat.st_mtime, stat.st_size), now)
+                    continue
+                del self.settling[item]
+                self.site.copy_static(item, stat)
+
+    def rescan(self):
+        """
+        Bring the site up to date with the files on disk and queue the pages
+        that have to be rendered again
+        """
+        static = []
+        with self.queue.lock:
+            pages = self.site.rescan(static)
+            # A file that changed without us hearing about it may still be
+            # being written
+            for path, stat in static:
+                self.settle(path, stat)
+        if pages:
+            logging.debug('Rescan found %d pages to render', len(pages))
+            self.queue.rebuild(pages)
+        return pages
+
+    def reconcile(self):
+        """
+        Rescan the site when it was requested, after a burst of events, or
+        every interval seconds
+        """
+        pending = False
+        seen = self.events
+        last_scan = time.time()
+        while not self.stopped:
+            if self.wakeup.wait(self.tick):
+                self.wakeup.clear()
+                pending = True
+            if self.stopped:
+                break
+            if self.settling:
+                self.copy_stable()
+            count = self.events - seen
+            seen = self.events
+            if count > self.burst:
+                pending = True
+            if count and pending:
+                # Wait until things calm down
+                continue
+            if pending or time.time() - last_scan >= self.interval:
+                try:
+                    self.rescan()
+                except Exception:
+                    logging.exception('Failed to rescan %s', self.site.root)
+                pending = False
+                last_scan = time.time()
+
+    def start(self):
+        """
+        Start watching in the background and return the observer
+        """
+        obs = watchdog.observers.Observer()
+        obs.schedule(Handler(), join(self.site.root), recursive=True)
+        logging.debug('Watching for changes in %s' % self.site.root)
+        cli.ui('Watching for changes in %s' % self.site.root)
+        if self.preview is None:
+            self.queue.start()
+        obs.start()
+        self.observer = obs
+        self.thread = threading.Thread(target=self.reconcile)
+        self.thread.daemon = True
+        self.thread.start()
+        return obs
+
+    def stop(self):
+        self.stopped = True
+        self.wakeup.set()
+        self.observer.stop()
+        self.observer.join()
+        self.thread.join()
+        if self.preview is None:
+            self.queue.stop()
+
+    def watch(self):
+        self.start()
+        try:
+            while True:
+                time.sleep(1)
+        except KeyboardInterrupt:
+            pass
+        self.stop()
+        if self.site.snapshot is not None:
+            # Pages still in the queue haven't been rendered yet
+            self.site.save_snapshot(exclude=list(self.queue.queued))
@@ -0,0 +1,75 @@
+# -*- coding: utf8 -*-
+"""
+Write rendered pages on a pool of threads.
+
+Rendering is CPU work and writing is I/O, which can be slow on network and
+overlay filesystems. While a build renders the next page, writer threads
+write the pages it already rendered. The queue between them is bounded, so
+rendering waits when the writers fall behind instead of piling up pages in
+memory.
+"""
+from __future__ import absolute_import, division, print_function, unicode_literals
+import logging
+import threading
+
+
+__metaclass__ = type
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+
+class WriterPool:
+    """
+    Calls write(target, data) for each queued file on a pool of threads.
+    Errors are raised from close(), which waits for every queued write.
+
+    threads -- How many writer threads to start
+    pending -- How many files can wait to be written before write() blocks
+    """
+
+    def __init__(self, write, threads=4, pending=None):
+        self.write_file = write
+        if pending is None:
+            pending = threads * 4
+        self.queue = queue.Queue(maxsize=pending)
+        self.errors = []
+        self.threads = []
+        for _ in range(threads):
+            thread = threading.Thread(target=self.work)
+            thread.daemon = True
+            thread.start()
+            self.threads.append(thread)
+
+    def write(self, target, data):
+        """
+        Queue a file to be written. Blocks while the queue is full.
+        """
+        self.queue.put((target, data))
+
+    def work(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                return
+            target, data = item
+            try:
+                self.write_file(target, data)
+            except Exception as e:
+                logging.debug('Failed to write %s', target, exc_info=True)
+                self.errors.append(e)
+
+    def close(self):
+        """
+        Wait for the queued files to be written and stop the threads. Raises
+        the first error a writer ran into.
+        """
+        for _ in self.threads:
+            self.queue.put(None)
+        for thread in self.threads:
+            thread.join()
+        self.threads = []
+        if self.errors:
+            raise self.errors[0]
@@ -1,10 +1,15 @@
 from setuptools import setup, find_packages
 from codecs import open
+import re
+
+# icecake/__init__.py holds the version; read it without importing icecake
+with open('icecake/__init__.py', encoding="utf-8") as f:
+    version = re.search(r"^__version__ = '([^']+)'", f.read(), re.M).group(1)
 
 setup(
     # packaging information that is likely to be updated between versions
     name='icecake',
-    version='0.6.0',
+    version=version,
     packages=['icecake'],
     py_modules=['cli', 'templates', 'livejs'],
     entry_points='''
@@ -18,7 +23,6 @@ setup(
         'Pygments',
         'python-dateutil',
         'watchdog',
-        'Werkzeug',
     ],
 
     # pypy stuff that is not likely to change between versions
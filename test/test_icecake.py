@@ -1,8 +1,14 @@
 import pytest
-from icecake import cli
+import json
+import os
+import subprocess
+import sys
+from datetime import datetime
+from xml.etree import ElementTree
+from icecake import cli, outputs
 import jinja2
 from templates import templates
-from os.path import abspath, dirname, isdir, isfile, join
+from os.path import abspath, basename, dirname, isdir, isfile, join
 
 
 module_root = dirname(dirname(abspath(__file__)))
@@ -19,6 +25,51 @@ class TestFunctions:
             'd/e.css'
         ]
 
+    def test_scan(self, tmpdir):
+        for path in ['a.txt', 'd/e.css', '.git/config', 'd/.git/HEAD', '.a.txt.swp',
+                     'd/.DS_Store', 'b.md~']:
+            tmpdir.join(path).write('hello', ensure=True)
+        os.symlink(tmpdir.join('d').strpath, tmpdir.join('link').strpath)
+        items = cli.scan(tmpdir.strpath)
+        assert [path for path, _ in items] == ['a.txt', join('d', 'e.css')]
+        assert [stat.st_size for _, stat in items] == [5, 5]
+        # Nothing is ignored when we pass an empty list
+        assert len(cli.scan(tmpdir.strpath, ignore=[])) == 7
+
+    def test_parse_date(self):
+        assert cli.parse_date("2013-01-02") == datetime(2013, 1, 2)
+        assert cli.parse_date("2013-01-02 10:30") == datetime(2013, 1, 2, 10, 30)
+        # Falls back to dateutil for other formats
+        assert cli.parse_date("January 2, 2013") == datetime(2013, 1, 2)
+        # Timezones are normalized to UTC
+        assert cli.parse_date("2013-01-02T10:30:00+02:00") == datetime(2013, 1, 2, 8, 30)
+        assert cli.parse_date("not a date") is None
+        assert cli.parse_date(None) is None
+
+    def test_write_if_changed(self, tmpdir):
+        target = join(tmpdir.strpath, 'a', 'b.html')
+        assert outputs.write_if_changed(target, b'cake')
+        assert not outputs.write_if_changed(target, b'cake')
+        assert outputs.write_if_changed(target, b'pie')
+        assert open(target).read() == 'pie'
+
+    def test_copy_file_failure(self, tmpdir):
+        import hashlib
+
+        class Broken:
+            def update(self, data):
+                raise IOError('No space left on device')
+        tmpdir.join('a.css').write('body {}')
+        target = tmpdir.join('out', 'a.css')
+        target.dirpath().ensure(dir=True)
+        with pytest.raises(IOError):
+            outputs.copy_file(tmpdir.join('a.css').strpath, target.strpath, Broken())
+        assert os.listdir(target.dirpath().strpath) == []
+        sha1 = hashlib.sha1()
+        outputs.copy_file(tmpdir.join('a.css').strpath, target.strpath, sha1)
+        assert target.read() == 'body {}'
+        assert sha1.hexdigest() == hashlib.sha1(b'body {}').hexdigest()
+
 
 class TestContentCache:
     def test_read(self):
@@ -46,8 +97,11 @@ class TestContentCache:
         cache = cli.ContentCache(join(module_root, 'templates'))
         cache.set('content/pie.md', 'delicious')
         assert cache.get('content/pie.md') == 'delicious'
+        cache.set('content/pie.md', 'tasty')
+        assert cache.chars == 5
         cache.delete('content/pie.md')
         assert cache.get('content/pie.md') is None
+        assert cache.chars == 0
 
     def test_move(self):
         cache = cli.ContentCache(join(module_root, 'templates'))
@@ -55,6 +109,7 @@ class TestContentCache:
         cache.move('content/pie.md', 'content/cake.md')
         assert cache.get('content/pie.md') is None
         assert cache.get('content/cake.md') == 'delicious'
+        assert cache.chars == len('delicious')
 
         # Doesn't exist; no-op
         cache.move('nope', 'yep')
@@ -97,6 +152,7 @@ template = myfile.html
 
         assert page.title == "Some title"
         assert page.date == "2013-01-02"
+        assert page.published == datetime(2013, 1, 2)
         assert page.tags == ['pie', 'cake', 'chocolate']
         assert page.slug == "some-title"
         assert page.template == "myfile.html"
@@ -216,6 +272,27 @@ class TestSite:
         output = page.render()
         assert output == open(join(test_root, 'fixtures', 'render', 'hello-world.md.html')).read()
 
+    def test_pages_order_date(self):
+        site = cli.Site('.')
+        for name, date in [('a', '2016-04-10'), ('b', '2016-4-2'), ('c', '2015-12-31')]:
+            page = cli.Page('content/%s.md' % name, site)
+            page.parse_metadata('date = %s' % date)
+            site.pagedata[page.filepath] = page
+        assert [p.filepath for p in site.pages(order="date")] == ['c.md', 'b.md', 'a.md']
+        assert [p.filepath for p in site.pages(order="-date")] == ['a.md', 'b.md', 'c.md']
+        # Each distinct date string is parsed only once
+        assert set(site.dates.keys()) == set(['2016-04-10', '2016-4-2', '2015-12-31'])
+
+    def test_pages_order_undated(self):
+        site = cli.Site('.')
+        for name, date in [('a', '2016-04-10'), ('b', None), ('c', '2015-12-31'), ('d', None)]:
+            page = cli.Page('content/%s.md' % name, site)
+            if date is not None:
+                page.parse_metadata('date = %s' % date)
+            site.pagedata[page.filepath] = page
+        assert [p.filepath for p in site.pages(order="date")][2:] == ['c.md', 'a.md']
+        assert [p.filepath for p in site.pages(order="-date")][:2] == ['a.md', 'c.md']
+
     def test_build(self, tmpdir):
         site = cli.Site.initialize(tmpdir.strpath)
         assert isfile(join(site.root, 'content', 'articles.html'))
@@ -234,6 +311,38 @@ class TestSite:
             'tags/index.html'
         ]
 
+    def test_atom(self, tmpdir):
+        site = cli.Site.initialize(tmpdir.strpath)
+        feed = site.atom("My Site", "https://example.com/atom.xml", None,
+                         "https://example.com", "me", path="articles/", order="-date")
+        # Output only depends on the pages, so it is the same every time
+        assert feed == site.atom("My Site", "https://example.com/atom.xml", None,
+                                 "https://example.com", "me", path="articles/", order="-date")
+        ns = {'atom': 'http://www.w3.org/2005/Atom'}
+        root = ElementTree.fromstring(feed.encode('utf-8'))
+        assert root.find('atom:updated', ns).text == '2016-04-02T00:00:00Z'
+        entries = root.findall('atom:entry', ns)
+        assert len(entries) == 1
+        assert entries[0].find('atom:title', ns).text == 'Hello world!'
+        assert entries[0].find('atom:id', ns).text == 'https://example.com/articles/hello-world/'
+        assert '<p>' in entries[0].find('atom:content', ns).text
+
+        # Per-tag feeds and limits are passed through to pages()
+        feed = site.atom("My Site", None, None, "https://example.com", None, tag="nope")
+        assert ElementTree.fromstring(feed.encode('utf-8')).findall('atom:entry', ns) == []
+        feed = site.atom("My Site", None, None, "https://example.com", None, limit=1)
+        assert len(ElementTree.fromstring(feed.encode('utf-8')).findall('atom:entry', ns)) == 1
+
+    def test_rss(self, tmpdir):
+        site = cli.Site.initialize(tmpdir.strpath)
+        feed = site.rss("My Site", "https://example.com/rss.xml", "Things",
+                        "https://example.com", "me", path="articles/")
+        root = ElementTree.fromstring(feed.encode('utf-8'))
+        items = root.findall('channel/item')
+        assert len(items) == 1
+        assert items[0].find('pubDate').text == 'Sat, 02 Apr 2016 00:00:00 GMT'
+        assert items[0].find('link').text == 'https://example.com/articles/hello-world/'
+
     def test_clean_output(self, tmpdir):
         site = cli.Site.initialize(tmpdir.strpath)
         files = cli.ls_relative(site.root)
@@ -247,6 +356,721 @@ class TestSite:
         files = cli.ls_relative(site.root)
         assert 'output/index.html' not in files
 
+    def test_clean_unsafe_output(self, tmpdir, monkeypatch):
+        site = cli.Site.initialize(tmpdir.join('site').strpath)
+        monkeypatch.setenv('HOME', tmpdir.join('home').strpath)
+        for folder in [site.root, tmpdir.strpath, tmpdir.join('home').strpath]:
+            with pytest.raises(outputs.OutputError):
+                cli.Site(site.root, output=folder).build()
+        assert isfile(join(site.root, 'content', 'index.html'))
+
+        other = tmpdir.join('other')
+        other.join('notes.txt').write('mine', ensure=True)
+        with pytest.raises(outputs.OutputError):
+            cli.Site(site.root, output=other.strpath).build()
+        assert other.join('notes.txt').read() == 'mine'
+
+        # A folder we built into before can be emptied again
+        public = tmpdir.join('public').strpath
+        cli.Site(site.root, output=public).build()
+        cli.Site(site.root, output=public).build()
+        assert isfile(join(public, 'index.html'))
+        assert isfile(join(public, outputs.marker_name))
+
+
+class TestBuildOnly:
+    def test_closure(self, tmpdir, monkeypatch):
+        site = cli.Site.initialize(tmpdir.strpath)
+        tmpdir.join('content', 'notes', 'note.md').write(
+            'title = Note\ndate = 2016-04-01\n++++\nHello', ensure=True)
+        cli.Site(site.root, snapshot=True).build()
+        rendered = TestSnapshot().rendered(monkeypatch)
+
+        # The article listings only query articles/, so they are left alone
+        site = cli.Site(site.root, snapshot=True)
+        site.build(only=[join(site.root, 'content', 'notes')])
+        assert sorted(rendered) == ['notes/note.md', 'tags.html']
+
+        del rendered[:]
+        site.build(only=[join(site.root, 'content', 'articles', 'hello-world.md')])
+        assert sorted(rendered) == ['articles.html', 'articles/hello-world.md', 'atom.xml',
+                                    'index.html', 'tags.html']
+
+        del rendered[:]
+        site.build(only=['layouts/markdown.html', 'static/css/main.css'])
+        assert sorted(rendered) == ['articles/hello-world.md', 'notes/note.md']
+
+        with pytest.raises(ValueError):
+            site.build(only=['output'])
+
+
+class TestShards:
+    def test_merge(self, tmpdir):
+        from icecake import manifest, shards
+        site = cli.Site.initialize(tmpdir.strpath)
+        for i in range(20):
+            tmpdir.join('content', 'notes', '%d.md' % i).write(
+                'title = Note %d\ndate = 2016-04-01\n++++\nHello' % i, ensure=True)
+        site.build()
+        expected = dict((path, open(join(site.root, 'output', path), 'rb').read())
+                        for path in cli.ls_relative(join(site.root, 'output')))
+        full = manifest.load(site.manifest_path)
+
+        # Each shard is its own process, like it would be on its own machine
+        folders = [tmpdir.join('shard%d' % i).strpath for i in range(1, 4)]
+        processes = [subprocess.Popen([sys.executable, '-m', 'icecake.cli', 'build',
+                                       '--shard', '%d/3' % i, '--output', folder],
+                                      cwd=site.root, env=dict(os.environ, PYTHONPATH=module_root))
+                     for i, folder in enumerate(folders, 1)]
+        assert [process.wait() for process in processes] == [0, 0, 0]
+        assert all(len(cli.ls_relative(folder)) > 1 for folder in folders)
+        # Shards leave the site's manifest alone
+        assert manifest.load(site.manifest_path) == full
+
+        merged = tmpdir.join('merged').strpath
+        shards.merge(folders, merged, manifest_path=tmpdir.join('merged.json').strpath)
+        assert manifest.load(tmpdir.join('merged.json').strpath) == full
+        assert dict((path, open(join(merged, path), 'rb').read())
+                    for path in cli.ls_relative(merged) if path != outputs.marker_name) == expected
+        assert isfile(join(merged, outputs.marker_name))
+
+        with pytest.raises(shards.MergeError):
+            shards.merge(folders[:2], merged)
+
+        # Two shards writing different files to the same path is a conflict
+        other = folders[shards.shard_of('index.html', 3) % 3]
+        with open(join(other, 'index.html'), 'w') as f:
+            f.write('conflict')
+        shard = shards.load_manifest(other)
+        shard['files']['index.html'] = 'something else'
+        with open(join(other, shards.manifest_name), 'w') as f:
+            json.dump(shard, f)
+        with pytest.raises(shards.MergeError) as e:
+            shards.merge(folders, merged)
+        assert 'index.html' in str(e.value)
+
+
+class TestProfiling:
+    def test_report(self, tmpdir):
+        from icecake.profiling import Profiler
+        site = cli.Site.initialize(tmpdir.strpath)
+        tmpdir.join('content', 'code.md').write(
+            'title = Code\n++++\n```python\nprint("hello")\n```\n')
+        render = cli.Page.render
+        profiler = Profiler()
+        profiler.install(cli.Site, cli.Page)
+        try:
+            cli.Site(site.root).build()
+        finally:
+            profiler.uninstall()
+        assert cli.Page.render == render
+
+        report = profiler.report(top=2)
+        assert set(report['phases']) == set(['load', 'parse', 'markdown', 'pygments', 'jinja',
+                                             'write', 'static'])
+        assert set(report['pages']['code.md']) == set(['parse', 'markdown', 'pygments', 'jinja'])
+        assert set(report['pages']['code/index.html']) == set(['write'])
+        assert report['phases']['write']['count'] == 6
+        assert 'static/css/main.css' in report['pages']
+        assert 'markdown.html' in report['templates']
+        assert len(report['slowest_pages']) == 2
+        # Nested phases aren't counted twice. Writes run on other threads at
+        # the same time, so they are left out.
+        phases = sum(times['wall'] for phase, times in report['phases'].items() if phase != 'write')
+        assert phases <= report['total']['wall']
+
+        profiler.write_json(tmpdir.join('profile', 'profile.json').strpath)
+        with open(tmpdir.join('profile', 'profile.json').strpath) as f:
+            assert json.load(f)['templates'].keys() == report['templates'].keys()
+        assert 'Slowest templates' in profiler.format()
+
+    @pytest.mark.skipif(sys.version_info < (3, 4), reason="tracemalloc needs python 3.4")
+    def test_memory(self, tmpdir):
+        from icecake.metrics import Metrics
+        from icecake.profiling import MemoryProfiler
+        site = cli.Site.initialize(tmpdir.strpath)
+        record = Metrics.record
+        release = cli.Page.release
+        profiler = MemoryProfiler(top=3)
+        profiler.install(Metrics, cli.Page)
+        try:
+            site = cli.Site(site.root, snapshot=True)
+            site.build()
+        finally:
+            profiler.uninstall(site)
+        assert Metrics.record == record
+        assert cli.Page.release == release
+
+        report = profiler.report()
+        assert [phase['phase'] for phase in report['phases']] == [
+            'load', 'load', 'render', 'static', 'snapshot', 'build']
+        assert all(len(phase['top']) <= 3 for phase in report['phases'])
+        assert set(report['structures']) == set(['cache_files', 'page_bodies', 'rendered_output',
+                                                 'compiled_templates', 'compiled_template_count'])
+        assert report['structures']['compiled_template_count'] > 0
+        # Pages are released as they are written, but we saw what they held
+        assert report['structures']['page_bodies'] > 0
+        assert report['structures']['rendered_output'] > 0
+        assert 'Held by the site' in profiler.format()
+
+
+class TestExplain:
+    def test_explain(self, tmpdir):
+        from icecake import explain
+        site = cli.Site.initialize(tmpdir.strpath)
+        tmpdir.join('content', 'articles', 'hello-world.md').write(
+            '\n```python\nprint("hello")\n```\n', mode='a')
+        site = cli.Site(site.root)
+        page = site.pagedata['articles/hello-world.md']
+        for path in [join(site.root, 'content', 'articles', 'hello-world.md'), 'articles/hello-world.md',
+                     join(site.output_dir, 'articles', 'hello-world', 'index.html'),
+                     '/articles/hello-world/']:
+            assert explain.find_page(site, path) is page
+        assert explain.find_page(site, 'nope.md') is None
+
+        report = explain.explain(site, page)
+        assert report['output'] == join('articles', 'hello-world', 'index.html')
+        assert report['templates'] == [('basic.html', join('layouts', 'basic.html')),
+                                       ('markdown.html', join('layouts', 'markdown.html'))]
+        assert report['queries'] == []
+        assert report['code_blocks'] == 2
+        assert set(report['phases']) == set(['markdown', 'pygments', 'jinja'])
+        assert set((name, template) for name, template, _, _ in report['blocks']) == set(
+            [('title', 'markdown.html'), ('content', 'markdown.html')])
+        assert report['invalidated_by'] == [join('content', 'articles', 'hello-world.md'),
+                                            join('layouts', 'basic.html'), join('layouts', 'markdown.html')]
+
+        report = explain.explain(site, site.pagedata['articles.html'])
+        assert report['queries'] == [{'path': 'articles/', 'tag': None, 'limit': None, 'results': 1,
+                                      'matches': 1}]
+        assert report['invalidated_by'][-1] == 'adding, changing or removing pages under %s' % join(
+            'content', 'articles/')
+        assert 'site.pages(' in explain.format(report)
+
+        # The index lists the 5 most recent articles
+        for i in range(6):
+            tmpdir.join('content', 'articles', '%d.md' % i).write(
+                'title = Article %d\ndate = 2016-05-0%d\n++++\nWords' % (i, i + 1))
+        site = cli.Site(site.root)
+        report = explain.explain(site, site.pagedata['index.html'])
+        assert report['queries'] == [{'path': 'articles/', 'tag': None, 'limit': 5, 'results': 5,
+                                      'matches': 7}]
+        assert 'limit=5): 5 of 7 pages' in explain.format(report)
+        assert 'pages' not in site.__dict__
+
+
+class TestMetrics:
+    def test_build(self, tmpdir):
+        site = cli.Site.initialize(tmpdir.strpath)
+        site = cli.Site(site.root, snapshot=True)
+        site.build()
+        counters = site.metrics.values
+        assert counters['pages'] == counters['pages_rendered'] == counters['files_written'] == 5
+        assert counters['pages_skipped'] == 0
+        assert counters['static_copied'] == 2
+        assert counters['bytes_written'] == sum(
+            os.path.getsize(join(site.root, 'output', path))
+            for path in cli.ls_relative(join(site.root, 'output')) if not path.startswith('css'))
+        assert counters['markdown_converted'] == 1
+        assert set(['load', 'render', 'static', 'snapshot', 'build']) <= set(site.metrics.phases)
+
+        tmpdir.join('content', 'articles', 'hello-world.md').write('\nMore', mode='a')
+        site = cli.Site(site.root, snapshot=True)
+        site.build(incremental=True)
+        counters = site.metrics.values
+        assert counters['pages_parsed'] == 1 and counters['pages_reused'] == 4
+        assert counters['pages_rendered'] + counters['pages_skipped'] == 5
+        assert counters['static_copied'] == 0 and counters['static_skipped'] == 2
+
+        site.metrics.write_json(tmpdir.join('metrics', 'build.json').strpath)
+        with open(tmpdir.join('metrics', 'build.json').strpath) as f:
+            data = json.load(f)
+        assert data['counters'] == counters
+        assert data['ratios']['page_reuse_ratio'] == 0.8
+        site.metrics.write_prometheus(tmpdir.join('metrics', 'build.prom').strpath)
+        lines = open(tmpdir.join('metrics', 'build.prom').strpath).read().splitlines()
+        assert 'icecake_build_pages 5' in lines
+        assert '# TYPE icecake_build_pages_rendered gauge' in lines
+        assert any(line.startswith('icecake_build_phase_seconds{phase="render"} ') for line in lines)
+
+
+class TestWriter:
+    def test_pool(self):
+        import threading
+        from icecake.writer import WriterPool
+        written = []
+        release = threading.Event()
+
+        def write(target, data):
+            release.wait()
+            if data == 'bad':
+                raise IOError('disk full')
+            written.append(target)
+        pool = WriterPool(write, threads=2, pending=2)
+        # Two files are being written and two are waiting, so the fifth
+        # write has to wait for room in the queue
+        for i in range(4):
+            pool.write('%d.html' % i, 'cake')
+        assert pool.queue.full()
+        thread = threading.Thread(target=pool.write, args=('4.html', 'cake'))
+        thread.start()
+        thread.join(0.1)
+        assert thread.is_alive()
+        release.set()
+        thread.join()
+        pool.write('5.html', 'bad')
+        with pytest.raises(IOError):
+            pool.close()
+        assert sorted(written) == ['%d.html' % i for i in range(5)]
+
+    def test_build(self, tmpdir):
+        site = cli.Site.initialize(tmpdir.join('threads').strpath)
+        site.build()
+        cli.Site.scaffold(tmpdir.join('serial').strpath)
+        serial = cli.Site(tmpdir.join('serial').strpath)
+        serial.writer_threads = 0
+        serial.build()
+        assert site.writer is None and site.output.folders is None
+        assert site.metrics.values['files_written'] == serial.metrics.values['files_written'] == 5
+        files = cli.ls_relative(site.output_dir)
+        assert files == cli.ls_relative(serial.output_dir)
+        for path in files:
+            assert (open(join(site.output_dir, path)).read() ==
+                    open(join(serial.output_dir, path)).read())
+
+
+class TestOutputs:
+    def read_folder(self, folder):
+        files = {}
+        for path in cli.ls_relative(folder):
+            with open(join(folder, path), 'rb') as f:
+                files[path.replace(os.sep, '/')] = f.read()
+        return files
+
+    def test_from_spec(self, tmpdir):
+        from icecake import outputs
+        assert isinstance(outputs.from_spec('output'), outputs.DirectoryOutput)
+        assert outputs.from_spec('dir:site').root == abspath('site')
+        assert isinstance(outputs.from_spec('tar:site.tar.gz'), outputs.TarOutput)
+        assert isinstance(outputs.from_spec('zip:site.zip'), outputs.ZipOutput)
+        assert isinstance(outputs.from_spec('cas:store'), outputs.ContentOutput)
+        assert isinstance(outputs.from_spec('memory:'), outputs.MemoryOutput)
+        with pytest.raises(ValueError):
+            outputs.from_spec('tar:')
+
+    def test_backends(self, tmpdir):
+        import tarfile
+        import zipfile
+        from icecake import outputs
+        site = cli.Site.initialize(tmpdir.join('site').strpath)
+        site.build()
+        expected = self.read_folder(site.output_dir)
+
+        memory = outputs.MemoryOutput()
+        cli.Site(site.root, output=memory).build()
+        assert memory.files == expected
+
+        names = ['site.tar', 'site.tar.gz', 'site.tar.bz2']
+        if sys.version_info >= (3,):
+            names.append('site.tar.xz')
+        else:
+            with pytest.raises(ValueError):
+                outputs.from_spec('tar:site.tar.xz')
+        for name in names:
+            path = tmpdir.join(name).strpath
+            built = cli.Site(site.root, output='tar:' + path)
+            built.build()
+            assert built.output_dir is None
+            assert not isfile(path + '.tmp')
+            with tarfile.open(path) as archive:
+                files = dict((info.name, archive.extractfile(info).read()) for info in archive.getmembers())
+            assert files == expected
+
+        path = tmpdir.join('site.zip').strpath
+        cli.Site(site.root, output='zip:' + path).build()
+        with zipfile.ZipFile(path) as archive:
+            assert dict((name, archive.read(name)) for name in archive.namelist()) == expected
+
+        store = tmpdir.join('store').strpath
+        built = cli.Site(site.root, output='cas:' + store)
+        built.build()
+        assert built.metrics.values['files_written'] == 5
+        with open(join(store, 'index.json')) as f:
+            index = json.load(f)
+        assert sorted(index) == sorted(expected)
+        for path, key in index.items():
+            with open(join(store, 'objects', key[:2], key[2:]), 'rb') as f:
+                assert f.read() == expected[path]
+        # Nothing changed, so there is nothing new to store
+        built = cli.Site(site.root, output='cas:' + store)
+        built.build()
+        assert built.metrics.values['files_written'] == 0
+        assert built.metrics.values['files_unchanged'] == 5
+
+    def test_failed_build(self, tmpdir):
+        site = cli.Site.initialize(tmpdir.join('site').strpath)
+        path = tmpdir.join('site.zip').strpath
+        built = cli.Site(site.root, output='zip:' + path)
+        built.build()
+        with open(path, 'rb') as f:
+            before = f.read()
+        with open(join(site.root, 'layouts', 'markdown.html'), 'a') as f:
+            f.write('{% broken %}')
+        with pytest.raises(jinja2.TemplateSyntaxError):
+            cli.Site(site.root, output='zip:' + path).build()
+        with open(path, 'rb') as f:
+            assert f.read() == before
+        assert not isfile(path + '.tmp')
+
+    def test_memory_cli(self, tmpdir):
+        site = cli.Site.initialize(tmpdir.strpath)
+        process = subprocess.Popen([sys.executable, '-m', 'icecake.cli', 'build', '--output', 'memory:'],
+                                   cwd=site.root, env=dict(os.environ, PYTHONPATH=module_root),
+                                   stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        _, err = process.communicate()
+        assert process.returncode == 2
+        assert b'memory: can only be used from Python' in err
+
+    def test_incremental(self, tmpdir):
+        site = cli.Site.initialize(tmpdir.join('site').strpath)
+        site = cli.Site(site.root, snapshot=True, output='memory:')
+        with pytest.raises(ValueError):
+            site.build(incremental=True)
+
+
+class TestManifest:
+    def test_build(self, tmpdir):
+        import hashlib
+        from icecake import manifest
+        site = cli.Site.initialize(tmpdir.strpath)
+        cli.Site(site.root, snapshot=True).build()
+        path = join(site.root, '.icecake', 'manifest.json')
+        old = manifest.load(path)
+        assert sorted(old) == sorted(path.replace(os.sep, '/') for path in cli.ls_relative(site.output_dir))
+        for name, entry in old.items():
+            with open(join(site.output_dir, name), 'rb') as f:
+                data = f.read()
+            assert entry['size'] == len(data)
+            assert entry['sha1'] == hashlib.sha1(data).hexdigest()
+        assert old['index.html']['type'] == 'text/html; charset=utf-8'
+
+        # Skipped files keep their entries from the last build
+        cli.Site(site.root, snapshot=True).build(incremental=True)
+        assert manifest.load(path) == old
+
+        with open(join(site.root, 'content', 'articles', 'hello-world.md'), 'a') as f:
+            f.write('\nMore')
+        os.remove(join(site.root, 'content', 'tags.html'))
+        with open(join(site.root, 'static', 'new.txt'), 'w') as f:
+            f.write('new')
+        cli.Site(site.root, snapshot=True).build(incremental=True)
+        new = manifest.load(path)
+        added, changed, deleted = manifest.diff(old, new)
+        assert added == ['new.txt']
+        assert 'articles/hello-world/index.html' in changed
+        assert 'atom.xml' in changed
+        assert deleted == ['tags/index.html']
+        assert sorted(new) == sorted(path.replace(os.sep, '/') for path in cli.ls_relative(site.output_dir))
+
+    def test_static_hashes(self, tmpdir, monkeypatch):
+        import hashlib
+        from icecake import manifest, outputs
+        site = cli.Site.initialize(tmpdir.strpath)
+        cli.Site(site.root, snapshot=True).build()
+        path = join(site.root, '.icecake', 'manifest.json')
+        old = manifest.load(path)
+
+        # A full build copies unchanged static files in the kernel and takes
+        # their hashes from the last build
+        copies = []
+        copy_file = outputs.copy_file
+
+        def record(source, target, sha1=None):
+            copies.append((basename(source), sha1 is None))
+            copy_file(source, target, sha1)
+        monkeypatch.setattr(outputs, 'copy_file', record)
+        with open(join(site.root, 'static', 'css', 'syntax.css'), 'a') as f:
+            f.write('/* changed */')
+        cli.Site(site.root, snapshot=True).build()
+        assert sorted(copies) == [('main.css', True), ('syntax.css', False)]
+        new = manifest.load(path)
+        assert new['css/main.css'] == old['css/main.css']
+        with open(join(site.output_dir, 'css', 'syntax.css'), 'rb') as f:
+            assert new['css/syntax.css']['sha1'] == hashlib.sha1(f.read()).hexdigest()
+
+    def test_diff_command(self, tmpdir):
+        from icecake import manifest
+        old = manifest.Manifest({'a.html': (1, 'a'), 'b.css': (2, 'b'), 'c.js': (3, 'c')})
+        new = manifest.Manifest({'a.html': (1, 'a'), 'b.css': (2, 'B'), 'd.png': (4, 'd')})
+        old.save(tmpdir.join('old.json').strpath)
+        new.save(tmpdir.join('new.json').strpath)
+        output = subprocess.check_output([sys.executable, '-m', 'icecake.cli', 'diff-manifest',
+                                          'old.json', 'new.json'],
+                                         cwd=tmpdir.strpath, env=dict(os.environ, PYTHONPATH=module_root))
+        assert output.decode('utf-8').splitlines() == ['A d.png', 'M b.css', 'D c.js']
+
+
+class TestBuildCache:
+    def test_restore(self, tmpdir):
+        import shutil
+        from icecake import buildcache
+        site = cli.Site.initialize(tmpdir.join('first').strpath)
+        cli.Site(site.root, snapshot=True).build()
+        path = tmpdir.join('cache.tar.gz').strpath
+        assert buildcache.export(cli.Site(site.root, snapshot=True), path) > 0
+
+        # A fresh checkout: same content, new mtimes and no cache or output
+        root = tmpdir.join('second').strpath
+        shutil.copytree(site.root, root)
+        shutil.rmtree(join(root, '.icecake'))
+        shutil.rmtree(join(root, 'output'))
+        for name in os.listdir(join(root, 'content')):
+            if isfile(join(root, 'content', name)):
+                os.utime(join(root, 'content', name), None)
+        count, rebased = buildcache.restore(cli.Site(root), path)
+        assert isfile(join(root, '.icecake', 'snapshot.pickle'))
+        assert rebased == 5
+        second = cli.Site(root, snapshot=True)
+        second.build(incremental=True)
+        assert second.metrics.values['pages_parsed'] == 0
+        assert second.metrics.values['markdown_converted'] == 0
+        assert cli.ls_relative(second.output_dir) == cli.ls_relative(site.output_dir)
+
+    def test_stale(self, tmpdir, monkeypatch):
+        from icecake import buildcache
+        site = cli.Site.initialize(tmpdir.join('site').strpath)
+        cli.Site(site.root, snapshot=True).build()
+        path = tmpdir.join('cache.tar.gz').strpath
+        buildcache.export(site, path)
+        os.remove(join(site.root, '.icecake', 'snapshot.pickle'))
+
+        monkeypatch.setattr(buildcache, 'python_version', lambda: '2.6')
+        with pytest.raises(buildcache.StaleCache):
+            buildcache.restore(site, path)
+        monkeypatch.undo()
+        monkeypatch.setattr(buildcache, 'library_versions', lambda: ('2.6.11', '2.2.0'))
+        with pytest.raises(buildcache.StaleCache) as e:
+            buildcache.restore(site, path)
+        assert 'not 2.2.0' in str(e.value)
+        monkeypatch.undo()
+        site.markdown_options = {}
+        with pytest.raises(buildcache.StaleCache):
+            buildcache.restore(site, path)
+        assert not isfile(join(site.root, '.icecake', 'snapshot.pickle'))
+
+    def test_unexpected_file(self, tmpdir):
+        import io
+        import json
+        import tarfile
+        from icecake import buildcache
+        site = cli.Site.initialize(tmpdir.join('site').strpath)
+        path = tmpdir.join('cache.tar.gz').strpath
+        metadata = dict(buildcache.describe(site), version=buildcache.version, sources={})
+        with tarfile.open(path, 'w:gz') as archive:
+            for name, data in [(buildcache.metadata_name, json.dumps(metadata).encode('utf-8')),
+                               ('cache/pages.sqlite', b'pages'), ('cache/../escape', b'oops')]:
+                info = tarfile.TarInfo(name)
+                info.size = len(data)
+                archive.addfile(info, io.BytesIO(data))
+        with pytest.raises(buildcache.CacheError):
+            buildcache.restore(site, path)
+        # The files extracted before the error are cleaned up
+        assert not os.path.exists(join(site.root, '.icecake.import'))
+
+        with pytest.raises(buildcache.CacheError):
+            buildcache.restore(site, join(site.root, 'content', 'index.html'))
+
+
+class TestBenchmarks:
+    def test_generate(self, tmpdir):
+        from benchmarks import sitegen
+        root = sitegen.generate(tmpdir.strpath, pages=4, tags=2, code_blocks=2, depth=2,
+                                static_files=3, static_size=100)
+        site = cli.Site(root)
+        site.build()
+        bench = [page for page in site.pagedata if page.startswith(join('articles', 'bench'))]
+        assert len(bench) == 4
+        assert set(tag for page in bench for tag in site.pagedata[page].tags) <= set(['tag-0', 'tag-1'])
+        html = open(join(root, 'output', 'articles', 'bench', 'page-0000', 'index.html')).read()
+        assert 'class="level-2"' in html and 'class="level-1"' in html
+        assert html.count('class="codehilite"') == 2
+        assert len(cli.ls_relative(join(root, 'static', 'bench'))) == 3
+        assert os.path.getsize(join(root, 'static', 'bench', 'asset-0000.bin')) == 100
+
+        # The same settings always make the same site
+        other = sitegen.generate(tmpdir.join('other').strpath, pages=4, tags=2, code_blocks=2,
+                                 depth=2, static_files=3, static_size=100)
+        for path in cli.ls_relative(join(root, 'content', 'articles', 'bench')):
+            assert (open(join(root, 'content', 'articles', 'bench', path)).read() ==
+                    open(join(other, 'content', 'articles', 'bench', path)).read())
+
+    def test_run_compare(self, tmpdir):
+        from benchmarks import run
+        results = run.run(tmpdir.strpath, repeat=2, only=['incremental_build', 'pages_query'],
+                          pages=5, static_files=1, static_size=10)
+        assert sorted(results['results']) == ['incremental_build', 'pages_query']
+        assert len(results['results']['pages_query']['runs']) == 2
+
+        slower = json.loads(json.dumps(results))
+        slower['results']['pages_query']['median'] *= 2
+        rows, regressions = run.compare(results, slower, threshold=0.5)
+        assert [row[0] for row in rows] == ['incremental_build', 'pages_query']
+        assert regressions == ['pages_query']
+        assert run.compare(results, results)[1] == []
+
+
+class TestStore:
+    def test_query(self, tmpdir):
+        site = cli.Site.initialize(tmpdir.strpath)
+        stored = cli.Site(site.root, store=True)
+        assert isfile(join(site.root, '.icecake', 'pages.sqlite'))
+        for query in [{}, {'path': 'articles/'}, {'tag': 'hello'}, {'tag': 'nope'}, {'order': 'date', 'limit': 1},
+                      {'path': 'articles/', 'order': '-date'}, {'path': 'articles/', 'order': 'title', 'limit': 2}]:
+            expected = [page.filepath for page in site.pages(**query)]
+            assert [page.filepath for page in stored.pages(**query)] == expected
+        assert stored.tags() == site.tags() == ['hello']
+
+    def test_reload(self, tmpdir, monkeypatch):
+        site = cli.Site.initialize(tmpdir.strpath)
+        cli.Site(site.root, store=True).build()
+
+        # Unchanged pages are loaded from the store without parsing them
+        def parse_string(*args):
+            raise AssertionError("page should not be parsed")
+        monkeypatch.setattr(cli.Page, 'parse_string', parse_string)
+        stored = cli.Site(site.root, store=True)
+        page = stored.pagedata['articles/hello-world.md']
+        assert page.title == 'Hello world!'
+        assert page.published == datetime(2016, 4, 2)
+        assert page.tags == ['hello']
+        assert '<p>' in page.get_content()
+        monkeypatch.undo()
+
+        # Changed and deleted pages are picked up
+        with open(join(site.root, 'content', 'articles', 'hello-world.md'), 'a') as f:
+            f.write('\nMore words')
+        os.remove(join(site.root, 'content', 'index.html'))
+        stored = cli.Site(site.root, store=True)
+        assert 'More words' in stored.pagedata['articles/hello-world.md'].body
+        assert 'index.html' not in [page.filepath for page in stored.pages()]
+
+    def test_markdown_changed(self, tmpdir):
+        site = cli.Site.initialize(tmpdir.strpath)
+        cli.Site(site.root, store=True).build()
+        stored = cli.Site(site.root, store=True)
+        stored.pagedata['articles/hello-world.md'].get_content()
+        assert stored.metrics.values.get('markdown_converted', 0) == 0
+
+        # Content converted with other Markdown settings is not reused
+        stored = cli.Site(site.root, store=True)
+        stored.markdown_options = {}
+        stored.pagedata['articles/hello-world.md'].get_content()
+        assert stored.metrics.values['markdown_converted'] == 1
+
+
+class TestSnapshot:
+    def rendered(self, monkeypatch):
+        rendered = []
+        render_to_disk = cli.Page.render_to_disk
+
+        def record(page):
+            rendered.append(page.filepath)
+            render_to_disk(page)
+        monkeypatch.setattr(cli.Page, 'render_to_disk', record)
+        return rendered
+
+    def test_unchanged(self, tmpdir, monkeypatch):
+        site = cli.Site.initialize(tmpdir.strpath)
+        cli.Site(site.root, snapshot=True).build()
+        assert isfile(join(site.root, '.icecake', 'snapshot.pickle'))
+
+        rendered = self.rendered(monkeypatch)
+        cli.Site(site.root, snapshot=True).build(incremental=True)
+        assert rendered == []
+
+        # A different mode renders everything
+        cli.Site(site.root, preview_mode=True, snapshot=True).build(incremental=True)
+        assert len(rendered) == 5
+
+    def test_layout_changed(self, tmpdir, monkeypatch):
+        site = cli.Site.initialize(tmpdir.strpath)
+        cli.Site(site.root, snapshot=True).build()
+        layout = join(site.root, 'layouts', 'markdown.html')
+        source = open(layout).read().replace('<hr>', '<hr class="changed">')
+        with open(layout, 'w') as f:
+            f.write(source)
+        os.remove(join(site.root, 'output', 'index.html'))
+
+        rendered = self.rendered(monkeypatch)
+        cli.Site(site.root, snapshot=True).build(incremental=True)
+        assert sorted(rendered) == ['articles/hello-world.md', 'index.html']
+        assert 'changed' in open(join(site.root, 'output', 'articles', 'hello-world', 'index.html')).read()
+
+    def test_page_removed(self, tmpdir, monkeypatch):
+        site = cli.Site.initialize(tmpdir.strpath)
+        cli.Site(site.root, snapshot=True).build()
+        os.remove(join(site.root, 'content', 'articles', 'hello-world.md'))
+        os.remove(join(site.root, 'static', 'css', 'syntax.css'))
+
+        rendered = self.rendered(monkeypatch)
+        cli.Site(site.root, snapshot=True).build(incremental=True)
+        # Only the pages that list other pages are rendered again
+        assert sorted(rendered) == ['articles.html', 'atom.xml', 'index.html', 'tags.html']
+        assert cli.ls_relative(join(site.root, 'output')) == [
+            'articles/index.html',
+            'atom.xml',
+            'css/main.css',
+            'index.html',
+            'tags/index.html'
+        ]
+
+    def test_unsafe(self, tmpdir):
+        import pickle
+        from icecake.snapshot import Snapshot
+        path = tmpdir.join('snapshot.pickle').strpath
+        snapshot = Snapshot(path)
+        snapshot.pages = {'a.md': {'tags': set(['a']), 'stat': (1.0, 2)}}
+        snapshot.save()
+        assert Snapshot.load(path).pages == snapshot.pages
+
+        # A pickle that calls a function when it is loaded is not loaded
+        with open(path, 'wb') as f:
+            pickle.dump({'version': Snapshot.version, 'pages': os.getcwd}, f, protocol=2)
+        assert Snapshot.load(path).pages == {}
+
+
+class TestMemory:
+    script = """
+import resource, sys
+from icecake import cli
+before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+site = cli.Site(sys.argv[1])
+site.markdown_plugins = []
+site.build()
+after = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+print(after - before)
+"""
+
+    @pytest.mark.skipif(not sys.platform.startswith('linux'), reason="ru_maxrss is in KB on linux")
+    def test_build_peak_rss(self, tmpdir):
+        """
+        Build a site with 20MB of markdown and make sure the peak RSS of the
+        build doesn't grow with the size of the site. Pages must not hold on to
+        their bodies or HTML after they are written.
+        """
+        site = cli.Site.initialize(tmpdir.strpath)
+        os.makedirs(join(site.root, 'content', 'notes'))
+        body = ("    " + "x" * 75 + "\n") * 625
+        for i in range(400):
+            with open(join(site.root, 'content', 'notes', '%d.md' % i), 'w') as f:
+                f.write("title = Note %d\ndate = 2016-01-01\n++++\n\n%s" % (i, body))
+        corpus_kb = 400 * len(body) // 1024
+
+        output = subprocess.check_output([sys.executable, '-c', self.script, site.root],
+                                         cwd=module_root)
+        assert int(output.decode('utf-8').strip()) < corpus_kb // 2
+        assert isfile(join(site.root, 'output', 'notes', '399', 'index.html'))
+
 
 class TestUpdates:
     def test_list_dependents(self, tmpdir):
@@ -276,8 +1100,389 @@ class TestUpdates:
 
 
 class TestCLI:
-    # TODO add tests for the CLI
-    pass
+    heavy = ['jinja2', 'markdown', 'dateutil', 'watchdog', 'http.server', 'sqlite3',
+             'icecake.templates', 'icecake.livejs', 'icecake.feeds', 'icecake.store']
+
+    def imports(self, args, cwd=module_root):
+        """
+        Run an icecake command with python -X importtime and return the names
+        of the modules it imported
+        """
+        script = "import sys; from icecake.cli import cli; cli(sys.argv[1:])"
+        env = dict(os.environ, PYTHONPATH=module_root)
+        proc = subprocess.Popen([sys.executable, '-X', 'importtime', '-c', script] + args,
+                                cwd=cwd, env=env, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        _, err = proc.communicate()
+        assert proc.returncode == 0, err
+        modules = set()
+        for line in err.decode('utf-8').splitlines():
+            if line.startswith('import time:') and '|' in line:
+                modules.add(line.split('|')[-1].strip())
+        return modules
+
+    @pytest.mark.skipif(sys.version_info < (3, 7), reason="-X importtime needs python 3.7")
+    def test_help_imports(self):
+        for args in [['--help'], ['build', '--help'], ['preview', '--help'],
+                     ['watch', '--help'], ['serve', '--help']]:
+            modules = self.imports(args)
+            assert 'icecake.cli' in modules
+            for name in self.heavy:
+                assert name not in modules, "%s imported %s" % (args, name)
+
+    @pytest.mark.skipif(sys.version_info < (3, 7), reason="-X importtime needs python 3.7")
+    def test_init_imports(self, tmpdir):
+        modules = self.imports(['init', tmpdir.strpath])
+        assert 'icecake.templates' in modules
+        for name in self.heavy:
+            if name != 'icecake.templates':
+                assert name not in modules, "init imported %s" % name
+
+    @pytest.mark.skipif(sys.version_info < (3, 7), reason="-X importtime needs python 3.7")
+    def test_build_imports(self, tmpdir):
+        cli.Site.scaffold(tmpdir.strpath)
+        modules = self.imports(['build'], cwd=tmpdir.strpath)
+        assert 'jinja2' in modules
+        assert 'markdown' in modules
+        for name in ['watchdog', 'http.server', 'dateutil', 'icecake.livejs', 'icecake.store',
+                     'icecake.templates']:
+            assert name not in modules, "build imported %s" % name
+
+    def test_moved(self, monkeypatch):
+        from icecake import server, watcher
+        from icecake.cli import Handler, HTTPServer
+        assert Handler is watcher.Handler and HTTPServer is server.HTTPServer
+        assert cli.Watcher is watcher.Watcher
+        # The module still works as before
+        monkeypatch.setattr(cli, 'curdir', '/nowhere')
+        assert cli.curdir == '/nowhere'
+        monkeypatch.undo()
+        assert cli.curdir != '/nowhere'
+
+    @pytest.mark.skipif(sys.version_info < (3, 7), reason="-X importtime needs python 3.7")
+    def test_import_time(self):
+        # The classes that moved out of cli are still there, but loading cli
+        # doesn't import them
+        script = ("import sys, icecake.cli; assert 'watchdog' not in sys.modules; "
+                  "from icecake.cli import Handler, Watcher, HTTPHandler, HTTPServer, Server; "
+                  "import icecake.watcher, icecake.server; "
+                  "assert Watcher is icecake.watcher.Watcher and Server is icecake.server.Server")
+        env = dict(os.environ, PYTHONPATH=module_root)
+        proc = subprocess.Popen([sys.executable, '-X', 'importtime', '-c', script],
+                                cwd=module_root, env=env, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        _, err = proc.communicate()
+        assert proc.returncode == 0, err
+        for line in err.decode('utf-8').splitlines():
+            if line.startswith('import time:') and line.endswith('| icecake.cli'):
+                # Microseconds, including everything cli imports. It takes
+                # around a tenth of that on a laptop.
+                assert int(line.split('|')[1]) < 1000000
+                break
+        else:
+            assert False, "icecake.cli was not imported"
+        with pytest.raises(AttributeError):
+            cli.Nope
+
+
+class TestPreview:
+    def test_on_demand(self, tmpdir):
+        from icecake.preview import Preview
+        cli.Site.scaffold(tmpdir.strpath)
+        site = cli.Site(tmpdir.strpath, preview_mode=True)
+        preview = Preview(site)
+        assert len(preview) == 5
+
+        # Only the requested page is rendered
+        preview.ensure('/articles/hello-world/?reload=1')
+        preview.ensure('/css/main.css')
+        assert cli.ls_relative(join(site.root, 'output')) == [
+            'articles/hello-world/index.html',
+            'css/main.css',
+        ]
+        assert 'articles/hello-world.md' in preview.fresh
+
+        # The background task fills in everything else
+        preview.fill()
+        assert cli.ls_relative(join(site.root, 'output')) == [
+            'articles/hello-world/index.html',
+            'articles/index.html',
+            'atom.xml',
+            'css/main.css',
+            'css/syntax.css',
+            'index.html',
+            'tags/index.html'
+        ]
+        assert preview.stale() == []
+
+        preview.invalidate(['index.html'])
+        assert preview.stale() == ['index.html']
+        preview.ensure('/index.html')
+        assert preview.stale() == []
+
+    def test_snapshot(self, tmpdir):
+        from icecake.preview import Preview
+        cli.Site.scaffold(tmpdir.strpath)
+        preview = Preview(cli.Site(tmpdir.strpath, preview_mode=True, snapshot=True))
+        preview.ensure('/articles/hello-world/')
+        preview.save_snapshot()
+
+        # Only the page we rendered is up to date on the next run
+        preview = Preview(cli.Site(tmpdir.strpath, preview_mode=True, snapshot=True))
+        assert 'articles/hello-world.md' in preview.fresh
+        assert 'index.html' in preview
+
+    def test_priority(self, tmpdir):
+        from icecake.preview import Preview
+        cli.Site.scaffold(tmpdir.strpath)
+        preview = Preview(cli.Site(tmpdir.strpath, preview_mode=True))
+        preview.fill()
+
+        # A layout change queues every page, but the open pages come first,
+        # the most recently requested one before the other
+        preview.ensure('/tags/')
+        preview.ensure('/articles/hello-world/')
+        preview.rebuild(preview.site.list_dependents('basic.html'))
+        assert len(preview) == 4
+        order = []
+        while len(preview):
+            order.append(preview.pop())
+        assert order == ['articles/hello-world.md', 'tags.html', 'articles.html', 'index.html']
+
+    def test_queue(self, tmpdir):
+        from icecake.preview import BACKGROUND, VIEWING, RebuildQueue
+        queue = RebuildQueue(None)
+        queue.push(['a', 'b', 'c'], BACKGROUND)
+        queue.push(['c', 'd'])
+        queue.push(['b'], VIEWING)
+        # Queuing a page again can move it up, but never down
+        queue.push(['b'], BACKGROUND)
+        assert len(queue) == 4
+        assert [queue.pop(), queue.pop(), queue.pop(), queue.pop()] == ['b', 'c', 'd', 'a']
+        assert queue.pop(block=False) is None
+
+
+class TestWatcher:
+    def test_rescan(self, tmpdir):
+        site = cli.Site.initialize(tmpdir.strpath)
+        site.build()
+        assert site.rescan() == []
+
+        # Pretend the watcher missed all of these
+        layout = join(site.root, 'layouts', 'markdown.html')
+        source = open(layout).read().replace('<hr>', '<hr class="changed">')
+        with open(layout, 'w') as f:
+            f.write(source)
+        os.remove(join(site.root, 'content', 'tags.html'))
+        os.remove(join(site.root, 'static', 'css', 'syntax.css'))
+        tmpdir.join('static', 'js', 'main.js').write('alert(1);', ensure=True)
+
+        assert site.rescan() == ['articles.html', 'articles/hello-world.md', 'atom.xml',
+                                 'index.html']
+        assert 'tags.html' not in site.pagedata
+        assert cli.ls_relative(join(site.root, 'output')) == [
+            'articles/hello-world/index.html',
+            'articles/index.html',
+            'atom.xml',
+            'css/main.css',
+            'index.html',
+            'js/main.js',
+        ]
+        assert site.rescan() == []
+
+    def test_reconcile(self, tmpdir):
+        from icecake.watcher import Watcher
+        site = cli.Site.initialize(tmpdir.strpath)
+        site.build()
+        watcher = Watcher(site)
+        tmpdir.join('content', 'new.html').write('{% extends "basic.html" %}', ensure=True)
+        watcher.rescan()
+        assert 'new.html' in watcher.queue
+        watcher.queue.run_pending()
+        assert isfile(join(site.root, 'output', 'new', 'index.html'))
+
+        # Static files found by a rescan wait to settle like any other change
+        tmpdir.join('static', 'video.mp4').write('partial')
+        watcher.rescan()
+        assert not isfile(join(site.root, 'output', 'video.mp4'))
+        assert 'video.mp4' in watcher.settling
+        watcher.stable = 0
+        watcher.copy_stable()
+        assert open(join(site.root, 'output', 'video.mp4')).read() == 'partial'
+
+    def queued(self, queue):
+        items = []
+        while len(queue):
+            items.append(queue.pop())
+        return sorted(items)
+
+    def test_delete(self, tmpdir):
+        from watchdog.events import FileDeletedEvent
+        from icecake.watcher import Handler, Watcher
+        site = cli.Site.initialize(tmpdir.strpath)
+        site.build()
+        watcher = Watcher(site)
+        page = join(site.root, 'content', 'articles', 'hello-world.md')
+        os.remove(page)
+        Handler().dispatch(FileDeletedEvent(page))
+        assert 'articles/hello-world.md' not in site.pagedata
+        assert not os.path.exists(join(site.root, 'output', 'articles', 'hello-world'))
+        # The pages that list other pages are rendered again
+        assert self.queued(watcher.queue) == ['articles.html', 'atom.xml', 'index.html', 'tags.html']
+
+    def test_move(self, tmpdir):
+        from watchdog.events import FileMovedEvent
+        from icecake.watcher import Handler, Watcher
+        site = cli.Site.initialize(tmpdir.strpath)
+        site.build()
+        watcher = Watcher(site)
+        handler = Handler()
+
+        source = join(site.root, 'static', 'css', 'main.css')
+        dest = join(site.root, 'static', 'style', 'main.css')
+        os.makedirs(dirname(dest))
+        os.rename(source, dest)
+        handler.dispatch(FileMovedEvent(source, dest))
+        assert not os.path.exists(join(site.root, 'output', 'css', 'main.css'))
+        assert isfile(join(site.root, 'output', 'style', 'main.css'))
+        assert len(watcher.queue) == 0
+
+        source = join(site.root, 'content', 'articles', 'hello-world.md')
+        dest = join(site.root, 'content', 'articles', 'hello.md')
+        os.rename(source, dest)
+        handler.dispatch(FileMovedEvent(source, dest))
+        assert 'articles/hello.md' in site.pagedata
+        assert not os.path.exists(join(site.root, 'output', 'articles', 'hello-world'))
+        assert self.queued(watcher.queue) == ['articles.html', 'articles/hello.md', 'atom.xml',
+                                              'index.html', 'tags.html']
+
+    def test_move_ignored(self, tmpdir):
+        from watchdog.events import FileMovedEvent
+        from icecake.watcher import Handler, Watcher
+        site = cli.Site.initialize(tmpdir.strpath)
+        site.build()
+        watcher = Watcher(site)
+        handler = Handler()
+
+        # Emacs keeps a backup by renaming the file it saves
+        source = join(site.root, 'static', 'css', 'main.css')
+        os.rename(source, source + '~')
+        handler.dispatch(FileMovedEvent(source, source + '~'))
+        assert not os.path.exists(join(site.root, 'output', 'css', 'main.css'))
+        assert not os.path.exists(join(site.root, 'output', 'css', 'main.css~'))
+
+        source = join(site.root, 'content', 'articles', 'hello-world.md')
+        os.rename(source, source + '~')
+        handler.dispatch(FileMovedEvent(source, source + '~'))
+        assert 'articles/hello-world.md' not in site.pagedata
+        assert 'articles/hello-world.md~' not in site.pagedata
+        self.queued(watcher.queue)
+
+        # Moving it back counts as adding it
+        os.rename(source + '~', source)
+        handler.dispatch(FileMovedEvent(source + '~', source))
+        assert 'articles/hello-world.md' in site.pagedata
+        assert 'articles/hello-world.md' in self.queued(watcher.queue)
+
+    def test_static_settles(self, tmpdir):
+        from watchdog.events import FileClosedEvent, FileModifiedEvent
+        from icecake.watcher import Handler, Watcher
+        site = cli.Site.initialize(tmpdir.strpath)
+        site.build()
+        watcher = Watcher(site)
+        handler = Handler()
+        source = tmpdir.join('static', 'video.mp4')
+        target = join(site.root, 'output', 'video.mp4')
+
+        # Nothing is copied while the file is still changing
+        source.write('part', ensure=True)
+        handler.dispatch(FileModifiedEvent(source.strpath))
+        watcher.copy_stable()
+        assert not isfile(target)
+        source.write('partial')
+        watcher.stable = 0
+        watcher.copy_stable()
+        assert not isfile(target)
+        watcher.copy_stable()
+        assert open(target).read() == 'partial'
+
+        # Closing the file after writing it means it is done
+        source.write('complete')
+        handler.dispatch(FileModifiedEvent(source.strpath))
+        handler.dispatch(FileClosedEvent(source.strpath))
+        assert open(target).read() == 'complete'
+        assert watcher.settling == {}
+
+
+class TestServer:
+    def test_serve_root(self, tmpdir):
+        from icecake import server
+        try:
+            from urllib.request import urlopen
+        except ImportError:
+            from urllib2 import urlopen
+        import threading
+
+        root = tmpdir.mkdir('output')
+        root.mkdir('cake').join('index.html').write('chocolate')
+        server.HTTPHandler.root = server.Server(root.strpath).root
+        httpd = server.HTTPServer(('127.0.0.1', 0), server.HTTPHandler)
+        thread = threading.Thread(target=httpd.serve_forever)
+        thread.start()
+        try:
+            url = 'http://127.0.0.1:%d/cake/' % httpd.server_address[1]
+            assert urlopen(url).read() == b'chocolate'
+        finally:
+            httpd.shutdown()
+            httpd.server_close()
+            thread.join()
+
+    def test_stats(self, tmpdir):
+        from icecake import server
+        from icecake.preview import Preview
+        try:
+            from urllib.request import urlopen
+            from urllib.error import HTTPError
+        except ImportError:
+            from urllib2 import urlopen, HTTPError
+        import threading
+
+        site = cli.Site.initialize(tmpdir.strpath)
+        site = cli.Site(site.root, preview_mode=True, snapshot=True)
+        preview = Preview(site)
+        preview.fill()
+        preview.rebuild(['articles/hello-world.md', 'articles.html'])
+        preview.run_pending()
+
+        server.HTTPHandler.root = server.Server(site.output_dir).root
+        server.HTTPHandler.preview = preview
+        server.HTTPHandler.stats = server.RequestStats()
+        httpd = server.HTTPServer(('127.0.0.1', 0), server.HTTPHandler)
+        thread = threading.Thread(target=httpd.serve_forever)
+        thread.start()
+        try:
+            url = 'http://127.0.0.1:%d' % httpd.server_address[1]
+            urlopen(url + '/articles/').read()
+            with pytest.raises(HTTPError):
+                urlopen(url + '/nope/')
+            with pytest.raises(HTTPError):
+                urlopen(url + '/__icecake/nope')
+            stats = json.loads(urlopen(url + '/__icecake/stats').read().decode('utf-8'))
+        finally:
+            httpd.shutdown()
+            httpd.server_close()
+            thread.join()
+            server.HTTPHandler.preview = None
+            server.HTTPHandler.stats = None
+
+        assert stats['requests']['statuses'] == {'200': 1, '404': 2}
+        assert stats['requests']['latency_seconds']['count'] == 3
+        stats = stats['preview']
+        assert stats['queue'] == 0
+        assert stats['rendered'] == 7
+        assert stats['rebuild_latency_seconds']['count'] == 2
+        assert stats['pages_per_change']['count'] == 1
+        assert stats['pages_per_change']['buckets'][1] == [2, 1]
+        assert stats['cache']['pages'] == 5
+        assert stats['counters']['pages_rendered'] == 7
 
 
 class TestTemplates: